@@ -0,0 +1,121 @@
+"""
+Compare searches ANDing 2 to 8 tags, and 2 to 8 fields, matched with
+a join of the tag or field table per term and with one grouped lookup
+(``sqlalchemy3.search_group_terms``), on a tag heavy corpus.
+
+Run from the top of the repository:
+
+    python bench/bench_conjunctions.py [db_config]
+
+db_config defaults to a sqlite file.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+import mangler
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.sqlalchemy3 import (Base, sBag, sTiddler, sRevision,
+        sTag, sField, current_revision_table, first_revision_table)
+
+TIDDLERS = 20000
+TAGS = 40
+TAGS_PER_TIDDLER = 12
+FIELDS = 12
+CHUNK = 1000
+COUNT = 5
+
+
+def make_store(db_config, grouped=False):
+    return Store(config['server_store'][0], {'db_config': db_config},
+            {'tiddlyweb.config': dict(config,
+                **{'sqlalchemy3.search_group_terms': grouped})})
+
+
+def insert(store, table, rows):
+    for start in xrange(0, len(rows), CHUNK):
+        store.storage.session.execute(table.insert(),
+                rows[start:start + CHUNK])
+
+
+def populate(store):
+    """
+    Insert TIDDLERS tiddlers with TAGS_PER_TIDDLER tags each, the lower
+    numbered tags being the more common, and FIELDS fields each with
+    one of two values, directly with Core.
+    """
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    generator = random.Random(50)
+    ids = range(1, TIDDLERS + 1)
+    insert(store, sBag.__table__, [{'id': 1, 'name': u'bench',
+        'desc': u''}])
+    insert(store, sTiddler.__table__, [{'id': i, 'bag': u'bench',
+        'title': u'tiddler%s' % i} for i in ids])
+    insert(store, sRevision.__table__, [{'number': i, 'tiddler_id': i,
+        'modifier': u'someone', 'modified': u'20120101000000',
+        'type': None} for i in ids])
+    weights = [1.0 / (tag + 1) for tag in xrange(TAGS)]
+    tags = []
+    for i in ids:
+        chosen = set()
+        while len(chosen) < TAGS_PER_TIDDLER:
+            chosen.add(_weighted(generator, weights))
+        tags.extend({'revision_number': i, 'tag': u'tag%s' % tag}
+                for tag in chosen)
+    insert(store, sTag.__table__, tags)
+    insert(store, sField.__table__, [{'revision_number': i,
+        'name': u'field%s' % field,
+        'value': u'value%s' % generator.randint(0, 1)}
+        for i in ids for field in xrange(FIELDS)])
+    insert(store, current_revision_table, [{'tiddler_id': i, 'current_id': i}
+        for i in ids])
+    insert(store, first_revision_table, [{'tiddler_id': i, 'first_id': i}
+        for i in ids])
+    store.storage.session.commit()
+
+
+def _weighted(generator, weights):
+    point = generator.random() * sum(weights)
+    for index, weight in enumerate(weights):
+        point -= weight
+        if point < 0:
+            return index
+    return len(weights) - 1
+
+
+def ms_per_search(store, query):
+    results = store.storage.search_count(query)
+    start = time.time()
+    for _ in xrange(COUNT):
+        store.storage.search_count(query)
+    return (time.time() - start) / COUNT * 1000, results
+
+
+def main():
+    db_config = len(sys.argv) > 1 and sys.argv[1] or 'sqlite:///bench.db'
+    store = make_store(db_config)
+    populate(store)
+    grouped_store = make_store(db_config, True)
+    print '%-8s %10s %10s %10s' % ('terms', 'joins', 'grouped', 'results')
+    for kind, term in [('tags', u'tag:tag%s'), ('fields', u'field%s:value0')]:
+        for terms in xrange(2, 9):
+            query = u' AND '.join(term % index for index in xrange(terms))
+            joined, results = ms_per_search(store, query)
+            grouped, grouped_results = ms_per_search(grouped_store, query)
+            assert results == grouped_results
+            print '%-8s %7.1f ms %7.1f ms %10s' % ('%s %s' % (terms, kind),
+                    joined, grouped, results)
+
+    if db_config == 'sqlite:///bench.db':
+        os.unlink('bench.db')
+
+
+if __name__ == '__main__':
+    main()
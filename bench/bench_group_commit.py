@@ -0,0 +1,97 @@
+"""
+Measure tiddler_put throughput from many threads against the group
+commit window (``sqlalchemy3.group_commit_window``), 0 being a commit
+per put.
+
+Run from the top of the repository:
+
+    python bench/bench_group_commit.py [db_config]
+
+db_config defaults to a sqlite file. Each window is measured in a
+forked process, since the committer for a database is made once.
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.getcwd())
+import mangler
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.sqlalchemy3 import Base, Session
+
+THREADS = 16
+PUTS = 50
+WINDOWS = [0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05]
+
+
+def make_store(db_config, window):
+    return Store(config['server_store'][0], {'db_config': db_config},
+            {'tiddlyweb.config': dict(config, **{
+                'sqlalchemy3.group_commit_window': window,
+                'sqlalchemy3.group_commit_size': THREADS})})
+
+
+def writer(db_config, window, index):
+    store = make_store(db_config, window)
+    for number in xrange(PUTS):
+        tiddler = Tiddler(u'tiddler%s-%s' % (index, number), u'bench')
+        tiddler.text = u'some text'
+        tiddler.tags = [u'one', u'two']
+        store.put(tiddler)
+    Session.remove()
+
+
+def measure(db_config, window):
+    """
+    Run the writers in a child process, returning puts per second and
+    the mean number of puts per commit.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        store = make_store(db_config, window)
+        threads = [threading.Thread(target=writer,
+            args=(db_config, window, index)) for index in xrange(THREADS)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+        committer = store.storage.group_commit
+        commits = committer and committer.batches or THREADS * PUTS
+        os.write(write, '%s %s' % (seconds, commits))
+        os._exit(0)
+    os.close(write)
+    output = os.read(read, 1024)
+    os.waitpid(pid, 0)
+    seconds, commits = output.split()
+    return THREADS * PUTS / float(seconds), THREADS * PUTS / float(commits)
+
+
+def main():
+    db_config = len(sys.argv) > 1 and sys.argv[1] or 'sqlite:///bench.db'
+    print '%10s %12s %12s' % ('window', 'puts/s', 'puts/commit')
+    for window in WINDOWS:
+        store = make_store(db_config, 0)
+        Base.metadata.drop_all()
+        Base.metadata.create_all()
+        store.put(Bag(u'bench'))
+        Session.remove()
+        rate, batch = measure(db_config, window)
+        print '%8.3f s %12.0f %12.1f' % (window, rate, batch)
+
+    if db_config == 'sqlite:///bench.db':
+        os.unlink('bench.db')
+
+
+if __name__ == '__main__':
+    main()
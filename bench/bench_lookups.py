@@ -0,0 +1,92 @@
+"""
+Measure the CPU time per call of the store's hot lookups: bag_get,
+recipe_get, user_get, tiddler_get (current and by revision) and
+tiddler_put of a new revision.
+
+Run from the top of the repository:
+
+    python bench/bench_lookups.py [db_config]
+
+db_config defaults to a sqlite file.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+import mangler
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+
+from tiddlywebplugins.sqlalchemy3 import Base
+
+COUNT = 2000
+
+
+def make_store(db_config):
+    return Store(config['server_store'][0], {'db_config': db_config},
+            {'tiddlyweb.config': config})
+
+
+def cpu_per_call(function):
+    for _ in xrange(50):
+        function()
+    start = time.clock()
+    for _ in xrange(COUNT):
+        function()
+    return (time.clock() - start) / COUNT * 1000000
+
+
+def main():
+    db_config = len(sys.argv) > 1 and sys.argv[1] or 'sqlite:///bench.db'
+    store = make_store(db_config)
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    store.put(Bag(u'bench'))
+    recipe = Recipe(u'bench')
+    recipe.set_recipe([(u'bench', u'')])
+    store.put(recipe)
+    user = User(u'bench')
+    user.add_role(u'ADMIN')
+    store.put(user)
+    tiddler = Tiddler(u'bench', u'bench')
+    tiddler.text = u'some text'
+    tiddler.tags = [u'one', u'two']
+    tiddler.fields[u'alpha'] = u'a'
+    store.put(tiddler)
+    revision = tiddler.revision
+
+    def put():
+        tiddler = Tiddler(u'bench', u'bench')
+        tiddler.text = u'some text'
+        tiddler.tags = [u'one', u'two']
+        tiddler.fields[u'alpha'] = u'a'
+        store.put(tiddler)
+
+    def get_revision(revision):
+        tiddler = Tiddler(u'bench', u'bench')
+        tiddler.revision = revision
+        return store.get(tiddler)
+
+    operations = [
+            ('bag_get', lambda: store.get(Bag(u'bench'))),
+            ('recipe_get', lambda: store.get(Recipe(u'bench'))),
+            ('user_get', lambda: store.get(User(u'bench'))),
+            ('tiddler_get', lambda: store.get(Tiddler(u'bench', u'bench'))),
+            ('tiddler_get revision', lambda: get_revision(revision)),
+            ('tiddler_put', put)]
+    for name, function in operations:
+        print '%-22s %7.1f us cpu/call' % (name, cpu_per_call(function))
+
+    if db_config == 'sqlite:///bench.db':
+        os.unlink('bench.db')
+
+
+if __name__ == '__main__':
+    main()
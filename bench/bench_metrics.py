@@ -0,0 +1,64 @@
+"""
+Measure the cost of metrics collection, in absolute terms and
+relative to a tiddler get from a sqlite store.
+
+Run from the top of the repository:
+
+    python bench/bench_metrics.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+import mangler
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.sqlalchemy3 import Base
+from tiddlywebplugins.sqlalchemy3.metrics import (ROWS_STREAMED,
+        SEARCH_EXECUTE, REGISTRY)
+
+COUNT = 100000
+
+
+def per_op(func, count=COUNT):
+    start = time.time()
+    for _ in xrange(count):
+        func()
+    return (time.time() - start) / count
+
+
+def main():
+    store_config = {'db_config': 'sqlite:///bench.db'}
+    store = Store(config['server_store'][0], store_config,
+            {'tiddlyweb.config': config})
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    store.put(Bag(u'bench'))
+    tiddler = Tiddler(u'bench', u'bench')
+    tiddler.text = u'bench'
+    store.put(tiddler)
+
+    counter = ROWS_STREAMED.labels('bench')
+    results = [
+            ('counter inc', per_op(counter.inc)),
+            ('labels + counter inc',
+                per_op(lambda: ROWS_STREAMED.labels('bench').inc())),
+            ('histogram observe',
+                per_op(lambda: SEARCH_EXECUTE.observe(0.003))),
+            ('tiddler get',
+                per_op(lambda: store.get(Tiddler(u'bench', u'bench')), 1000)),
+            ('render registry', per_op(REGISTRY.render, 1000)),
+            ]
+    for name, seconds in results:
+        print '%-22s %10.2f us/op' % (name, seconds * 1000000)
+    os.unlink('bench.db')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Measure the parse throughput of the hand written search parser and
+of the pyparsing grammar it replaces, over a mix of queries, and the
+time to build the pyparsing grammar, which it no longer spends at
+import.
+
+Run from the top of the repository:
+
+    python bench/bench_parser.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+import mangler
+
+from tiddlywebplugins.sqlalchemy3.parser import (DEFAULT_PARSER,
+        _make_pyparsing_parser)
+
+COUNT = 2000
+
+QUERIES = [
+        u'foo',
+        u'tag:foo',
+        u'title:"a long phrase" bag:common',
+        u'tag:one AND tag:two AND tag:three',
+        u'(tag:a OR tag:b) AND NOT title:c* _limit:20',
+        u'modified:[20100101 TO 20120101] text:something^2',
+        ]
+
+
+def queries_per_second(parser, query):
+    for _ in xrange(50):
+        parser(query)
+    start = time.clock()
+    for _ in xrange(COUNT):
+        parser(query)
+    return COUNT / (time.clock() - start)
+
+
+def main():
+    start = time.clock()
+    reference = _make_pyparsing_parser()
+    print 'pyparsing grammar built in %.1f ms' % (
+            (time.clock() - start) * 1000)
+    print '%-48s %10s %10s' % ('query', 'pyparsing', 'hand')
+    for query in QUERIES:
+        print '%-48s %8.0f/s %8.0f/s' % (query,
+                queries_per_second(reference, query),
+                queries_per_second(DEFAULT_PARSER, query))
+
+
+if __name__ == '__main__':
+    main()
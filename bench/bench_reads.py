@@ -0,0 +1,142 @@
+"""
+Compare the ORM and Core read paths (``sqlalchemy3.core_reads``) of
+list_bags, list_recipes, list_users, list_bag_tiddlers and search:
+CPU time and peak memory growth per 10k rows read.
+
+Run from the top of the repository:
+
+    python bench/bench_reads.py [db_config]
+
+db_config defaults to a sqlite file. Each measurement runs in a
+forked process so that its peak memory is its own.
+"""
+
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+import mangler
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+from tiddlyweb.model.bag import Bag
+
+from tiddlywebplugins.sqlalchemy3 import (Base, Session, sBag, sRecipe, sUser,
+        sPolicy, sTiddler, sRevision, sTag, bag_policy_table,
+        recipe_policy_table, current_revision_table, first_revision_table)
+
+ROWS = 10000
+CHUNK = 1000
+
+
+def make_store(db_config, core):
+    return Store(config['server_store'][0], {'db_config': db_config},
+            {'tiddlyweb.config': dict(config,
+                **{'sqlalchemy3.core_reads': core})})
+
+
+def insert(store, table, rows):
+    for start in xrange(0, len(rows), CHUNK):
+        store.storage.session.execute(table.insert(),
+                rows[start:start + CHUNK])
+
+
+def populate(store):
+    """
+    Insert ROWS each of bags, recipes, users and tiddlers, directly
+    with Core since saving them one at a time is slow.
+    """
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    ids = range(1, ROWS + 1)
+    insert(store, sPolicy.__table__, [{'id': 1, 'constraint': 'read',
+        'principal_name': u'someone', 'principal_type': 'U'},
+        {'id': 2, 'constraint': 'owner', 'principal_name': u'someone',
+            'principal_type': 'U'}])
+    insert(store, sBag.__table__, [{'id': i, 'name': u'bag%s' % i,
+        'desc': u'a bag'} for i in ids])
+    insert(store, bag_policy_table, [{'bag_id': i, 'policy_id': policy}
+        for i in ids for policy in (1, 2)])
+    insert(store, sRecipe.__table__, [{'id': i, 'name': u'recipe%s' % i,
+        'desc': u'a recipe', 'recipe_string': u'bag%s?' % i} for i in ids])
+    insert(store, recipe_policy_table, [{'recipe_id': i, 'policy_id': policy}
+        for i in ids for policy in (1, 2)])
+    insert(store, sUser.__table__, [{'usersign': u'user%s' % i}
+        for i in ids])
+    insert(store, sTiddler.__table__, [{'id': i, 'bag': u'bag1',
+        'title': u'tiddler%s' % i} for i in ids])
+    insert(store, sRevision.__table__, [{'number': i, 'tiddler_id': i,
+        'modifier': u'someone', 'modified': u'20120101000000',
+        'type': None} for i in ids])
+    insert(store, sTag.__table__, [{'revision_number': i, 'tag': u'bench'}
+        for i in ids])
+    insert(store, current_revision_table, [{'tiddler_id': i, 'current_id': i}
+        for i in ids])
+    insert(store, first_revision_table, [{'tiddler_id': i, 'first_id': i}
+        for i in ids])
+    store.storage.session.commit()
+    # each child makes its own session
+    Session.remove()
+
+
+def resident_kb():
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+
+def measure(db_config, core, operation):
+    """
+    Run operation in a child process, returning its CPU seconds and
+    peak memory growth in kilobytes.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        store = make_store(db_config, core)
+        operation(store)  # warm up
+        before = resident_kb()
+        start = time.clock()
+        results = operation(store)
+        seconds = time.clock() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        assert len(results) == ROWS, len(results)
+        os.write(write, '%s %s' % (seconds, max(peak - before, 0)))
+        os._exit(0)
+    os.close(write)
+    output = os.read(read, 1024)
+    os.waitpid(pid, 0)
+    seconds, kilobytes = output.split()
+    return float(seconds), int(kilobytes)
+
+
+OPERATIONS = [
+        ('list_bags', lambda store: list(store.list_bags())),
+        ('list_recipes', lambda store: list(store.list_recipes())),
+        ('list_users', lambda store: list(store.list_users())),
+        ('list_bag_tiddlers', lambda store: list(
+            store.list_bag_tiddlers(Bag(u'bag1')))),
+        ('search', lambda store: list(store.storage.search(
+            u'tag:bench _limit:%s' % ROWS))),
+        ('search metadata', lambda store: list(store.storage.search(
+            u'tag:bench _limit:%s' % ROWS, metadata=True, tags=True)))]
+
+
+def main():
+    db_config = len(sys.argv) > 1 and sys.argv[1] or 'sqlite:///bench.db'
+    populate(make_store(db_config, False))
+    print '%-18s %22s %22s' % ('per %s rows' % ROWS, 'ORM', 'Core')
+    for name, operation in OPERATIONS:
+        orm_seconds, orm_kb = measure(db_config, False, operation)
+        core_seconds, core_kb = measure(db_config, True, operation)
+        print '%-18s %8.0f ms %8d KB %8.0f ms %8d KB' % (name,
+                orm_seconds * 1000, orm_kb, core_seconds * 1000, core_kb)
+
+    if db_config == 'sqlite:///bench.db':
+        os.unlink('bench.db')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Measure tiddler_put: statements per save and saves per second, for
+a single writer and for several concurrent writer threads.
+
+Run from the top of the repository:
+
+    python bench/bench_tiddler_put.py [db_config]
+
+db_config defaults to a sqlite file.
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.getcwd())
+import mangler
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.sqlalchemy3 import Base
+
+from test import count_statements
+
+COUNT = 500
+THREADS = 4
+
+def make_store(db_config):
+    return Store(config['server_store'][0], {'db_config': db_config},
+            {'tiddlyweb.config': config})
+
+
+def put_many(db_config, prefix, count, updates=False):
+    # the session is scoped to the thread, so make the store here
+    store = make_store(db_config)
+    for i in xrange(count):
+        title = updates and u'%s' % prefix or u'%s%s' % (prefix, i)
+        tiddler = Tiddler(title, u'bench')
+        tiddler.text = u'some text %s' % i
+        tiddler.tags = [u'one', u'two', u'three']
+        tiddler.fields[u'alpha'] = u'%s' % i
+        tiddler.fields[u'beta'] = u'b'
+        store.put(tiddler)
+
+
+def single(db_config, updates):
+    start = time.time()
+    with count_statements() as statements:
+        put_many(db_config, updates and u'updated' or u'single', COUNT,
+                updates)
+    elapsed = time.time() - start
+    return COUNT / elapsed, len(statements) / float(COUNT)
+
+
+def concurrent(db_config):
+    threads = [threading.Thread(target=put_many,
+        args=(db_config, u'thread%s-' % i, COUNT // THREADS))
+        for i in range(THREADS)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (COUNT // THREADS * THREADS) / (time.time() - start)
+
+
+def main():
+    db_config = len(sys.argv) > 1 and sys.argv[1] or 'sqlite:///bench.db'
+    store = make_store(db_config)
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    store.put(Bag(u'bench'))
+
+    rate, statements = single(db_config, False)
+    print 'new tiddlers, one writer:     %7.1f puts/s %5.1f statements/put' % (
+            rate, statements)
+    rate, statements = single(db_config, True)
+    print 'revisions, one writer:        %7.1f puts/s %5.1f statements/put' % (
+            rate, statements)
+    print 'new tiddlers, %s writers:      %7.1f puts/s' % (THREADS,
+            concurrent(db_config))
+
+    if db_config == 'sqlite:///bench.db':
+        os.unlink('bench.db')
+
+
+if __name__ == '__main__':
+    main()
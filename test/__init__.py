@@ -1,3 +1,26 @@
 #import warnings
 #warnings.simplefilter('error')
 import mangler
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@contextmanager
+def count_statements():
+    """
+    Yield a list which collects the SQL of every statement run on any
+    engine until the block ends.
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
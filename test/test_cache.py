@@ -0,0 +1,214 @@
+"""
+Test the tiddler and search caches, alone and in the store.
+"""
+
+from tiddlyweb.config import config
+from tiddlyweb.store import NoTiddlerError
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.utils import get_store
+
+from tiddlywebplugins.sqlalchemy3 import Base
+from tiddlywebplugins.sqlalchemy3.cache import (TiddlerCache, SearchCache,
+        normalize_query, search_bags)
+from tiddlywebplugins.sqlalchemy3.parser import DEFAULT_PARSER
+
+from test import count_statements
+
+import py.test
+
+
+def setup_module(module):
+    module.store = get_store(config)
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    store.put(Bag(u'cachebag'))
+
+
+def teardown_module(module):
+    store.storage.tiddler_cache = None
+    store.storage.search_cache = None
+
+
+def loaded(title, revision, text=u'text'):
+    tiddler = Tiddler(title, u'cachebag')
+    tiddler.revision = revision
+    tiddler.text = text
+    tiddler.tags = [u'one', u'two']
+    tiddler.fields[u'field'] = u'value'
+    return tiddler
+
+
+def test_cache_lru():
+    probe = TiddlerCache(100000)
+    probe.put(loaded(u'a', 1))
+    size = probe.stats()['bytes']
+    cache = TiddlerCache(size * 2)
+    cache.put(loaded(u'a', 1))
+    cache.put(loaded(u'b', 2))
+    assert cache.get(Tiddler(u'a', u'cachebag'), 1)
+    cache.put(loaded(u'c', 3))
+    # b was least recently used
+    assert not cache.get(Tiddler(u'b', u'cachebag'), 2)
+
+    tiddler = Tiddler(u'a', u'cachebag')
+    assert cache.get(tiddler, 1)
+    assert tiddler.text == u'text'
+    assert tiddler.tags == [u'one', u'two']
+    assert tiddler.fields == {u'field': u'value'}
+    tiddler.tags.append(u'three')
+    assert Tiddler(u'a', u'cachebag').tags == []
+    assert cache.get(Tiddler(u'a', u'cachebag'), 1)
+
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['bytes'] == size * 2
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
+    assert stats['hit_ratio'] == 0.75
+
+    # too large to cache at all
+    cache.put(loaded(u'd', 4, text=u'x' * size))
+    assert cache.stats()['entries'] == 2
+
+    cache.delete(u'cachebag', u'a')
+    assert not cache.get(Tiddler(u'a', u'cachebag'), 1)
+    cache.delete_bag(u'cachebag')
+    assert cache.stats()['bytes'] == 0
+
+
+def test_cache_pointers():
+    cache = TiddlerCache(10000, max_pointers=2)
+    cache.set_pointer(u'bag', u'a', 2)
+    cache.set_pointer(u'bag', u'a', 1)
+    assert cache.pointer(u'bag', u'a') == 2
+    cache.set_pointer(u'bag', u'b', 1)
+    cache.set_pointer(u'bag', u'c', 1)
+    assert cache.pointer(u'bag', u'b') == 1
+    assert cache.pointer(u'bag', u'a') is None
+
+
+def test_store_cache():
+    store.storage.tiddler_cache = TiddlerCache(100000)
+    tiddler = Tiddler(u'cached', u'cachebag')
+    tiddler.text = u'first'
+    store.put(tiddler)
+    first = tiddler.revision
+
+    with count_statements() as statements:
+        loaded = store.get(Tiddler(u'cached', u'cachebag'))
+    assert loaded.text == u'first'
+    assert len(statements) > 1
+    # the current revision costs one lookup, a given revision none
+    with count_statements() as statements:
+        loaded = store.get(Tiddler(u'cached', u'cachebag'))
+    assert len(statements) == 1
+    assert loaded.text == u'first'
+    assert loaded.revision == first
+    revision = Tiddler(u'cached', u'cachebag')
+    revision.revision = first
+    with count_statements() as statements:
+        loaded = store.get(revision)
+    assert len(statements) == 0
+    assert loaded.text == u'first'
+
+    tiddler = Tiddler(u'cached', u'cachebag')
+    tiddler.text = u'second'
+    store.put(tiddler)
+    loaded = store.get(Tiddler(u'cached', u'cachebag'))
+    assert loaded.text == u'second'
+    assert loaded.created == store.get(revision).created
+
+    store.delete(Tiddler(u'cached', u'cachebag'))
+    py.test.raises(NoTiddlerError, 'store.get(revision)')
+    py.test.raises(NoTiddlerError,
+            'store.get(Tiddler(u"cached", u"cachebag"))')
+
+
+def test_store_cache_trusted_pointers():
+    store.storage.tiddler_cache = TiddlerCache(100000, trust_pointers=True)
+    tiddler = Tiddler(u'trusted', u'cachebag')
+    tiddler.text = u'first'
+    store.put(tiddler)
+    store.get(Tiddler(u'trusted', u'cachebag'))
+    with count_statements() as statements:
+        loaded = store.get(Tiddler(u'trusted', u'cachebag'))
+    assert len(statements) == 0
+    assert loaded.text == u'first'
+    assert store.storage.tiddler_cache.stats()['pointer_hits'] == 2
+
+
+def test_normalize_query():
+    assert normalize_query(u'  tag:a   AND\tb ') == u'tag:a AND b'
+    assert normalize_query(u'title:"a  b"  c') == u'title:"a  b" c'
+    assert normalize_query(u'"a \\"  b"  c') == u'"a \\"  b" c'
+
+
+def test_search_bags():
+    def bags(query):
+        return search_bags(DEFAULT_PARSER(query)[0])
+    assert bags(u'bag:one') == set([u'one'])
+    assert bags(u'tag:x AND fbag:"two words"') == set([u'two words'])
+    assert bags(u'bag:one OR bag:two') is None
+    assert bags(u'bag:on*') is None
+    assert bags(u'NOT bag:one') is None
+    assert bags(u'text') is None
+
+
+def search_titles(query):
+    return sorted(tiddler.title for tiddler in store.search(query))
+
+
+def test_store_search_cache():
+    store.storage.search_cache = SearchCache(10)
+    store.put(Bag(u'otherbag'))
+    for title, bag in [(u'alpha', u'cachebag'), (u'beta', u'otherbag')]:
+        tiddler = Tiddler(title, bag)
+        tiddler.tags = [u'searched']
+        store.put(tiddler)
+
+    assert search_titles(u'tag:searched') == [u'alpha', u'beta']
+    with count_statements() as statements:
+        titles = search_titles(u'tag:searched  ')
+    assert len(statements) == 1
+    assert titles == [u'alpha', u'beta']
+    assert store.storage.search_cache.stats()['hits'] == 1
+
+    # projected and unprojected results are kept apart
+    tiddler = list(store.storage.search(u'tag:searched', metadata=True,
+        tags=True))[0]
+    assert tiddler.tags == [u'searched']
+    assert tiddler.revision
+    tiddler = list(store.storage.search(u'tag:searched', metadata=True,
+        tags=True))[0]
+    assert tiddler.tags == [u'searched']
+
+    tiddler = Tiddler(u'gamma', u'otherbag')
+    tiddler.tags = [u'searched']
+    store.put(tiddler)
+    assert search_titles(u'tag:searched') == [u'alpha', u'beta', u'gamma']
+    store.delete(tiddler)
+    assert search_titles(u'tag:searched') == [u'alpha', u'beta']
+
+
+def test_store_search_cache_per_bag():
+    store.storage.search_cache = SearchCache(10, per_bag=True)
+    query = u'tag:searched bag:cachebag'
+    assert search_titles(query) == [u'alpha']
+    search_titles(query)
+    assert store.storage.search_cache.stats()['hits'] == 1
+
+    tiddler = Tiddler(u'delta', u'otherbag')
+    tiddler.tags = [u'searched']
+    store.put(tiddler)
+    assert search_titles(query) == [u'alpha']
+    assert store.storage.search_cache.stats()['hits'] == 2
+    assert u'delta' in search_titles(u'tag:searched')
+
+    tiddler = Tiddler(u'delta', u'cachebag')
+    tiddler.tags = [u'searched']
+    store.put(tiddler)
+    assert search_titles(query) == [u'alpha', u'delta']
+    assert store.storage.search_cache.stats()['hits'] == 2
@@ -1,14 +1,19 @@
 
+import json
 import os
 
+from StringIO import StringIO
+
 import py.test
 
 from tiddlyweb.config import config
 from tiddlyweb.store import Store, NoBagError, NoUserError, NoRecipeError, NoTiddlerError
 
 from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
 from tiddlyweb.model.tiddler import Tiddler
 
+from tiddlywebplugins.sqlalchemy3.dump import dump_store
 from tiddlywebplugins.sqlalchemy3.model import (Base, sText, sTag, sTiddler,
         sRevision, sField)
 
@@ -51,3 +56,98 @@ def test_cascade():
     store.delete(tiddler)
 
     count_em(0, '0 rows for the tiddler everywhere')
+
+
+def test_chunked_bag_delete():
+    environ = store.storage.environ
+    store.storage.environ = {'tiddlyweb.config': dict(config,
+        **{'sqlalchemy3.chunked_bag_delete': 2})}
+    try:
+        store.put(Bag(u'chunked'))
+        for index in range(5):
+            tiddler = Tiddler(u'tiddler%s' % index, u'chunked')
+            tiddler.text = u'text'
+            tiddler.tags = [u'chunkedtag']
+            store.put(tiddler)
+        store.delete(Bag(u'chunked'))
+
+        # hidden at once, though its rows remain
+        py.test.raises(NoBagError, 'store.get(Bag(u"chunked"))')
+        py.test.raises(NoBagError, 'store.delete(Bag(u"chunked"))')
+        py.test.raises(NoBagError,
+                'list(store.list_bag_tiddlers(Bag(u"chunked")))')
+        py.test.raises(NoBagError,
+                'store.put(Tiddler(u"new", u"chunked"))')
+        assert u'chunked' not in [bag.name for bag in store.list_bags()]
+        assert list(store.search(u'tag:chunkedtag')) == []
+        # with no revisions, history or stats of its tiddlers left over
+        changes = [change for change in store.storage.changes_since()
+                if change[0] == u'chunked']
+        assert changes == [(u'chunked', None, changes[0][2], True)]
+        py.test.raises(NoTiddlerError, 'store.storage.list_tiddler_revisions('
+                'Tiddler(u"tiddler0", u"chunked"))')
+        py.test.raises(NoTiddlerError, 'store.storage.tiddler_history('
+                'Tiddler(u"tiddler0", u"chunked"))')
+        py.test.raises(NoBagError, 'store.storage.bag_stats(Bag(u"chunked"))')
+        recipe = Recipe(u'chunked')
+        recipe.set_recipe([(u'chunked', u'')])
+        store.put(recipe)
+        py.test.raises(NoBagError, 'store.storage.recipe_tiddlers(recipe)')
+        store.delete(recipe)
+        output = StringIO()
+        dump_store(store.storage, output)
+        # only the deletion is dumped
+        assert [json.loads(line)['type'] for line
+                in output.getvalue().splitlines()
+                if u'chunked' in line] == ['tombstone']
+        assert store.storage.session.query(sTiddler).filter(
+                sTiddler.bag == u'chunked').count() == 5
+        store.storage.session.commit()
+
+        reports = []
+
+        def progress(bag, removed, tiddlers, done):
+            reports.append((bag, removed, tiddlers, done))
+            if len(reports) == 1:
+                raise RuntimeError('interrupted')
+
+        py.test.raises(RuntimeError,
+                'store.storage.purge_deleted_bags(progress=progress)')
+        assert store.storage.purge_deleted_bags(progress=progress) == 1
+        assert reports == [(u'chunked', 2, 5, False),
+                (u'chunked', 4, 5, False), (u'chunked', 5, 5, False),
+                (u'chunked', 5, 5, True)]
+        assert store.storage.session.query(sRevision).count() == 0
+        store.storage.session.commit()
+
+        store.put(Bag(u'chunked'))
+        assert list(store.list_bag_tiddlers(Bag(u'chunked'))) == []
+    finally:
+        store.storage.environ = environ
+
+
+def test_background_bag_purge():
+    import time
+    from tiddlywebplugins.sqlalchemy3.model import sBag
+    environ = store.storage.environ
+    store.storage.environ = {'tiddlyweb.config': dict(config,
+        **{'sqlalchemy3.chunked_bag_delete': 2,
+            'sqlalchemy3.bag_purge_background': True})}
+    try:
+        store.put(Bag(u'background'))
+        for index in range(3):
+            store.put(Tiddler(u'tiddler%s' % index, u'background'))
+        store.delete(Bag(u'background'))
+        for _ in range(50):
+            remaining = store.storage.session.query(sBag).filter(
+                    sBag.name == u'background').count()
+            store.storage.session.commit()
+            if not remaining:
+                break
+            time.sleep(0.1)
+        assert remaining == 0
+        assert store.storage.session.query(sTiddler).filter(
+                sTiddler.bag == u'background').count() == 0
+        store.storage.session.commit()
+    finally:
+        store.storage.environ = environ
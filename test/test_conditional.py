@@ -0,0 +1,177 @@
+"""
+Test bag statistics, the bag counters and conditional listings.
+"""
+
+from tiddlyweb.config import config
+from tiddlyweb.store import NoBagError
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.utils import get_store
+
+from tiddlywebplugins.sqlalchemy3 import Base
+from tiddlywebplugins.sqlalchemy3.conditional import ConditionalListings
+
+from test import count_statements
+
+import py.test
+
+
+def setup_module(module):
+    module.store = get_store(config)
+    module.environ = {'tiddlyweb.config': config,
+            'tiddlyweb.store': module.store}
+    module.counting_environ = {'tiddlyweb.config': dict(config,
+        **{'sqlalchemy3.bag_counters': True})}
+    module.store.storage.environ = module.environ
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+
+
+def put_tiddler(title, bag, modified):
+    tiddler = Tiddler(title, bag)
+    tiddler.text = u'text of %s' % title
+    tiddler.modified = modified
+    store.put(tiddler)
+    return store.get(tiddler).revision
+
+
+def test_bag_stats():
+    store.put(Bag(u'statsbag'))
+    assert store.storage.bag_stats(Bag(u'statsbag')) == {
+            'tiddlers': 0, 'revision': 0, 'modified': None}
+
+    put_tiddler(u'one', u'statsbag', u'20120101000000')
+    revision = put_tiddler(u'two', u'statsbag', u'20110101000000')
+    assert store.storage.bag_stats(Bag(u'statsbag')) == {
+            'tiddlers': 2, 'revision': revision,
+            'modified': u'20120101000000'}
+
+    store.delete(Tiddler(u'one', u'statsbag'))
+    stats = store.storage.bag_stats(Bag(u'statsbag'))
+    assert stats == {'tiddlers': 1, 'revision': revision,
+            'modified': u'20110101000000'}
+
+    py.test.raises(NoBagError, 'store.storage.bag_stats(Bag(u"nobag"))')
+
+
+def test_revision_numbers_increase():
+    store.put(Bag(u'deletebag'))
+    revision = put_tiddler(u'last', u'deletebag', u'20120101000000')
+    store.delete(Tiddler(u'last', u'deletebag'))
+    assert put_tiddler(u'next', u'deletebag', u'20120101000000') > revision
+
+
+def test_bag_counters():
+    store.storage.environ = counting_environ
+    try:
+        store.put(Bag(u'countedbag'))
+        put_tiddler(u'one', u'countedbag', u'20120101000000')
+        put_tiddler(u'one', u'countedbag', u'20110101000000')
+        revision = put_tiddler(u'two', u'countedbag', u'20100101000000')
+        store.delete(Tiddler(u'two', u'countedbag'))
+        # the counter keeps the highest revision and latest modified
+        assert store.storage.bag_stats(Bag(u'countedbag')) == {
+                'tiddlers': 1, 'revision': revision,
+                'modified': u'20120101000000'}
+
+        # a bag put before counting is aggregated until rebuilt
+        put_tiddler(u'three', u'statsbag', u'20130101000000')
+        aggregated = store.storage.bag_stats(Bag(u'statsbag'))
+        assert aggregated['tiddlers'] == 2
+        assert store.storage.rebuild_bag_counters() == 3
+        assert store.storage.bag_stats(Bag(u'statsbag')) == aggregated
+
+        with count_statements() as statements:
+            store.storage.bag_stats(Bag(u'statsbag'))
+        assert len(statements) == 1
+        assert 'bag_counter' in statements[0]
+    finally:
+        store.storage.environ = environ
+
+
+def test_recipe_stats():
+    recipe = Recipe(u'statsrecipe')
+    recipe.set_recipe([(u'statsbag', u''), (u'deletebag', u'select=tag:x')])
+    store.put(recipe)
+    statsbag = store.storage.bag_stats(Bag(u'statsbag'))
+    deletebag = store.storage.bag_stats(Bag(u'deletebag'))
+    assert store.storage.recipe_stats(Recipe(u'statsrecipe')) == {
+            'tiddlers': statsbag['tiddlers'] + deletebag['tiddlers'],
+            'revision': max(statsbag['revision'], deletebag['revision']),
+            'modified': max(statsbag['modified'], deletebag['modified'])}
+
+
+def listing_app(environ, start_response):
+    listing_app.calls += 1
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+        ('ETag', '"from-tiddlers"')])
+    return ['listing']
+
+
+def request(path, etag=None, user=u'GUEST'):
+    request_environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+            'QUERY_STRING': '', 'tiddlyweb.config': config,
+            'tiddlyweb.store': store, 'tiddlyweb.usersign': {'name': user,
+                'roles': []}}
+    if etag:
+        request_environ['HTTP_IF_NONE_MATCH'] = etag
+    responses = []
+
+    def start_response(status, headers, exc_info=None):
+        responses.append((status, dict(headers)))
+
+    output = ConditionalListings(listing_app)(request_environ,
+            start_response)
+    status, headers = responses[0]
+    return status, headers, ''.join(output)
+
+
+def test_conditional_listings():
+    listing_app.calls = 0
+    status, headers, output = request('/bags/statsbag/tiddlers')
+    assert status == '200 OK'
+    assert output == 'listing'
+    etag = headers['Etag']
+    assert etag.startswith('"sqlalchemy3:')
+
+    status, headers, output = request('/bags/statsbag/tiddlers', etag)
+    assert status == '304 Not Modified'
+    assert headers['Etag'] == etag
+    assert output == ''
+    assert listing_app.calls == 1
+
+    # other representations and users have other etags
+    assert request('/bags/statsbag/tiddlers.json')[1]['Etag'] != etag
+    assert request('/bags/statsbag/tiddlers', etag,
+            user=u'someone')[0] == '200 OK'
+
+    put_tiddler(u'four', u'statsbag', u'20130101000000')
+    status, headers, output = request('/bags/statsbag/tiddlers', etag)
+    assert status == '200 OK'
+    assert headers['Etag'] != etag
+
+    status, headers, output = request('/recipes/statsrecipe/tiddlers')
+    recipe_etag = headers['Etag']
+    assert request('/recipes/statsrecipe/tiddlers',
+            recipe_etag)[0] == '304 Not Modified'
+
+
+def test_conditional_listings_unreadable():
+    bag = Bag(u'privatebag')
+    bag.policy.read = [u'owner']
+    store.put(bag)
+    status, headers, output = request('/bags/privatebag/tiddlers',
+            user=u'owner')
+    etag = headers['Etag']
+    assert request('/bags/privatebag/tiddlers', etag,
+            user=u'owner')[0] == '304 Not Modified'
+
+    # refused reads are left to the listing handler
+    status, headers, output = request('/bags/privatebag/tiddlers',
+            user=u'other')
+    assert headers['ETag'] == '"from-tiddlers"'
+    status, headers, output = request('/bags/nobag/tiddlers')
+    assert headers['ETag'] == '"from-tiddlers"'
@@ -0,0 +1,149 @@
+from StringIO import StringIO
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+
+from tiddlywebplugins.sqlalchemy3 import Base
+from tiddlywebplugins.sqlalchemy3.dump import (dump_store, load_store,
+        fill_field_types, _copy_value)
+
+
+def setup_module(module):
+    module.store = Store(
+            config['server_store'][0],
+            config['server_store'][1],
+            {'tiddlyweb.config': config}
+            )
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+
+
+def test_dump_and_load():
+    bag = Bag(u'dumped')
+    bag.desc = u'a bag to dump'
+    bag.policy.read = [u'cdent', u'R:readers']
+    bag.policy.owner = u'cdent'
+    store.put(bag)
+    recipe = Recipe(u'dumped')
+    recipe.set_recipe([(u'dumped', u''), (u'other', u'select=tag:x')])
+    store.put(recipe)
+    user = User(u'dumper')
+    user.set_password(u'secret')
+    user.add_role(u'ADMIN')
+    store.put(user)
+    for i in range(5):
+        tiddler = Tiddler(u'history', u'dumped')
+        tiddler.text = u'version %s \u2603\ttabbed' % i
+        tiddler.tags = [u'v%s' % i, u'history']
+        tiddler.fields[u'count'] = u'%s' % i
+        store.put(tiddler)
+    for i in range(12):
+        tiddler = Tiddler(u'many%s' % i, u'dumped')
+        tiddler.text = u'many'
+        store.put(tiddler)
+    binary = Tiddler(u'binary', u'dumped')
+    binary.type = 'application/octet-stream'
+    binary.text = '\x00\x01binary'
+    store.put(binary)
+    gone = Tiddler(u'gone', u'dumped')
+    store.put(gone)
+    store.delete(gone)
+    tombstone = list(store.storage.changes_since())[-1]
+    assert tombstone == (u'dumped', u'gone', tombstone[2], True)
+
+    revisions = store.list_tiddler_revisions(Tiddler(u'history', u'dumped'))
+
+    output = StringIO()
+    progress = []
+    count, seconds = dump_store(store.storage, output, chunk_size=4,
+            progress=lambda count, seconds: progress.append(count))
+    assert count == 3 + 14 + 18 + 1
+    assert progress
+
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    output.seek(0)
+    environ = store.storage.environ
+    store.storage.environ = {'tiddlyweb.config': dict(config,
+        **{'sqlalchemy3.bag_counters': True})}
+    try:
+        count, seconds = load_store(store.storage, output, chunk_size=7,
+                transaction_size=10)
+        # the counters are rebuilt after the tiddlers are loaded
+        stats = store.storage.bag_stats(Bag(u'dumped'))
+        assert stats['tiddlers'] == 14
+    finally:
+        store.storage.environ = environ
+    assert count == 3 + 14 + 18 + 1
+
+    bag = store.get(Bag(u'dumped'))
+    assert bag.desc == u'a bag to dump'
+    assert sorted(bag.policy.read) == [u'R:readers', u'cdent']
+    assert bag.policy.owner == u'cdent'
+    recipe = store.get(Recipe(u'dumped'))
+    assert [tuple(line) for line in recipe.get_recipe()] == [
+            (u'dumped', u''), (u'other', u'select=tag:x')]
+    user = store.get(User(u'dumper'))
+    assert user.check_password(u'secret')
+    assert u'ADMIN' in user.roles
+
+    assert store.list_tiddler_revisions(
+            Tiddler(u'history', u'dumped')) == revisions
+    tiddler = store.get(Tiddler(u'history', u'dumped'))
+    assert tiddler.text == u'version 4 \u2603\ttabbed'
+    assert sorted(tiddler.tags) == [u'history', u'v4']
+    assert tiddler.fields[u'count'] == u'4'
+    old = Tiddler(u'history', u'dumped')
+    old.revision = revisions[-1]
+    old = store.get(old)
+    assert old.text == u'version 0 \u2603\ttabbed'
+    assert old.fields[u'count'] == u'0'
+    assert len(list(store.list_bag_tiddlers(Bag(u'dumped')))) == 14
+    assert store.get(Tiddler(u'binary', u'dumped')).text == '\x00\x01binary'
+
+    assert list(store.storage.changes_since())[-1] == tombstone
+
+    # numbering continues after the loaded revisions and tombstones
+    tiddler = Tiddler(u'history', u'dumped')
+    store.put(tiddler)
+    assert tiddler.revision > tombstone[2] > revisions[0]
+
+
+def test_copy_value():
+    assert _copy_value(0.1 + 0.2) == '0.30000000000000004'
+    assert _copy_value(u'a\tb\u2603') == 'a\\tb\xe2\x98\x83'
+    assert _copy_value(None) == '\\N'
+
+
+def test_fill_field_types():
+    from tiddlywebplugins.sqlalchemy3 import sField
+    field = sField.__table__
+    store.put(Bag(u'typed'))
+    for i, value in enumerate([u'12.5', u'2024-02-03', u'plain']):
+        tiddler = Tiddler(u'typed%s' % i, u'typed')
+        tiddler.fields[u'value'] = value
+        store.put(tiddler)
+    session = store.storage.session
+    session.execute(field.update().values(value_number=None,
+        value_date=None))
+    session.execute('DROP INDEX ix_field_name_number')
+    session.commit()
+
+    count, seconds = fill_field_types(store.storage, chunk_size=2)
+    assert count >= 3
+
+    rows = dict((row.value, row) for row in session.execute(
+        field.select().where(field.c.name == u'value')))
+    assert rows[u'12.5'].value_number == 12.5
+    assert rows[u'12.5'].value_date is None
+    assert rows[u'2024-02-03'].value_date == '20240203000000'
+    assert rows[u'plain'].value_number is None
+    assert rows[u'plain'].value_date is None
+    session.close()
+    assert [tiddler.title for tiddler in store.search(u'value:[10 TO 20]')
+            ] == [u'typed0']
@@ -0,0 +1,47 @@
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.sqlalchemy3 import Base
+from tiddlywebplugins.sqlalchemy3.explain import format_explanation
+
+
+def setup_module(module):
+    module.store = Store(
+            config['server_store'][0],
+            config['server_store'][1],
+            {'tiddlyweb.config': config}
+            )
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    store.put(Bag(u'ebag'))
+    tiddler = Tiddler(u'explained', u'ebag')
+    tiddler.text = u'explain this'
+    tiddler.tags = [u'plan']
+    store.put(tiddler)
+
+
+def test_explain_search():
+    explanation = store.storage.explain_search(u'tag:plan _limit:5')
+
+    assert 'Field' in explanation['ast']
+    assert "'plan'" in explanation['ast']
+    assert 'tag.tag' in explanation['sql']
+    assert u'plan' in explanation['params'].values()
+    assert 5 in explanation['params'].values()
+    assert explanation['plan']
+
+
+def test_explain_warnings():
+    explanation = store.storage.explain_search(u'explain')
+
+    assert [warning for warning in explanation['warnings']
+            if warning.startswith('leading wildcard LIKE')]
+    assert [warning for warning in explanation['warnings']
+            if warning.startswith('full scan of')]
+
+    output = format_explanation(explanation)
+    assert 'Plan:' in output
+    assert 'Warnings:' in output
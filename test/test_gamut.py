@@ -16,6 +16,8 @@ from base64 import b64encode
 
 from tiddlywebplugins.sqlalchemy3 import Base
 
+from test import count_statements
+
 #RANGE = 1000
 RANGE = 10
 
@@ -443,3 +445,220 @@ def test_emoji_title():
     assert tiddler2.fields[title] == tiddler.fields[title]
     assert tiddler2.fields[title] == title
             
+
+def test_large_policy_statements():
+    readers = [u'reader%s' % i for i in range(40)]
+    bag = Bag('bigpolicy')
+    bag.policy.read = readers
+    bag.policy.write = readers[:20] + [u'R:writers']
+    bag.policy.owner = u'reader1'
+
+    with count_statements() as statements:
+        store.put(bag)
+        first_put = len(statements)
+        del statements[:]
+        store.put(store.get(Bag('bigpolicy')))
+        get_and_unchanged_put = len(statements)
+
+    assert first_put < 10, first_put
+    assert get_and_unchanged_put < 6, get_and_unchanged_put
+
+    bag = store.get(Bag('bigpolicy'))
+    assert sorted(bag.policy.read) == sorted(readers)
+    assert sorted(bag.policy.write) == sorted(readers[:20] + [u'R:writers'])
+    assert bag.policy.owner == u'reader1'
+
+    bag.policy.read = readers[5:] + [u'newreader']
+    store.put(bag)
+    bag = store.get(Bag('bigpolicy'))
+    assert sorted(bag.policy.read) == sorted(readers[5:] + [u'newreader'])
+
+
+def test_tiddler_put_statements():
+    store.put(Bag('putbag'))
+    tiddler = Tiddler(u'counted', u'putbag')
+    tiddler.text = u'one'
+    tiddler.tags = [u'a', u'b', u'c']
+    tiddler.fields[u'x'] = u'1'
+    tiddler.fields[u'y'] = u'2'
+
+    with count_statements() as statements:
+        store.put(tiddler)
+        new_put = len(statements)
+        del statements[:]
+        tiddler.text = u'two'
+        store.put(tiddler)
+        revision_put = len(statements)
+
+    assert new_put <= 8, new_put
+    assert revision_put <= 6, revision_put
+
+    stored = store.get(Tiddler(u'counted', u'putbag'))
+    assert stored.text == u'two'
+    assert sorted(stored.tags) == [u'a', u'b', u'c']
+    assert stored.fields[u'y'] == u'2'
+    assert stored.revision == tiddler.revision
+    revisions = store.list_tiddler_revisions(stored)
+    assert len(revisions) == 2
+    assert stored.created != u''
+
+
+def test_tiddler_put_existing_row():
+    """
+    A tiddler row created by another writer between the lookup and
+    the insert is reused.
+    """
+    from tiddlywebplugins.sqlalchemy3 import sTiddler
+    store.storage.session.execute(sTiddler.__table__.insert(),
+            {'bag': u'putbag', 'title': u'raced'})
+    tiddler = Tiddler(u'raced', u'putbag')
+    tiddler.text = u'won anyway'
+    tiddler_id, created = store.storage._insert_tiddler(tiddler)
+    assert not created
+    assert tiddler_id is not None
+    store.storage.session.rollback()
+
+
+def test_tiddler_history():
+    store.put(Bag('historybag'))
+    for i in range(10):
+        tiddler = Tiddler(u'history', u'historybag')
+        tiddler.text = u'revision %s' % i
+        tiddler.modifier = u'writer%s' % i
+        tiddler.tags = [u'tag%s' % i]
+        tiddler.fields[u'count'] = u'%s' % i
+        store.put(tiddler)
+
+    numbers = store.list_tiddler_revisions(Tiddler(u'history', u'historybag'))
+    history = store.storage.tiddler_history(
+            Tiddler(u'history', u'historybag'))
+    assert [revision.revision for revision in history] == numbers
+    assert history[0].modifier == u'writer9'
+    assert history[0].text == u''
+
+    page = store.storage.tiddler_history(
+            Tiddler(u'history', u'historybag'), limit=4)
+    assert [revision.revision for revision in page] == numbers[:4]
+    page = store.storage.tiddler_history(
+            Tiddler(u'history', u'historybag'), limit=4,
+            before=page[-1].revision)
+    assert [revision.revision for revision in page] == numbers[4:8]
+    assert store.storage.tiddler_history(Tiddler(u'history', u'historybag'),
+            before=numbers[-1]) == []
+
+    py.test.raises(NoTiddlerError, 'store.storage.tiddler_history('
+            'Tiddler(u"nohistory", u"historybag"))')
+
+    wanted = [numbers[0], numbers[-1], numbers[5]]
+    revisions = store.storage.tiddler_get_revisions(
+            Tiddler(u'history', u'historybag'), wanted)
+    assert [revision.revision for revision in revisions] == wanted
+    for revision in revisions:
+        single = Tiddler(u'history', u'historybag')
+        single.revision = revision.revision
+        single = store.get(single)
+        assert revision.text == single.text
+        assert revision.tags == single.tags
+        assert revision.fields == single.fields
+        assert revision.modifier == single.modifier
+        assert revision.creator == u'writer0'
+
+    py.test.raises(NoTiddlerError, 'store.storage.tiddler_get_revisions('
+            'Tiddler(u"history", u"historybag"), [numbers[0], 999999])')
+
+
+def test_changes_since():
+    store.put(Bag(u'changebag'))
+    start = max([0] + [change[2] for change in store.storage.changes_since()])
+
+    for title in [u'one', u'two', u'one']:
+        tiddler = Tiddler(title, u'changebag')
+        tiddler.text = u'changed'
+        store.put(tiddler)
+    store.delete(Tiddler(u'two', u'changebag'))
+
+    changes = list(store.storage.changes_since(start))
+    assert [(bag, title, deleted) for bag, title, _, deleted
+            in changes] == [(u'changebag', u'one', False),
+                    (u'changebag', u'one', False),
+                    (u'changebag', u'two', True)]
+    numbers = [change[2] for change in changes]
+    assert numbers == sorted(numbers)
+    assert numbers[:2] == store.list_tiddler_revisions(
+            Tiddler(u'one', u'changebag'))[::-1]
+
+    assert list(store.storage.changes_since(start, 1)) == changes[:1]
+    assert list(store.storage.changes_since(numbers[0], 1)) == changes[1:2]
+    assert list(store.storage.changes_since(numbers[-1])) == []
+
+    store.delete(Bag(u'changebag'))
+    changes = list(store.storage.changes_since(numbers[-1]))
+    assert [(bag, title, deleted) for bag, title, _, deleted
+            in changes] == [(u'changebag', None, True)]
+    assert changes[0][2] > numbers[-1]
+
+
+def test_precompiled_statements():
+    from tiddlywebplugins.sqlalchemy3.statements import COMPILED_STATEMENTS
+
+    store.put(Bag(u'compiledbag'))
+    for i in range(3):
+        tiddler = Tiddler(u'compiled', u'compiledbag')
+        tiddler.text = u'text %s' % i
+        tiddler.tags = [u'a']
+        store.put(tiddler)
+        compiled = len(COMPILED_STATEMENTS)
+    assert compiled
+    # each put after the first reuses the same compiled statements
+    tiddler = Tiddler(u'compiled', u'compiledbag')
+    tiddler.tags = [u'b']
+    store.put(tiddler)
+    assert len(COMPILED_STATEMENTS) == compiled
+
+    # the baked lookups are distinct queries
+    assert store.get(Bag(u'compiledbag')).name == u'compiledbag'
+    assert store.get(Tiddler(u'compiled', u'compiledbag')).tags == [u'b']
+    py.test.raises(NoRecipeError, 'store.get(Recipe(u"compiledbag"))')
+    py.test.raises(NoUserError, 'store.get(User(u"compiledbag"))')
+
+
+def test_core_reads():
+    def listing():
+        bags = dict((bag.name, (bag.desc, bag.policy.read,
+            bag.policy.write, bag.policy.owner))
+            for bag in store.list_bags())
+        recipes = dict((recipe.name, (recipe.desc, recipe.get_recipe(),
+            recipe.policy.manage, recipe.policy.owner))
+            for recipe in store.list_recipes())
+        users = sorted(user.usersign for user in store.list_users())
+        titles = sorted(tiddler.title
+                for tiddler in store.list_bag_tiddlers(Bag(u'corebag')))
+        found = [(tiddler.title, tiddler.bag, tiddler.revision,
+            tiddler.modifier, tiddler.created, sorted(tiddler.tags),
+            sorted(tiddler.fields.items())) for tiddler
+            in store.storage.search(u'tag:coretag', metadata=True, tags=True,
+                fields=True)]
+        return bags, recipes, users, titles, found
+
+    bag = Bag(u'corebag')
+    bag.policy.read = [u'alice', u'R:friends']
+    bag.policy.owner = u'alice'
+    store.put(bag)
+    store.put(Bag(u'emptycorebag'))
+    for title in [u'one', u'two']:
+        tiddler = Tiddler(title, u'corebag')
+        tiddler.tags = [u'coretag', title]
+        tiddler.fields[u'core'] = title
+        store.put(tiddler)
+    orm = listing()
+    environ = store.storage.environ
+    store.storage.environ = {'tiddlyweb.config': dict(config,
+        **{'sqlalchemy3.core_reads': True})}
+    try:
+        assert listing() == orm
+        assert orm[0] and orm[1] and orm[2] and orm[3] and orm[4]
+        assert list(store.list_bag_tiddlers(Bag(u'emptycorebag'))) == []
+        py.test.raises(NoBagError,
+                'list(store.list_bag_tiddlers(Bag(u"nocorebag")))')
+    finally:
+        store.storage.environ = environ
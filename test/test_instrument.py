@@ -0,0 +1,89 @@
+import logging
+
+import py.test
+
+from sqlalchemy.exc import DatabaseError
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.sqlalchemy3 import Base
+from tiddlywebplugins.sqlalchemy3.instrument import INSTRUMENTATION
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def setup_module(module):
+    instrument_config = dict(config)
+    instrument_config['sqlalchemy3.instrument'] = True
+    instrument_config['sqlalchemy3.slow_query_threshold'] = 0
+    module.store = Store(
+            config['server_store'][0],
+            config['server_store'][1],
+            {'tiddlyweb.config': instrument_config}
+            )
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    INSTRUMENTATION.reset()
+
+
+def teardown_module(module):
+    INSTRUMENTATION.slow_threshold = 1.0
+
+
+def test_method_stats():
+    store.put(Bag(u'ibag'))
+    for title in [u'one', u'two', u'three']:
+        tiddler = Tiddler(title, u'ibag')
+        tiddler.text = u'instrumented text'
+        store.put(tiddler)
+    store.get(Tiddler(u'one', u'ibag'))
+    tiddlers = list(store.list_bag_tiddlers(Bag(u'ibag')))
+    assert len(tiddlers) == 3
+
+    stats = INSTRUMENTATION.snapshot()
+    assert stats['tiddler_put']['latency']['count'] == 3
+    assert stats['tiddler_put']['statements']['sum'] >= 3
+    assert stats['tiddler_get']['latency']['count'] == 1
+    assert stats['tiddler_get']['rows'] == 1
+    assert stats['list_bag_tiddlers']['rows'] == 3
+
+
+def test_search_rows_and_slow_log():
+    handler = ListHandler()
+    logger = logging.getLogger('tiddlywebplugins.sqlalchemy3.slowquery')
+    logger.addHandler(handler)
+    try:
+        tiddlers = list(store.search(u'instrumented'))
+    finally:
+        logger.removeHandler(handler)
+
+    assert len(tiddlers) == 3
+    stats = INSTRUMENTATION.snapshot()
+    assert stats['search']['rows'] == 3
+    assert stats['search']['statements']['sum'] >= 1
+    assert handler.messages
+    assert "u'instrumented" in handler.messages[0]
+
+
+def test_failed_and_unmatched_statements():
+    session = store.storage.session
+    py.test.raises(DatabaseError, 'session.execute("SELECT nothing FROM '
+            'nowhere")')
+    session.rollback()
+    # an after event with no start, as when listening begins mid
+    # statement, is counted but not timed
+    INSTRUMENTATION._after_cursor_execute(None, None, 'SELECT 1', (),
+            None, False)
+    assert list(store.list_bag_tiddlers(Bag(u'ibag')))
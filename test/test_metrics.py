@@ -0,0 +1,72 @@
+import os
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.sqlalchemy3 import Base
+from tiddlywebplugins.sqlalchemy3.metrics import (Registry, REGISTRY,
+        metrics_app, write_metrics)
+
+
+def setup_module(module):
+    module.store = Store(
+            config['server_store'][0],
+            config['server_store'][1],
+            {'tiddlyweb.config': config}
+            )
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+
+
+def test_render_format():
+    registry = Registry()
+    counter = registry.counter('things_total', 'Things.', ['kind'])
+    counter.labels('a"b').inc(2)
+    histogram = registry.histogram('waits_seconds', 'Waits.',
+            buckets=(0.1, 1.0))
+    histogram.observe(0.5)
+
+    output = registry.render()
+    assert '# TYPE things_total counter' in output
+    assert 'things_total{kind="a\\"b"} 2' in output
+    assert 'waits_seconds_bucket{le="0.1"} 0' in output
+    assert 'waits_seconds_bucket{le="1.0"} 1' in output
+    assert 'waits_seconds_bucket{le="+Inf"} 1' in output
+    assert 'waits_seconds_count 1' in output
+
+
+def test_search_metrics():
+    store.put(Bag(u'mbag'))
+    tiddler = Tiddler(u'measured', u'mbag')
+    tiddler.text = u'measure me'
+    store.put(tiddler)
+    assert len(list(store.search(u'measure'))) == 1
+
+    output = REGISTRY.render()
+    assert 'sqlalchemy3_search_seconds_count{phase="parse"}' in output
+    assert 'sqlalchemy3_search_seconds_count{phase="execute"}' in output
+    assert 'sqlalchemy3_rows_streamed_total{method="search"}' in output
+    assert 'sqlalchemy3_pool_checkouts_total' in output
+
+
+def test_metrics_app_and_file():
+    responses = []
+
+    def start_response(status, headers):
+        responses.append((status, dict(headers)))
+
+    output = ''.join(metrics_app({}, start_response))
+    assert responses[0][0] == '200 OK'
+    assert responses[0][1]['Content-Type'].startswith('text/plain')
+    assert '# TYPE sqlalchemy3_search_seconds histogram' in output
+
+    filename = 'test_metrics.prom'
+    write_metrics(filename)
+    try:
+        assert '# TYPE sqlalchemy3_search_seconds histogram' in open(
+                filename).read()
+    finally:
+        os.unlink(filename)
@@ -0,0 +1,123 @@
+"""
+Check that a SQLite revision table created without AUTOINCREMENT is
+refused, and that migrating it keeps its rows and numbers later
+revisions after every tombstone, and that columns and indexes missing
+from older tables are added.
+"""
+
+import os
+
+import py.test
+
+from tiddlyweb.store import StoreError
+
+from tiddlywebplugins.sqlalchemy3 import (Base, get_engine, sBag, sTiddler,
+        sRevision, sField, tombstone_table)
+from tiddlywebplugins.sqlalchemy3.migrate import (add_missing_columns,
+        create_missing_indexes, check_revision_sequence,
+        migrate_revision_sequence)
+
+DB_FILE = 'migrate.db'
+
+
+def setup_module(module):
+    if os.path.exists(DB_FILE):
+        os.unlink(DB_FILE)
+    module.engine = get_engine('sqlite:///%s' % DB_FILE)
+    Base.metadata.create_all(engine)
+    # remake the revision table as stores created before
+    # AUTOINCREMENT have it
+    sql = engine.execute("SELECT sql FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'revision'").scalar()
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=OFF')
+        cursor.execute('DROP TABLE revision')
+        cursor.execute(sql.replace('AUTOINCREMENT', ''))
+        cursor.execute('PRAGMA foreign_keys=ON')
+        raw.connection.commit()
+    finally:
+        raw.close()
+
+
+def teardown_module(module):
+    engine.dispose()
+    os.unlink(DB_FILE)
+
+
+def test_unmigrated_store():
+    from tiddlyweb.config import config
+    from tiddlyweb.model.bag import Bag
+    from tiddlyweb.model.tiddler import Tiddler
+    from tiddlyweb.store import Store
+    from tiddlywebplugins.sqlalchemy3 import Store as SQLStore
+    SQLStore.mapped = False
+    try:
+        store = Store(config['server_store'][0],
+                {'db_config': 'sqlite:///%s' % DB_FILE},
+                {'tiddlyweb.config': config})
+        # the store works, without recording deletions
+        assert not SQLStore.tombstones
+        store.put(Bag(u'unmigrated'))
+        store.put(Tiddler(u'one', u'unmigrated'))
+        store.delete(Tiddler(u'one', u'unmigrated'))
+        store.delete(Bag(u'unmigrated'))
+        assert engine.execute(tombstone_table.count()).scalar() == 0
+        py.test.raises(StoreError, 'list(store.storage.changes_since())')
+        store.storage.session.close()
+    finally:
+        SQLStore.mapped = True
+        SQLStore.tombstones = True
+
+
+def test_migrate_revision_sequence():
+    engine.execute(sBag.__table__.insert(), {'id': 1, 'name': u'bag',
+        'desc': u''})
+    engine.execute(sTiddler.__table__.insert(), {'id': 1, 'bag': u'bag',
+        'title': u'tiddler'})
+    revision = sRevision.__table__
+    for number in (1, 2, 3):
+        engine.execute(revision.insert(), {'number': number,
+            'tiddler_id': 1, 'modified': u'20120101000000'})
+    # as if a tiddler with revision 2 was deleted, tombstone 3 with it
+    engine.execute(revision.delete().where(revision.c.number > 1))
+    engine.execute(tombstone_table.insert(), {'number': 3, 'bag': u'bag',
+        'title': u'gone'})
+    py.test.raises(StoreError, check_revision_sequence, engine)
+
+    assert migrate_revision_sequence(engine)
+    check_revision_sequence(engine)
+    assert not migrate_revision_sequence(engine)
+    assert [row[0] for row in engine.execute(
+        'SELECT number FROM revision')] == [1]
+    indexes = [row[0] for row in engine.execute("SELECT name "
+        "FROM sqlite_master WHERE type = 'index' AND tbl_name = 'revision' "
+        "AND sql IS NOT NULL")]
+    assert 'ix_revision_history' in indexes
+
+    number = engine.execute(revision.insert(), {'tiddler_id': 1,
+        'modified': u'20120101000000'}).inserted_primary_key[0]
+    assert number == 4
+    engine.execute(revision.delete().where(revision.c.number == 4))
+    number = engine.execute(revision.insert(), {'tiddler_id': 1,
+        'modified': u'20120101000000'}).inserted_primary_key[0]
+    assert number == 5
+
+
+def test_missing_columns_and_indexes():
+    # as the field table was before its typed columns
+    for statement in ['DROP INDEX ix_field_name_number',
+            'DROP INDEX ix_field_name_date',
+            'ALTER TABLE field DROP COLUMN value_number',
+            'ALTER TABLE field DROP COLUMN value_date']:
+        engine.execute(statement)
+
+    assert add_missing_columns(engine) == ['field.value_number',
+            'field.value_date']
+    assert add_missing_columns(engine) == []
+    engine.execute(sField.__table__.insert(), {'revision_number': 1,
+        'name': u'price', 'value': u'12', 'value_number': 12.0})
+    assert sorted(create_missing_indexes(engine)) == [
+            'ix_field_name_date', 'ix_field_name_number']
+    assert create_missing_indexes(engine) == []
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Check the hand written parser against the pyparsing grammar it
+replaces: both must build the same AST, or both refuse, for every
+query in a corpus of edge cases and for random queries.
+"""
+
+import random
+
+import py.test
+
+from pyparsing import ParseException, ParseResults
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.sqlalchemy3.parser import (DEFAULT_PARSER,
+        pyparsing_parser)
+
+QUERIES = [u'', u' ', u'a', u'a b', u' a  b ', u'a AND b', u'a AND b AND c',
+        u'a OR b AND c', u'NOT a', u'a NOT b', u'NOT NOT a', u'title:foo',
+        u'title:"foo bar"', u'title:(a b)', u'(a b)', u'((a))', u'()',
+        u'[a TO b]', u'modified:[2010 TO 2012]', u'x:[ TO b]',
+        u'x:{a TO *}', u'x:[a TO ]', u'["a b" TO c]', u'a^2', u'"a b"^2',
+        u'tag:x^2.5', u'a ^ 2', u'a\\ b', u'a\\:b', u'a:b:c', u'a^b', u'a^',
+        u'^a', u'^2', u'ANDY', u'a AND', u'AND a', u'a\tb', u'a\nb',
+        u'"unterminated', u'a)', u'(a', u'x:', u':x', u'title :foo',
+        u'title:[a TO b]^2', u'a OR', u'a  AND  b', u'a AND NOT b',
+        u'x:NOT', u'caf\xe9', u'caf\xe9:x', u'a.b-c_d:e', u'(a OR b) AND c',
+        u'a AND (b OR c)', u'x:(a OR b)', u'"a\\"b"', u'[a TO b', u'[TO]',
+        u'[ TO ]', u'x:"a"^3', u'a b^2 c', u'a "b c" d', u'"a"NOT b',
+        u'_limit:20', u'a}b', u'NOT', u'OR', u'a OR OR b', u'\\\xe9',
+        u'tag:foo* AND title:"bar baz" OR NOT bag:(x y)^1.5']
+
+PIECES = [u'a', u'b', u'title', u'tag', u'x.y', u'AND', u'OR', u'NOT', u'TO',
+        u'ANDY', u' ', u'  ', u'\n', u'\t', u'\r', u'(', u')', u'[', u']',
+        u'{', u'}', u'"', u':', u'^', u'^2', u'2', u'.5', u'\\', u'\\ ',
+        u'\\:', u'*', u'\xe9', u'$', u'_', u'-', u'"a b"', u'[a TO b]',
+        u'{ TO x}']
+
+
+def setup_module(module):
+    module.reference = pyparsing_parser()
+
+
+def tree(node):
+    if isinstance(node, (list, ParseResults)):
+        return (node.getName(), [tree(child) for child in node])
+    return node
+
+
+def parsed(parser, query):
+    try:
+        result = parser(query)
+    except ParseException:
+        return 'refused'
+    assert len(result) == 1
+    return tree(result[0])
+
+
+def test_corpus():
+    for query in QUERIES:
+        assert parsed(DEFAULT_PARSER, query) == parsed(reference, query), \
+                query
+
+
+def test_random_queries():
+    generator = random.Random(48)
+    for _ in xrange(2000):
+        query = u''.join(generator.choice(PIECES)
+                for _ in xrange(generator.randint(1, 12)))
+        assert parsed(DEFAULT_PARSER, query) == parsed(reference, query), \
+                repr(query)
+
+
+def test_node_names():
+    ast = DEFAULT_PARSER(u'a AND b OR:"c" NOT (d [e TO f]^2)')[0]
+    assert ast.getName() == 'Toplevel'
+    assert [node.getName() for node in ast] == ['And', 'Field', 'Not']
+    assert ast[2][0].getName() == 'Group'
+    assert ast[2][0][1].getName() == 'Boost'
+    assert ast[2][0][1][0].getName() == 'Range'
+    assert ast[2][0][1][0][1].getName() is None
+
+
+def test_store_parsers():
+    store = Store(config['server_store'][0], config['server_store'][1],
+            {'tiddlyweb.config': config})
+    assert store.storage.parser is DEFAULT_PARSER
+    pyparsing_config = dict(config)
+    pyparsing_config['sqlalchemy3.search_parser'] = 'pyparsing'
+    store = Store(config['server_store'][0], config['server_store'][1],
+            {'tiddlyweb.config': pyparsing_config})
+    assert store.storage.parser is reference
+    py.test.raises(ParseException, DEFAULT_PARSER, u'a:b:c')
@@ -0,0 +1,93 @@
+"""
+Compare Store.recipe_tiddlers with TiddlyWeb's own recipe resolution.
+"""
+
+import py.test
+
+from tiddlyweb.config import config
+from tiddlyweb.control import get_tiddlers_from_recipe
+from tiddlyweb.store import NoBagError
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.utils import get_store
+
+from tiddlywebplugins.sqlalchemy3 import Base
+
+from test import count_statements
+
+
+def setup_module(module):
+    module.store = get_store(config)
+    module.environ = {'tiddlyweb.config': config,
+            'tiddlyweb.store': module.store}
+    module.store.storage.environ = module.environ
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+
+    for name in [u'system', u'common', u'private']:
+        store.put(Bag(name))
+    for i in range(10):
+        for name in [u'system', u'common', u'private']:
+            if i % 3 == 0 and name == u'private':
+                continue
+            tiddler = Tiddler(u'tiddler%s' % i, name)
+            tiddler.tags = [u'tag%s' % (i % 2), u'%s tag' % name]
+            tiddler.fields[u'kind'] = u'kind%s' % (i % 3)
+            tiddler.modifier = u'modifier%s' % (i % 4)
+            tiddler.text = u'text %s' % i
+            store.put(tiddler)
+
+
+def resolve(lines):
+    recipe = Recipe(u'testrecipe')
+    recipe.set_recipe(lines)
+    store.put(recipe)
+    recipe = store.get(recipe)
+    expected = sorted((tiddler.title, tiddler.bag) for tiddler
+            in get_tiddlers_from_recipe(recipe, environ))
+    resolved = sorted((tiddler.title, tiddler.bag) for tiddler
+            in store.storage.recipe_tiddlers(recipe))
+    assert resolved == expected
+    return resolved
+
+
+def test_plain_bags():
+    resolved = resolve([(u'system', u''), (u'common', u''),
+        (u'private', u'')])
+    assert len(resolved) == 10
+    assert (u'tiddler0', u'common') in resolved
+    assert (u'tiddler1', u'private') in resolved
+
+
+def test_select_filters_in_sql():
+    resolve([(u'system', u''), (u'common', u'select=tag:tag1'),
+        (u'private', u'select=kind:kind1;select=tag:private tag')])
+    resolve([(u'system', u'select=modifier:modifier2'),
+        (u'private', u'select=title:tiddler4')])
+    resolve([(u'common', u'select=bag:common&select=type:None')])
+
+
+def test_other_filters_in_python():
+    resolve([(u'system', u'select=tag:!tag1'),
+        (u'common', u'sort=-title;limit=2'),
+        (u'private', u'select=text:text 5')])
+    resolve([(u'system', u''), (u'private', u'select=kind:*')])
+
+
+def test_single_query():
+    recipe = Recipe(u'countrecipe')
+    recipe.set_recipe([(u'system', u''), (u'common', u'select=tag:tag0'),
+        (u'private', u'select=kind:kind2')])
+    with count_statements() as statements:
+        store.storage.recipe_tiddlers(recipe)
+    # the bag check and the resolution
+    assert len(statements) == 2
+
+
+def test_missing_bag():
+    recipe = Recipe(u'missing')
+    recipe.set_recipe([(u'system', u''), (u'nothere', u'')])
+    py.test.raises(NoBagError, 'store.storage.recipe_tiddlers(recipe)')
@@ -3,6 +3,8 @@ from tiddlyweb.config import config
 
 from tiddlyweb.model.tiddler import Tiddler
 from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.store import StoreError
 
 from tiddlywebplugins.utils import get_store
 
@@ -333,3 +335,280 @@ def test_tiddler_field_join():
     tiddlers = list(store.search(u'barney:evil AND soup:good'))
     assert len(tiddlers) == 1
     assert tiddlers[0].title == 'fieldtest'
+
+def test_keyset_pagination():
+    store.put(Bag('pages'))
+    for i in range(7):
+        tiddler = Tiddler('page%s' % i, 'pages')
+        tiddler.text = u'paginated'
+        # some modified times shared, to check the tiddler id tie-break
+        tiddler.modified = u'2013010100000%s' % (i // 2)
+        store.put(tiddler)
+
+    titles = []
+    query = u'bag:pages _limit:3'
+    while True:
+        tiddlers = list(store.search(query))
+        if not tiddlers:
+            break
+        assert len(tiddlers) <= 3
+        titles.extend(tiddler.title for tiddler in tiddlers)
+        query = u'bag:pages _limit:3 _after:%s' % (
+                tiddlers[-1].fields['server.cursor'])
+
+    assert titles == ['page%s' % i for i in reversed(range(7))]
+
+    py.test.raises(StoreError,
+            'list(store.search(u"bag:pages _after:notacursor"))')
+
+def test_count_and_facets():
+    store.put(Bag('facets'))
+    for i in range(5):
+        tiddler = Tiddler('facet%s' % i, 'facets')
+        tiddler.text = u'faceted'
+        tiddler.tags = [u'all', u'even' if i % 2 == 0 else u'odd']
+        tiddler.fields[u'colour'] = i < 3 and u'red' or u'blue'
+        store.put(tiddler)
+
+    assert store.storage.search_count(u'bag:facets') == 5
+    assert store.storage.search_count(u'bag:facets _limit:2') == 5
+    assert store.storage.search_count(u'bag:facets tag:even') == 3
+    assert store.storage.search_count(u'bag:facets tag:none') == 0
+
+    facets = store.storage.search_facets(u'bag:facets')
+    assert facets == [(u'all', 5), (u'even', 3), (u'odd', 2)]
+
+    facets = store.storage.search_facets(u'bag:facets', limit=1)
+    assert facets == [(u'all', 5)]
+
+    facets = store.storage.search_facets(u'bag:facets tag:odd',
+            facet='colour')
+    assert facets == [(u'blue', 1), (u'red', 1)]
+
+    facets = store.storage.search_facets(u'faceted', facet='bag')
+    assert facets == [(u'facets', 5)]
+
+def test_projected_search():
+    store.put(Bag('skinny'))
+    tiddler = Tiddler('thin', 'skinny')
+    tiddler.text = u'projected text'
+    tiddler.modifier = u'first'
+    tiddler.tags = [u'slim', u'lean']
+    tiddler.fields[u'width'] = u'narrow'
+    store.put(tiddler)
+    tiddler.modifier = u'second'
+    store.put(tiddler)
+
+    tiddlers = list(store.storage.search(u'bag:skinny'))
+    assert tiddlers[0].modifier is None
+    assert tiddlers[0].tags == []
+
+    tiddlers = list(store.storage.search(u'bag:skinny', metadata=True))
+    assert len(tiddlers) == 1
+    found = tiddlers[0]
+    assert found.revision == tiddler.revision
+    assert found.modifier == 'second'
+    assert found.creator == 'first'
+    assert found.modified == tiddler.modified
+    assert found.tags == []
+    assert found.text == ''
+
+    tiddlers = list(store.storage.search(u'bag:skinny', metadata=True,
+        tags=True, fields=True))
+    found = tiddlers[0]
+    assert sorted(found.tags) == ['lean', 'slim']
+    assert found.fields['width'] == 'narrow'
+    assert 'server.cursor' in found.fields
+
+
+def test_range_search():
+    store.put(Bag('rangebag'))
+    for i, (price, day) in enumerate([(u'5', u'2024-01-15'),
+            (u'10', u'20240201'), (u'12.5', u'20240201235900'),
+            (u'20', u'2024-03-01'), (u'100', u'not a date')]):
+        tiddler = Tiddler(u'range%s' % i, u'rangebag')
+        tiddler.fields[u'price'] = price
+        tiddler.fields[u'due'] = day
+        tiddler.modified = u'2023120%s000000' % (i + 1)
+        store.put(tiddler)
+
+    def titles(query):
+        return sorted(tiddler.title for tiddler in store.search(query))
+
+    # numbers compare as numbers, not strings
+    assert titles(u'price:[10 TO 20]') == [u'range1', u'range2', u'range3']
+    assert titles(u'price:{10 TO 20}') == [u'range2']
+    assert titles(u'price:[12 TO *]') == [u'range2', u'range3', u'range4']
+    assert titles(u'price:[TO 6]') == [u'range0']
+
+    # dates include the whole of an inclusive end day
+    assert titles(u'due:[20240101 TO 20240201]') == [u'range0', u'range1',
+            u'range2']
+    assert titles(u'due:{20240115 TO 2024-03-01}') == [u'range1',
+            u'range2']
+
+    assert titles(u'modified:[20231202 TO 20231204]') == [u'range1',
+            u'range2', u'range3']
+    assert titles(u'bag:rangebag AND title:[range1 TO range3]') == [
+            u'range1', u'range2', u'range3']
+    assert titles(u'price:[10 TO 20] AND due:[20240201 TO 20240301]') == [
+            u'range1', u'range2', u'range3']
+
+    py.test.raises(StoreError, 'list(store.search(u"[a TO b]"))')
+
+    plan = store.storage.explain_search(u'price:[10 TO 20]')
+    assert 'value_number BETWEEN' in plan['sql']
+    assert 'ix_field_name_number' in u' '.join(
+            unicode(row) for row in plan['plan'])
+
+
+def test_ranked_search():
+    store.put(Bag('rankbag'))
+    for title, text, tags in [
+            (u'zebra crossing', u'a zebra walks', []),
+            (u'stripes', u'zebra stripes', [u'zebra']),
+            (u'savanna', u'zebra herds', []),
+            (u'lion', u'no stripes here', [u'zebra'])]:
+        tiddler = Tiddler(title, u'rankbag')
+        tiddler.text = text
+        tiddler.tags = tags
+        store.put(tiddler)
+
+    def titles(query):
+        return [tiddler.title for tiddler in store.search(query)]
+
+    # unranked searches are newest first
+    assert titles(u'bag:rankbag AND zebra') == [u'savanna', u'stripes',
+            u'zebra crossing']
+    # a title match outranks a tag match outranks text alone
+    assert titles(u'bag:rankbag AND zebra _rank:1') == [u'zebra crossing',
+            u'stripes', u'savanna']
+    # the top results are chosen by rank before the limit
+    assert titles(u'bag:rankbag AND zebra _rank:1 _limit:1') == [
+            u'zebra crossing']
+
+    # equal scores are newest first
+    assert titles(u'bag:rankbag AND (text:stripes OR text:herds) _rank:1'
+            ) == [u'lion', u'savanna', u'stripes']
+    assert titles(u'bag:rankbag AND (text:stripes^3 OR text:herds) _rank:1'
+            ) == [u'lion', u'stripes', u'savanna']
+    assert titles(u'bag:rankbag AND (text:walks^0.5 OR text:zebra) '
+            '_rank:1') == [u'zebra crossing', u'savanna', u'stripes']
+
+    assert titles(u'bag:rankbag AND (title:"zebra crossing"^0.5 OR '
+            'text:stripes) _rank:1') == [u'lion', u'stripes',
+                    u'zebra crossing']
+
+    # scores are only built for ranked searches
+    store.storage._search_query(u'bag:rankbag AND zebra')
+    assert store.storage.producer.scores == []
+    store.storage._search_query(u'bag:rankbag AND zebra _rank:0')
+    assert store.storage.producer.scores == []
+    store.storage._search_query(u'bag:rankbag AND zebra _rank:1')
+    assert store.storage.producer.scores
+
+    # a caret not followed by a number is part of the word
+    assert titles(u'title:a^b') == []
+
+    py.test.raises(StoreError, 'list(store.search(u"zebra _rank:1 '
+            '_after:MjAyNDoxMjM="))')
+
+
+def test_search_guardrails():
+    from tiddlywebplugins.sqlalchemy3 import guard
+    steps = guard.SQLITE_PROGRESS_STEPS
+
+    def guarded(**settings):
+        store.storage.environ = {'tiddlyweb.config': dict(config,
+            **settings)}
+
+    try:
+        guarded(**{'sqlalchemy3.search_max_nodes': 4})
+        assert list(store.search(u'tag:apple'))
+        py.test.raises(StoreError,
+                'list(store.search(u"a OR b OR c OR d OR e"))')
+        # recipes resolved by search are not guarded
+        recipe = Recipe(u'guarded')
+        recipe.set_recipe([(u'bag1', u'select=tag:apple')])
+        store.put(recipe)
+        assert [tiddler.title for tiddler
+                in store.storage.recipe_tiddlers(recipe)] == ['tiddler1']
+
+        guarded(**{'sqlalchemy3.search_max_joins': 1})
+        assert list(store.search(u'tag:apple'))
+        py.test.raises(StoreError,
+                'list(store.search(u"tag:apple AND house:cottage"))')
+        py.test.raises(StoreError,
+                'store.storage.search_count(u"tag:apple AND text:pear")')
+
+        guarded(**{'sqlalchemy3.search_leading_wildcards': 'refuse'})
+        assert list(store.search(u'tag:app*'))
+        py.test.raises(StoreError, 'list(store.search(u"tag:*ppl*"))')
+        py.test.raises(StoreError,
+                'list(store.search(u"*a* OR *b* OR text:x"))')
+
+        guarded(**{'sqlalchemy3.search_leading_wildcards': 'rewrite'})
+        assert [tiddler.title for tiddler
+                in store.search(u'tag:*app*')] == ['tiddler1']
+        assert list(store.search(u'tag:*ppl*')) == []
+        py.test.raises(StoreError, 'list(store.search(u"tag:*"))')
+        # plain words match anywhere, without the wildcards
+        assert [tiddler.title for tiddler
+                in store.search(u'*chrisdent*')] == [tiddler.title
+                        for tiddler in store.search(u'chrisdent')]
+        assert list(store.search(u'*chrisdent*'))
+        py.test.raises(StoreError, 'list(store.search(u"**"))')
+
+        guarded(**{'sqlalchemy3.search_timeout': 10})
+        assert list(store.search(u'chrisdent'))
+        guarded(**{'sqlalchemy3.search_timeout': 0.000001})
+        # check the deadline at every step of this small search
+        guard.SQLITE_PROGRESS_STEPS = 1
+        py.test.raises(StoreError, 'list(store.search(u"chrisdent"))')
+        py.test.raises(StoreError,
+                'store.storage.search_facets(u"chrisdent")')
+    finally:
+        guard.SQLITE_PROGRESS_STEPS = steps
+        store.storage.environ = environ
+
+
+def test_grouped_conjunctions():
+    store.put(Bag(u'grouped'))
+    for title, tags, fields in [
+            (u'all', [u'a', u'b', u'c'], {u'x': u'1', u'y': u'2'}),
+            (u'some', [u'a', u'b'], {u'x': u'1', u'y': u'3'}),
+            (u'none', [u'c'], {u'x': u'2'})]:
+        tiddler = Tiddler(title, u'grouped')
+        tiddler.tags = tags
+        tiddler.fields.update(fields)
+        store.put(tiddler)
+
+    def titles(query):
+        return sorted(tiddler.title for tiddler
+                in store.search(u'bag:grouped %s' % query))
+
+    queries = [(u'tag:a AND tag:b', [u'all', u'some']),
+            (u'tag:a AND tag:b AND tag:c', [u'all']),
+            (u'tag:a AND tag:a AND tag:b', [u'all', u'some']),
+            (u'tag:a AND tag:d', []),
+            (u'x:1 AND y:3', [u'some']),
+            (u'x:1 AND x:2', []),
+            (u'tag:a AND tag:b AND x:1 AND y:2', [u'all']),
+            (u'tag:a AND tag:b* AND y:2', [u'all'])]
+    producer = store.storage.producer
+    for query, expected in queries:
+        assert titles(query) == expected, query
+    assert titles(u'tag:a AND tag:b AND x:1 AND y:2') == [u'all']
+    assert producer.joins == 4
+
+    store.storage.environ = {'tiddlyweb.config': dict(config,
+        **{'sqlalchemy3.search_group_terms': True})}
+    try:
+        for query, expected in queries:
+            assert titles(query) == expected, query
+        assert titles(u'tag:a AND tag:b AND x:1 AND y:2') == [u'all']
+        assert producer.joins == 0
+        # with a join per term, any other pair of tags would match
+        assert titles(u'NOT (tag:a AND tag:c)') == [u'none', u'some']
+    finally:
+        store.storage.environ = environ
@@ -0,0 +1,227 @@
+"""
+Stress the session lifecycle from many threads, abandoning
+generators part way, and check no connection is left checked out.
+"""
+
+import threading
+
+import py.test
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.sqlalchemy3 import (Base, Session, SessionRelease,
+        get_engine)
+from tiddlywebplugins.sqlalchemy3.batch import GroupCommit
+from tiddlywebplugins.sqlalchemy3.metrics import POOL_CHECKOUTS, POOL_CHECKINS
+
+THREADS = 20
+
+
+def make_store():
+    return Store(config['server_store'][0], config['server_store'][1],
+            {'tiddlyweb.config': config})
+
+
+def setup_module(module):
+    module.store = make_store()
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    for name in [u'one', u'two']:
+        store.put(Bag(name))
+        recipe = Recipe(name)
+        recipe.set_recipe([(name, u'')])
+        store.put(recipe)
+        for index in range(5):
+            tiddler = Tiddler(u'tiddler%s' % index, name)
+            tiddler.tags = [u'stress']
+            store.put(tiddler)
+    Session.remove()
+
+
+def checked_out():
+    return POOL_CHECKOUTS.labels().value - POOL_CHECKINS.labels().value
+
+
+def test_one_engine():
+    assert make_store().storage.session.get_bind() is get_engine(
+            config['server_store'][1]['db_config'])
+
+
+def test_abandoned_generators():
+    abandoned = []
+    errors = []
+    started = threading.Semaphore(0)
+    finish = threading.Event()
+
+    def work():
+        try:
+            store = make_store()
+            generators = [store.list_bags(), store.list_recipes(),
+                    store.search(u'tag:stress'),
+                    store.storage.changes_since(0),
+                    store.list_bag_tiddlers(Bag(u'one'))]
+            for generator in generators:
+                next(generator)
+            abandoned.append(generators)
+        except Exception, exc:
+            errors.append(exc)
+        finally:
+            started.release()
+        finish.wait()
+
+    before = checked_out()
+    threads = [threading.Thread(target=work) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for _ in threads:
+        started.acquire()
+    try:
+        assert errors == []
+        assert len(abandoned) == THREADS
+        # every thread is alive, holding its generators
+        assert checked_out() == before
+    finally:
+        finish.set()
+        for thread in threads:
+            thread.join()
+
+
+def test_session_release():
+    before = checked_out()
+
+    def application(environ, start_response):
+        store = make_store()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+
+        def output():
+            for bag in store.list_bags():
+                # leave a transaction, and its connection, open
+                store.storage.session.execute('SELECT 1')
+                yield bag.name.encode('utf-8')
+        return output()
+
+    def request():
+        output = SessionRelease(application)({},
+                lambda status, headers, exc_info=None: None)
+        next(iter(output))
+        output.close()
+
+    output = SessionRelease(application)({},
+            lambda status, headers, exc_info=None: None)
+    next(iter(output))
+    assert checked_out() == before + 1
+    output.close()
+    assert checked_out() == before
+
+    threads = [threading.Thread(target=request) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert checked_out() == before
+
+
+def test_group_commit():
+    group_config = dict(config)
+    group_config['sqlalchemy3.group_commit_window'] = 0.2
+    group_config['sqlalchemy3.group_commit_size'] = THREADS
+
+    def group_store():
+        return Store(config['server_store'][0], config['server_store'][1],
+                {'tiddlyweb.config': group_config})
+
+    committer = group_store().storage.group_commit
+    assert committer is not None
+    before = committer.batches
+    results = {}
+    start = threading.Event()
+
+    def work(index):
+        store = group_store()
+        bag = index == 0 and u'missing' or u'one'
+        tiddler = Tiddler(u'grouped%s' % index, bag)
+        tiddler.text = u'text %s' % index
+        start.wait()
+        try:
+            store.put(tiddler)
+            results[index] = tiddler.revision
+        except NoBagError, exc:
+            results[index] = exc
+        finally:
+            Session.remove()
+
+    threads = [threading.Thread(target=work, args=(index,))
+            for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert isinstance(results.pop(0), NoBagError)
+    assert len(set(results.values())) == THREADS - 1
+    # the failing put is retried alone, and the rest with it
+    assert committer.batches - before < THREADS - 1
+    store = make_store()
+    for index, revision in results.items():
+        tiddler = store.get(Tiddler(u'grouped%s' % index, u'one'))
+        assert tiddler.revision == revision
+        assert tiddler.text == u'text %s' % index
+
+
+def test_group_commit_restarts():
+    attempts = []
+
+    def store_factory():
+        attempts.append(True)
+        if len(attempts) == 1:
+            raise RuntimeError('no database')
+        return make_store().storage
+
+    committer = GroupCommit(store_factory, 0.01, THREADS)
+    tiddler = Tiddler(u'restarted', u'one')
+    py.test.raises(RuntimeError, 'committer.put(tiddler)')
+    assert committer.thread.is_alive()
+    assert committer.put(tiddler)
+    assert len(attempts) == 2
+
+
+def test_session_release_in_app():
+    from StringIO import StringIO
+    from tiddlyweb.web.serve import load_app
+    saved = dict((key, config.get(key)) for key in ['system_plugins',
+        'server_request_filters', 'server_response_filters', 'selector'])
+    config['system_plugins'] = ['tiddlywebplugins.sqlalchemy3']
+    config['server_request_filters'] = list(
+            config['server_request_filters'])
+    config['server_response_filters'] = list(
+            config['server_response_filters'])
+    try:
+        app = load_app()
+        assert isinstance(app, SessionRelease)
+        environ = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+                'PATH_INFO': '/bags/one/tiddlers', 'QUERY_STRING': '',
+                'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080',
+                'HTTP_HOST': 'localhost:8080', 'HTTP_ACCEPT': 'text/plain',
+                'wsgi.url_scheme': 'http', 'wsgi.input': StringIO(''),
+                'wsgi.errors': StringIO()}
+        status = []
+        output = app(environ, lambda line, headers, exc_info=None:
+                status.append(line))
+        body = ''.join(output)
+        assert status == ['200 OK']
+        assert 'tiddler0' in body
+        assert Session.registry.has()
+        output.close()
+        assert not Session.registry.has()
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
@@ -5,17 +5,25 @@ The base for using sqlalchemy as a store with TiddlyWeb.
 from __future__ import absolute_import
 
 import logging
+import re
+import threading
+import time
 
 from pyparsing import ParseException
 
 from base64 import b64encode, b64decode
+from functools import partial
 from sqlalchemy import event
-from sqlalchemy.engine import create_engine, Engine
+from sqlalchemy.engine import create_engine
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql.expression import and_
+from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import (and_, or_, case, distinct, literal,
+        null, select, union_all)
 
-from tiddlyweb.filters import FilterIndexRefused
+from tiddlyweb.control import filter_tiddlers, recipe_template
+from tiddlyweb.filters import FilterIndexRefused, parse_for_filters
+from tiddlyweb.filters.select import ATTRIBUTE_SELECTOR as SELECT_ATTRIBUTE
 from tiddlyweb.model.bag import Bag
 from tiddlyweb.model.policy import Policy
 from tiddlyweb.model.recipe import Recipe
@@ -23,16 +31,48 @@ from tiddlyweb.model.tiddler import Tiddler
 from tiddlyweb.model.user import User
 from tiddlyweb.store import (NoBagError, NoRecipeError, NoTiddlerError,
         NoUserError, StoreError)
+from tiddlyweb.specialbag import get_bag_retriever, SpecialBagError
 from tiddlyweb.stores import StorageInterface
 from tiddlyweb.util import binary_tiddler
 
 from .model import (Base, Session, sBag, sPolicy, sRecipe, sTiddler, sRevision,
-        sText, sTag, sField, sCurrentRevision, sFirstRevision, sUser, sRole)
-from .parser import DEFAULT_PARSER
-from .producer import Producer
+        sText, sTag, sField, sUser, sRole, bag_policy_table,
+        recipe_policy_table, current_revision_table, first_revision_table,
+        bag_counter_table, tombstone_table, generation_table,
+        bag_deletion_table, field_types)
+from .batch import get_group_commit
+from .cache import get_tiddler_cache, get_search_cache, normalize_query
+from .explain import explain_search
+from .guard import check_ast, check_joins, time_limit
+from .instrument import INSTRUMENTATION
+from .metrics import (ROWS_STREAMED, SEARCH_PARSE, SEARCH_COMPILE,
+        SEARCH_EXECUTE, MetricsWriter, metrics_app, track_engine)
+from .migrate import (add_missing_columns, check_revision_sequence,
+        raise_auto_increment)
+from .parser import DEFAULT_PARSER, pyparsing_parser
+from .producer import Producer, encode_cursor
+from . import statements
 
 __version__ = '3.1.1'
 
+# Select filter attributes which tiddlyweb and the search producer
+# both compare by equality (tag by membership).
+RECIPE_SELECT_ATTRIBUTES = ('title', 'bag', 'modifier', 'type', 'tag')
+# Search fields which do not name a tiddler field.
+SEARCH_ATTRIBUTES = ('id', 'near', 'text', 'ftitle', 'fbag')
+FIELD_NAME = re.compile(r'^[\w.-]+$')
+# Changes read per query by changes_since.
+CHANGES_PAGE = 1000
+
+# One engine, and so one connection pool, per db_config.
+STORE_ENGINES = {}
+ENGINE_LOCK = threading.Lock()
+
+# Held by the thread purging deleted bags in the background.
+PURGE_LOCK = threading.Lock()
+PURGE_LOGGER = logging.getLogger('tiddlywebplugins.sqlalchemy3.purge')
+LOGGER = logging.getLogger('tiddlywebplugins.sqlalchemy3')
+
 #logging.basicConfig()
 #logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 #logging.getLogger('sqlalchemy.pool').setLevel(logging.DEBUG)
@@ -44,67 +84,123 @@ class Store(StorageInterface):
     """
 
     mapped = False
+    # False if the revision table may reuse numbers, in which case no
+    # tombstones are written and the change feed is refused
+    tombstones = True
 
     def __init__(self, store_config=None, environ=None):
         super(Store, self).__init__(store_config, environ)
         self.store_type = self._db_config().split(':', 1)[0]
-        self.parser = DEFAULT_PARSER
+        if self.environ.get('tiddlyweb.config', {}).get(
+                'sqlalchemy3.search_parser') == 'pyparsing':
+            self.parser = pyparsing_parser()
+        else:
+            self.parser = DEFAULT_PARSER
         self.producer = Producer()
         self.has_geo = False
+        self.tiddler_cache = get_tiddler_cache(self.environ.get(
+            'tiddlyweb.config', {}))
+        self.search_cache = get_search_cache(self.environ.get(
+            'tiddlyweb.config', {}))
+        # the committer outlives this request, so its store is made
+        # from the config alone
+        config = self.environ.get('tiddlyweb.config', {})
+        self.group_commit = get_group_commit(config, self._db_config(),
+            partial(Store, self.store_config, {'tiddlyweb.config': config}))
         self._init_store()
+        if self._instrumented():
+            INSTRUMENTATION.instrument_store(self)
 
     def _init_store(self):
         """
         Establish the database engine and session,
         creating tables if needed.
         """
-        engine = create_engine(self._db_config())
+        engine = get_engine(self._db_config())
         Base.metadata.bind = engine
         Session.configure(bind=engine)
         self.session = Session()
 
-        # turn on foreign keys for sqlite (the default engine)
-        if 'sqlite' in self.store_type:
-            @event.listens_for(Engine, 'connect')
-            def set_sqlite_pragma(dbapi_connection, connection_record):
-                cursor = dbapi_connection.cursor()
-                cursor.execute('PRAGMA foreign_keys=ON')
-                cursor.close()
+        if self._instrumented():
+            config = self.environ.get('tiddlyweb.config', {})
+            INSTRUMENTATION.slow_threshold = float(config.get(
+                'sqlalchemy3.slow_query_threshold', 1.0))
+            INSTRUMENTATION.instrument_engines()
 
         if not Store.mapped:
             Base.metadata.create_all(engine)
+            for column in add_missing_columns(engine):
+                LOGGER.warning('added column %s, run twanager sqlmigrate '
+                        'and sqlfieldtypes to index and fill it', column)
+            try:
+                check_revision_sequence(engine)
+            except StoreError, exc:
+                LOGGER.warning('%s; until then, and a restart, deletions '
+                        'are not recorded and changes_since is refused', exc)
+                Store.tombstones = False
             Store.mapped = True
 
     def _db_config(self):
         return self.store_config['db_config']
 
+    def _counting(self):
+        config = self.environ.get('tiddlyweb.config', {})
+        return config.get('sqlalchemy3.bag_counters', False)
+
+    def _chunked_delete(self):
+        config = self.environ.get('tiddlyweb.config', {})
+        return int(config.get('sqlalchemy3.chunked_bag_delete', 0))
+
+    def _purge_in_background(self):
+        config = self.environ.get('tiddlyweb.config', {})
+        return config.get('sqlalchemy3.bag_purge_background', False)
+
+    def _core_reads(self):
+        config = self.environ.get('tiddlyweb.config', {})
+        return config.get('sqlalchemy3.core_reads', False)
+
+    def _instrumented(self):
+        config = self.environ.get('tiddlyweb.config', {})
+        return config.get('sqlalchemy3.instrument', False)
+
     def list_recipes(self):
         try:
-            recipes = self.session.query(sRecipe).all()
-            for srecipe in recipes:
-                recipe = Recipe(srecipe.name)
-                recipe = self._load_recipe(recipe, srecipe)
-                yield recipe
+            if self._core_reads():
+                recipes = self._core_recipes()
+            else:
+                recipes = [self._load_recipe(Recipe(srecipe.name), srecipe)
+                        for srecipe in self.session.query(sRecipe).all()]
+            ROWS_STREAMED.labels('list_recipes').inc(len(recipes))
             self.session.close()
         except:
             self.session.rollback()
             raise
+        for recipe in recipes:
+            yield recipe
 
     def list_bags(self):
         try:
-            bags = self.session.query(sBag).all()
-            for sbag in bags:
-                bag = Bag(sbag.name)
-                bag = self._load_bag(bag, sbag)
-                yield bag
+            if self._core_reads():
+                bags = self._core_bags()
+            else:
+                bags = [self._load_bag(Bag(sbag.name), sbag)
+                        for sbag in self.session.query(sBag).filter(
+                            ~statements.BAG_DELETING).all()]
+            ROWS_STREAMED.labels('list_bags').inc(len(bags))
             self.session.close()
         except:
             self.session.rollback()
             raise
+        for bag in bags:
+            yield bag
 
     def list_users(self):
         try:
-            users = self.session.query(sUser.usersign).all()
+            if self._core_reads():
+                users = self._execute(statements.USERSIGNS, {}).fetchall()
+            else:
+                users = self.session.query(sUser.usersign).all()
+            ROWS_STREAMED.labels('list_users').inc(len(users))
             self.session.close()
         except:
             self.session.rollback()
@@ -115,10 +211,22 @@ class Store(StorageInterface):
     def list_bag_tiddlers(self, bag):
         try:
             try:
-                self.session.query(sBag.id).filter(
-                    sBag.name == bag.name).one()
-                tiddlers = self.session.query(sTiddler).filter(
-                        sTiddler.bag == bag.name).all()
+                if self._core_reads():
+                    titles = [row[0] for row in self._execute(
+                        statements.TIDDLER_TITLES_IN_BAG,
+                        {'bag': bag.name}).fetchall()]
+                    if not titles:
+                        raise NoResultFound('no bag')
+                    if titles == [None]:
+                        titles = []
+                else:
+                    self.session.query(sBag.id).filter(and_(
+                        sBag.name == bag.name,
+                        ~statements.BAG_DELETING)).one()
+                    titles = [stiddler.title for stiddler in
+                            self.session.query(sTiddler).filter(
+                                sTiddler.bag == bag.name).all()]
+                ROWS_STREAMED.labels('list_bag_tiddlers').inc(len(titles))
             except NoResultFound, exc:
                 raise NoBagError('no results for bag %s, %s' % (bag.name, exc))
             self.session.close()
@@ -126,25 +234,163 @@ class Store(StorageInterface):
             self.session.rollback()
             raise
 
-        return (Tiddler(stiddler.title, bag.name) for stiddler in tiddlers)
+        return (Tiddler(title, bag.name) for title in titles)
 
     def list_tiddler_revisions(self, tiddler):
+        revision_table = sRevision.__table__
+        tiddler_table = sTiddler.__table__
         try:
-            try:
-                revisions = self.session.query(sTiddler).filter(and_(
-                        sTiddler.title == tiddler.title,
-                        sTiddler.bag == tiddler.bag)).one().revisions
-            except NoResultFound, exc:
-                raise NoTiddlerError('tiddler %s not found: %s' % (
-                    tiddler.title, exc))
+            revisions = [row[0] for row in self.session.execute(
+                select([revision_table.c.number])
+                .select_from(revision_table.join(tiddler_table))
+                .where(and_(tiddler_table.c.bag == tiddler.bag,
+                    tiddler_table.c.title == tiddler.title,
+                    ~statements.TIDDLER_BAG_DELETING))
+                .order_by(revision_table.c.number.desc()))]
+            if not revisions:
+                raise NoTiddlerError('tiddler %s not found' % tiddler.title)
+            return revisions
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
 
-            return [revision.number for revision in revisions]
+    def tiddler_history(self, tiddler, limit=None, before=None):
+        """
+        Return Tiddlers for the revisions of tiddler, newest first,
+        with revision, modified, modifier and type set (but not text,
+        tags or fields). At most limit are returned, and only those
+        with a revision number less than before, if given. One query
+        is made, which is answered from the revision history index.
+        """
+        revision_table = sRevision.__table__
+        tiddler_table = sTiddler.__table__
+        conditions = [revision_table.c.tiddler_id == tiddler_table.c.id]
+        if before is not None:
+            conditions.append(revision_table.c.number < int(before))
+        query = (select([revision_table.c.number, revision_table.c.modified,
+            revision_table.c.modifier, revision_table.c.type])
+            .select_from(tiddler_table.outerjoin(revision_table,
+                and_(*conditions)))
+            .where(and_(tiddler_table.c.bag == tiddler.bag,
+                tiddler_table.c.title == tiddler.title,
+                ~statements.TIDDLER_BAG_DELETING))
+            .order_by(revision_table.c.number.desc()))
+        if limit is not None:
+            query = query.limit(int(limit))
+        try:
+            rows = self.session.execute(query).fetchall()
         except:
             self.session.rollback()
             raise
         finally:
             self.session.close()
 
+        # The outer join yields one row of nulls for a tiddler
+        # with no revisions before before, and none for no tiddler.
+        if not rows:
+            raise NoTiddlerError('tiddler %s not found' % tiddler.title)
+        history = []
+        for row in rows:
+            if row.number is None:
+                break
+            revision = Tiddler(tiddler.title, tiddler.bag)
+            revision.revision = row.number
+            revision.modified = row.modified
+            revision.modifier = row.modifier
+            revision.type = row.type
+            history.append(revision)
+        ROWS_STREAMED.labels('tiddler_history').inc(len(history))
+        return history
+
+    def tiddler_get_revisions(self, tiddler, revisions):
+        """
+        Return full Tiddlers for each of the revision numbers in
+        revisions of tiddler, in the same order, with one query for
+        the revisions and their text and another for their tags and
+        fields. Raises NoTiddlerError if any revision is not found.
+        """
+        try:
+            numbers = [int(revision) for revision in revisions]
+        except ValueError, exc:
+            raise NoTiddlerError('invalid revision id: %s' % exc)
+        if not numbers:
+            return []
+
+        revision_table = sRevision.__table__
+        tiddler_table = sTiddler.__table__
+        text_table = sText.__table__
+        first = sRevision.__table__.alias('first')
+        try:
+            rows = self.session.execute(select([revision_table.c.number,
+                revision_table.c.modified, revision_table.c.modifier,
+                revision_table.c.type, text_table.c.text,
+                first.c.modified.label('created'),
+                first.c.modifier.label('creator')])
+                .select_from(revision_table.join(tiddler_table)
+                    .outerjoin(text_table)
+                    .join(first_revision_table, first_revision_table.c
+                        .tiddler_id == tiddler_table.c.id)
+                    .join(first, first.c.number
+                        == first_revision_table.c.first_id))
+                .where(and_(tiddler_table.c.bag == tiddler.bag,
+                    tiddler_table.c.title == tiddler.title,
+                    revision_table.c.number.in_(numbers),
+                    ~statements.TIDDLER_BAG_DELETING))).fetchall()
+            found = dict((row.number, row) for row in rows)
+            missing = [number for number in numbers if number not in found]
+            if missing:
+                raise NoTiddlerError('Tiddler %s:%s:%s not found' %
+                        (tiddler.bag, tiddler.title, missing[0]))
+
+            # Tags and fields come back together: a tag row has a
+            # null value, which a field's value can never be.
+            tag_table = sTag.__table__
+            field_table = sField.__table__
+            attributes = self.session.execute(union_all(
+                select([tag_table.c.revision_number,
+                    tag_table.c.tag.label('name'),
+                    null().label('value')])
+                .where(tag_table.c.revision_number.in_(numbers)),
+                select([field_table.c.revision_number, field_table.c.name,
+                    field_table.c.value])
+                .where(field_table.c.revision_number.in_(numbers))))
+            tags = {}
+            fields = {}
+            for number, name, value in attributes:
+                if value is None:
+                    tags.setdefault(number, []).append(name)
+                else:
+                    fields.setdefault(number, {})[name] = value
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
+
+        tiddlers = []
+        for number in numbers:
+            row = found[number]
+            revision = Tiddler(tiddler.title, tiddler.bag)
+            revision.revision = number
+            revision.modified = row.modified
+            revision.modifier = row.modifier
+            revision.type = row.type
+            revision.created = row.created
+            revision.creator = row.creator
+            revision.tags = tags.get(number, [])
+            revision.fields.update(fields.get(number, {}))
+            if row.text is None:
+                revision.text = ''
+            elif binary_tiddler(revision):
+                revision.text = b64decode(row.text.strip())
+            else:
+                revision.text = row.text
+            tiddlers.append(revision)
+        ROWS_STREAMED.labels('tiddler_get_revisions').inc(len(tiddlers))
+        return tiddlers
+
     def recipe_delete(self, recipe):
         try:
             try:
@@ -163,8 +409,8 @@ class Store(StorageInterface):
     def recipe_get(self, recipe):
         try:
             try:
-                srecipe = self.session.query(sRecipe).filter(sRecipe.name
-                        == recipe.name).one()
+                srecipe = statements.RECIPE_BY_NAME(self.session).params(
+                        name=recipe.name).one()
                 recipe = self._load_recipe(recipe, srecipe)
                 self.session.close()
                 return recipe
@@ -175,6 +421,218 @@ class Store(StorageInterface):
             self.session.rollback()
             raise
 
+    def changes_since(self, revision_number=0, limit=None):
+        """
+        Yield the changes to tiddlers after revision_number, in order,
+        as (bag, title, revision, deleted) tuples: one for each revision
+        of a tiddler which still exists, and one for each deletion, with
+        title None if a whole bag was deleted. Give the revision of the
+        last change to the next call to continue from it. At most limit
+        changes are yielded.
+
+        Revisions and tombstones share the revision number sequence, so
+        the changes are a merge of two primary key range scans. They
+        are read in pages, closing the session before each page is
+        yielded.
+        """
+        if not Store.tombstones:
+            raise StoreError('the change feed needs a revision table which '
+                    'cannot reuse revision numbers, run twanager sqlmigrate')
+        count = 0
+        while limit is None or count < limit:
+            page = CHANGES_PAGE
+            if limit is not None:
+                page = min(page, limit - count)
+            try:
+                rows = self.session.execute(self._changes_query(
+                    revision_number, page)).fetchall()
+                self.session.close()
+            except:
+                self.session.rollback()
+                raise
+            ROWS_STREAMED.labels('changes_since').inc(len(rows))
+            for number, bag, title, deleted in rows:
+                yield bag, title, number, bool(deleted)
+            count += len(rows)
+            if len(rows) < page:
+                break
+            revision_number = rows[-1][0]
+
+    def _changes_query(self, revision_number, limit):
+        """
+        Select the first limit changes after revision_number.
+        """
+        revision_table = sRevision.__table__
+        tiddler_table = sTiddler.__table__
+        revisions = (select([revision_table.c.number,
+            tiddler_table.c.bag, tiddler_table.c.title,
+            literal(False).label('deleted')])
+            .select_from(revision_table.join(tiddler_table))
+            .where(and_(revision_table.c.number > revision_number,
+                ~statements.TIDDLER_BAG_DELETING))
+            .order_by(revision_table.c.number).limit(limit))
+        tombstones = (select([tombstone_table.c.number,
+            tombstone_table.c.bag, tombstone_table.c.title,
+            literal(True).label('deleted')])
+            .where(tombstone_table.c.number > revision_number)
+            .order_by(tombstone_table.c.number).limit(limit))
+        changes = union_all(select([revisions.alias()]),
+                select([tombstones.alias()])).alias('changes')
+        return select([changes]).order_by(changes.c.number).limit(limit)
+
+    def recipe_tiddlers(self, recipe):
+        """
+        Return the tiddlers, with only title and bag set, that result
+        from recipe, later bags taking precedence over earlier ones
+        as in tiddlyweb.control.get_tiddlers_from_recipe.
+
+        Bags with no filter, or only select filters the search
+        producer can express, are resolved together in one query: a
+        UNION ALL of each bag's titles tagged with its position in the
+        recipe, grouped by title to keep the highest position. Other
+        bags, including special bags, are listed and filtered by
+        TiddlyWeb and merged by position.
+        """
+        if not recipe.get_recipe():
+            recipe = self.recipe_get(recipe)
+        lines = recipe.get_recipe(recipe_template(self.environ))
+        names = [unicode(bag) for bag, _ in lines]
+
+        tiddler_table = sTiddler.__table__
+        selects = []
+        resolved_bags = set()
+        unmapped = []
+        for position, (name, filter_string) in enumerate(lines):
+            name = names[position]
+            retriever = get_bag_retriever(self.environ, name)
+            if retriever:
+                unmapped.append((position, retriever[0], filter_string))
+                continue
+            terms = self._recipe_filter_terms(filter_string)
+            if terms is None or (terms and _unquotable(name)):
+                unmapped.append((position, self.list_bag_tiddlers,
+                    filter_string))
+            elif terms:
+                query = self._search_query(u' AND '.join(
+                    [u'bag:"%s"' % name] + terms), limited=False,
+                    guarded=False)[1]
+                selects.append(query.with_entities(sTiddler.title,
+                    literal(position).label('position')).statement)
+                resolved_bags.add(name)
+            else:
+                selects.append(select([tiddler_table.c.title,
+                    literal(position).label('position')])
+                    .where(and_(tiddler_table.c.bag == name,
+                        ~statements.TIDDLER_BAG_DELETING)))
+                resolved_bags.add(name)
+
+        winners = {}
+        try:
+            if selects:
+                found = set(row[0] for row in self.session.execute(
+                    select([sBag.name]).where(and_(
+                        sBag.name.in_(resolved_bags),
+                        ~statements.BAG_DELETING))))
+                for name in names:
+                    if name in resolved_bags and name not in found:
+                        raise NoBagError('no results for bag %s' % name)
+                if len(selects) == 1:
+                    resolved = selects[0].alias('resolved')
+                else:
+                    resolved = union_all(*selects).alias('resolved')
+                for title, position in self.session.execute(select([
+                    resolved.c.title, func.max(resolved.c.position)])
+                    .group_by(resolved.c.title)):
+                    winners[title] = (position, None)
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+
+        for position, retriever, filter_string in unmapped:
+            try:
+                tiddlers = filter_tiddlers(retriever(Bag(names[position])),
+                        filter_string, environ=self.environ)
+                for tiddler in tiddlers:
+                    if position > winners.get(tiddler.title, (-1,))[0]:
+                        winners[tiddler.title] = (position, tiddler)
+            except SpecialBagError, exc:
+                raise NoBagError('unable to retrieve from special bag: '
+                        '%s, %s' % (names[position], exc))
+
+        tiddlers = [tiddler or Tiddler(title, names[position])
+                for title, (position, tiddler) in winners.items()]
+        ROWS_STREAMED.labels('recipe_tiddlers').inc(len(tiddlers))
+        return tiddlers
+
+    def bag_stats(self, bag):
+        """
+        Return a dict of the number of tiddlers in bag, the highest
+        revision number among them and their latest modified time,
+        for building ETags and Last-Modified headers without listing
+        the tiddlers. Revision numbers only increase, so any change to
+        the bag changes either the count or the revision.
+
+        With ``sqlalchemy3.bag_counters`` set these come from the
+        bag_counter row maintained on write, in which case revision
+        and modified include deleted tiddlers. Otherwise, or if the
+        bag has no row, they are aggregated over the current revisions
+        using the tiddler bag and revision primary key indexes.
+        """
+        try:
+            stats = self._bag_stats([bag.name])[bag.name]
+            self.session.close()
+            return stats
+        except:
+            self.session.rollback()
+            raise
+
+    def recipe_stats(self, recipe):
+        """
+        Return the bag_stats of the bags in recipe combined: the
+        total number of tiddlers in them (before filtering and
+        overriding), the highest revision and the latest modified.
+        Raises StoreError if the recipe includes a special bag.
+        """
+        if not recipe.get_recipe():
+            recipe = self.recipe_get(recipe)
+        names = [unicode(bag) for bag, _ in
+                recipe.get_recipe(recipe_template(self.environ))]
+        for name in names:
+            if get_bag_retriever(self.environ, name):
+                raise StoreError('no stats for special bag %s' % name)
+        try:
+            stats = self._bag_stats(names)
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        modified = [stats[name]['modified'] for name in names
+                if stats[name]['modified']]
+        return {'tiddlers': sum(stats[name]['tiddlers'] for name in names),
+                'revision': max([0] + [stats[name]['revision']
+                    for name in names]),
+                'modified': modified and max(modified) or None}
+
+    def rebuild_bag_counters(self):
+        """
+        Replace the bag_counter rows with counts aggregated from the
+        tiddlers, for turning on ``sqlalchemy3.bag_counters`` with an
+        existing store. Returns the number of bags counted.
+        """
+        try:
+            self.session.execute(bag_counter_table.delete())
+            self.session.execute(bag_counter_table.insert().from_select(
+                ['bag', 'tiddlers', 'revision', 'modified'],
+                self._bag_aggregates()))
+            count = self.session.execute(select([func.count()])
+                    .select_from(bag_counter_table)).scalar()
+            self.session.commit()
+            return count
+        except:
+            self.session.rollback()
+            raise
+
     def recipe_put(self, recipe):
         try:
             self._store_recipe(recipe)
@@ -184,24 +642,104 @@ class Store(StorageInterface):
             raise
 
     def bag_delete(self, bag):
+        """
+        Delete bag and its tiddlers. With ``sqlalchemy3.chunked_bag_delete``
+        set, the bag is only marked as being deleted, which hides it and
+        its tiddlers, and its rows are removed later in chunks by
+        :py:meth:`purge_deleted_bags`.
+        """
+        chunked = self._chunked_delete()
         try:
             try:
-                rows = self.session.query(sBag).filter(sBag.name
-                        == bag.name).delete()
-                if rows == 0:
-                    raise NoResultFound
+                tiddler_table = sTiddler.__table__
+                tiddler_id, tiddlers = self.session.execute(
+                        select([func.min(tiddler_table.c.id),
+                            func.count(tiddler_table.c.id)])
+                        .where(tiddler_table.c.bag == bag.name)).fetchone()
+                if chunked:
+                    row = self._execute(statements.BAG_DELETION,
+                            {'bag': bag.name}).fetchone()
+                    if row is None or row[1] is not None:
+                        raise NoResultFound
+                if tiddler_id is not None:
+                    self._tombstone(tiddler_id, bag.name, None)
+                if self.search_cache:
+                    self._bump_generations(bag.name)
+                if chunked:
+                    self.session.execute(bag_deletion_table.insert(),
+                            {'bag': bag.name, 'tiddlers': tiddlers,
+                                'removed': 0})
+                else:
+                    rows = self.session.query(sBag).filter(sBag.name
+                            == bag.name).delete()
+                    if rows == 0:
+                        raise NoResultFound
                 self.session.commit()
             except NoResultFound, exc:
                 raise NoBagError('Bag %s not found: %s' % (bag.name, exc))
         except:
             self.session.rollback()
             raise
+        finally:
+            if self.tiddler_cache:
+                self.tiddler_cache.delete_bag(bag.name)
+        if chunked and self._purge_in_background():
+            thread = threading.Thread(target=_purge_deleted_bags,
+                    args=(self.store_config, self.environ))
+            thread.daemon = True
+            thread.start()
+
+    def purge_deleted_bags(self, chunk=None, progress=None):
+        """
+        Remove the tiddlers, with their revisions, of bags deleted with
+        ``sqlalchemy3.chunked_bag_delete``, chunk tiddlers at a time
+        (by default the configured chunk size) each in its own
+        transaction, then the bags themselves. Progress is kept in the
+        database, so an interrupted purge resumes where it stopped.
+        progress, if given, is called after each chunk with the bag
+        name, the tiddlers removed so far, the bag's total and whether
+        the bag is gone. Return the number of bags purged.
+        """
+        chunk = chunk or self._chunked_delete() or 1000
+        purged = 0
+        try:
+            while True:
+                row = self._execute(statements.NEXT_DELETION, {}).fetchone()
+                if row is None:
+                    break
+                name, tiddlers, removed = row
+                ids = [tiddler_id for tiddler_id, in self._execute(
+                    statements.TIDDLER_IDS_IN_BAG,
+                    {'bag': name, 'chunk': chunk}).fetchall()]
+                done = not ids
+                if ids:
+                    tiddler_table = sTiddler.__table__
+                    self.session.execute(tiddler_table.delete().where(
+                        tiddler_table.c.id.in_(ids)))
+                    removed += len(ids)
+                    self.session.execute(bag_deletion_table.update()
+                            .where(bag_deletion_table.c.bag == name)
+                            .values(removed=removed))
+                else:
+                    self.session.execute(bag_deletion_table.delete()
+                            .where(bag_deletion_table.c.bag == name))
+                    self.session.query(sBag).filter(
+                            sBag.name == name).delete()
+                    purged += 1
+                self.session.commit()
+                if progress:
+                    progress(name, removed, tiddlers, done)
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
+        return purged
 
     def bag_get(self, bag):
         try:
             try:
-                sbag = self.session.query(sBag).filter(sBag.name
-                        == bag.name).one()
+                sbag = statements.BAG_BY_NAME(self.session).params(
+                        name=bag.name).one()
                 bag = self._load_bag(bag, sbag)
                 self.session.close()
                 return bag
@@ -213,7 +751,15 @@ class Store(StorageInterface):
 
     def bag_put(self, bag):
         try:
-            self._store_bag(bag)
+            row = self._execute(statements.BAG_DELETION,
+                    {'bag': bag.name}).fetchone()
+            if row is not None and row[1] is not None:
+                raise StoreError('bag %s is being deleted' % bag.name)
+            sbag = self._store_bag(bag)
+            if sbag.id is None and self._counting():
+                self.session.flush()
+                self.session.execute(bag_counter_table.insert(),
+                        {'bag': bag.name, 'tiddlers': 0, 'revision': 0})
             self.session.commit()
         except:
             self.session.rollback()
@@ -222,11 +768,21 @@ class Store(StorageInterface):
     def tiddler_delete(self, tiddler):
         try:
             try:
-                rows = (self.session.query(sTiddler).
-                        filter(sTiddler.title == tiddler.title).
-                        filter(sTiddler.bag == tiddler.bag).delete())
-                if rows == 0:
+                tiddler_table = sTiddler.__table__
+                tiddler_id = self._execute(statements.TIDDLER_ID,
+                        {'bag': tiddler.bag, 'title': tiddler.title}).scalar()
+                if tiddler_id is None:
                     raise NoResultFound
+                self._tombstone(tiddler_id, tiddler.bag, tiddler.title)
+                self.session.execute(tiddler_table.delete()
+                        .where(tiddler_table.c.id == tiddler_id))
+                if self._counting():
+                    self.session.execute(bag_counter_table.update()
+                            .where(bag_counter_table.c.bag == tiddler.bag)
+                            .values(tiddlers=bag_counter_table.c.tiddlers
+                                - 1))
+                if self.search_cache:
+                    self._bump_generations(tiddler.bag)
                 self.session.commit()
             except NoResultFound, exc:
                 raise NoTiddlerError('no tiddler %s to delete, %s' %
@@ -234,32 +790,45 @@ class Store(StorageInterface):
         except:
             self.session.rollback()
             raise
+        finally:
+            if self.tiddler_cache:
+                self.tiddler_cache.delete(tiddler.bag, tiddler.title)
 
     def tiddler_get(self, tiddler):
+        cache = self.tiddler_cache
         try:
             try:
+                revision_value = None
                 if tiddler.revision:
                     try:
                         revision_value = int(tiddler.revision)
                     except ValueError, exc:
                         raise NoTiddlerError('%s is not a valid revision id'
                                 % tiddler.revision)
-                    revision = self.session.query(sRevision).filter(
-                            sRevision.number == revision_value).one()
-                    stiddler = self.session.query(sTiddler).filter(and_(
-                            sTiddler.id == revision.tiddler_id,
-                            sTiddler.title == tiddler.title,
-                            sTiddler.bag == tiddler.bag)).one()
+                elif cache:
+                    revision_value = self._current_revision(tiddler)
+                if cache and revision_value and cache.get(tiddler,
+                        revision_value):
+                    self.session.close()
+                    return tiddler
+                if revision_value:
+                    revision = statements.REVISION_BY_NUMBER(
+                            self.session).params(number=revision_value).one()
+                    stiddler = statements.TIDDLER_BY_ID_AND_NAME(
+                            self.session).params(id=revision.tiddler_id,
+                                title=tiddler.title, bag=tiddler.bag).one()
                     current_revision = revision
                 else:
-                    stiddler = self.session.query(sTiddler).filter(and_(
-                            sTiddler.title == tiddler.title,
-                            sTiddler.bag == tiddler.bag)).one()
+                    stiddler = statements.TIDDLER_BY_NAME(
+                            self.session).params(title=tiddler.title,
+                                bag=tiddler.bag).one()
                     current_revision = stiddler.current
                 base_revision = stiddler.first
                 tiddler = self._load_tiddler(tiddler, current_revision,
                     base_revision)
                 self.session.close()
+                if cache:
+                    cache.put(tiddler)
                 return tiddler
             except NoResultFound, exc:
                 raise NoTiddlerError('Tiddler %s:%s:%s not found: %s' %
@@ -270,21 +839,23 @@ class Store(StorageInterface):
 
     def tiddler_put(self, tiddler):
         tiddler.revision = None
-        try:
+        if self.group_commit:
             if not tiddler.bag:
                 raise NoBagError('bag required to save')
+            tiddler.revision = self.group_commit.put(tiddler)
+        else:
             try:
-                self.session.query(sBag.id).filter(sBag.name
-                        == tiddler.bag).one()
-            except NoResultFound, exc:
-                raise NoBagError('bag %s must exist for tiddler save: %s'
-                        % (tiddler.bag, exc))
-            current_revision_number = self._store_tiddler(tiddler)
-            tiddler.revision = current_revision_number
-            self.session.commit()
-        except:
-            self.session.rollback()
-            raise
+                if not tiddler.bag:
+                    raise NoBagError('bag required to save')
+                current_revision_number = self._store_tiddler(tiddler)
+                tiddler.revision = current_revision_number
+                self.session.commit()
+            except:
+                self.session.rollback()
+                raise
+        if self.tiddler_cache:
+            self.tiddler_cache.set_pointer(tiddler.bag, tiddler.title,
+                    tiddler.revision)
 
     def user_delete(self, user):
         try:
@@ -304,8 +875,8 @@ class Store(StorageInterface):
     def user_get(self, user):
         try:
             try:
-                suser = self.session.query(sUser).filter(sUser.usersign
-                        == user.usersign).one()
+                suser = statements.USER_BY_USERSIGN(self.session).params(
+                        usersign=user.usersign).one()
                 user = self._load_user(user, suser)
                 self.session.close()
                 return user
@@ -326,41 +897,446 @@ class Store(StorageInterface):
             self.session.rollback()
             raise
 
-    def search(self, search_query=''):
+    def search(self, search_query='', metadata=False, tags=False,
+            fields=False):
         """
         Do a search of of the database, using the 'q' query,
         parsed by the parser and turned into a producer.
+
+        Each tiddler found has a ``server.cursor`` field which may be
+        given in an ``_after:<cursor>`` term of the same query to get
+        the following page of results.
+
+        By default the tiddlers found have only title and bag. If
+        metadata is True they also have revision, modified, modifier,
+        type, created and creator; if tags or fields are True those
+        are filled in too. Text is never loaded. Each of these costs
+        one query for all the tiddlers found.
+
+        With a search cache configured, results are kept and reused
+        until the next write, checked with one query of the write
+        generations. See :py:mod:`tiddlywebplugins.sqlalchemy3.cache`.
+
+        The results are read and the session closed before the first
+        is yielded, so an abandoned search holds no connection.
         """
-        query = self.session.query(sTiddler).join('current')
-        config = self.environ.get('tiddlyweb.config', {})
-        if '_limit:' not in search_query:
-            default_limit = config.get('mysql.search_limit',
-                    config.get('sqlalchemy3.search_limit', '20'))
-            search_query += ' _limit:%s' % default_limit
         try:
-            try:
-                ast = self.parser(search_query)[0]
-                fulltext = config.get('mysql.fulltext', False)
-                query = self.producer.produce(ast, query, fulltext=fulltext,
-                        geo=self.has_geo)
-            except ParseException, exc:
-                raise StoreError('failed to parse search query: %s' % exc)
+            cache = self.search_cache
+            key = query = tiddlers = None
+            if cache:
+                normalized = normalize_query(search_query)
+                scopes = cache.scopes(normalized)
+                if scopes is None:
+                    ast, query = self._search_query(search_query)
+                    scopes = cache.set_scopes(normalized, ast)
+                key = (normalized, metadata, tags, fields,
+                        self._generations(scopes))
+                tiddlers = cache.get(key)
+            if tiddlers is None:
+                if query is None:
+                    ast, query = self._search_query(search_query)
+                tiddlers = self._search_tiddlers(query, metadata, tags,
+                        fields)
+                if key:
+                    cache.put(key, tiddlers, metadata, tags)
+            self.session.close()
+        except:
+            self.session.rollback()
+            raise
 
+        streamed = ROWS_STREAMED.labels('search')
+        for tiddler in tiddlers:
+            streamed.inc()
+            yield tiddler
+
+    def _search_tiddlers(self, query, metadata, tags, fields):
+        """
+        Run a produced search query, returning the tiddlers found with
+        their cursors and any projected attributes.
+        """
+        query = query.add_columns(sRevision.modified)
+        projected = metadata or tags or fields
+        if projected:
+            query = query.add_columns(sRevision.number,
+                    sRevision.modifier, sRevision.type)
+        core = self._core_reads()
+        config = self.environ.get('tiddlyweb.config', {})
+        with time_limit(self.session, query, config) as query:
             try:
-                for stiddler in query.all():
-                    try:
-                        yield Tiddler(unicode(stiddler.title),
-                                unicode(stiddler.bag))
-                    except AttributeError:
-                        stiddler = stiddler[0]
-                        yield Tiddler(unicode(stiddler.title),
-                                unicode(stiddler.bag))
-                self.session.close()
+                start = time.time()
+                if core:
+                    # the tiddler's columns, unlabelled, in place of an
+                    # sTiddler
+                    rows = self.session.execute(query.statement).fetchall()
+                else:
+                    rows = query.all()
+                SEARCH_EXECUTE.observe(time.time() - start)
+            except ProgrammingError, exc:
+                raise StoreError('generated search SQL incorrect: %s' % exc)
+        tiddlers = []
+        ids = []
+        for row in rows:
+            stiddler = core and row or row[0]
+            tiddler = Tiddler(unicode(stiddler.title),
+                    unicode(stiddler.bag))
+            tiddler.fields[u'server.cursor'] = encode_cursor(
+                    row.modified, stiddler.id)
+            tiddlers.append(tiddler)
+            ids.append(stiddler.id)
+        if projected and rows:
+            self._project_tiddlers(tiddlers, ids, rows, metadata, tags,
+                    fields)
+        return tiddlers
+
+    def explain_search(self, search_query=''):
+        """
+        Explain how search_query would be run: return a dict of the
+        parsed AST, the generated SQL and parameters, the database's
+        query plan and warnings about slow parts of that plan. See
+        :py:mod:`tiddlywebplugins.sqlalchemy3.explain`.
+        """
+        try:
+            ast, query = self._search_query(search_query)
+            try:
+                return explain_search(self.session, ast, query)
             except ProgrammingError, exc:
                 raise StoreError('generated search SQL incorrect: %s' % exc)
         except:
             self.session.rollback()
             raise
+        finally:
+            self.session.close()
+
+    def search_count(self, search_query=''):
+        """
+        Return the number of tiddlers matching search_query, counted
+        by the database. Any _limit in the query is ignored.
+        """
+        try:
+            ast, query = self._search_query(search_query, limited=False)
+            query = query.with_entities(func.count(distinct(sTiddler.id)))
+            config = self.environ.get('tiddlyweb.config', {})
+            with time_limit(self.session, query, config) as query:
+                try:
+                    return query.scalar()
+                except ProgrammingError, exc:
+                    raise StoreError('generated search SQL incorrect: %s'
+                            % exc)
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
+
+    def search_facets(self, search_query='', facet='tag', limit=10):
+        """
+        Return the limit most common values, as a list of (value, count)
+        tuples, of facet among the tiddlers matching search_query.
+        facet may be tag, bag, modifier, type or the name of a field.
+        """
+        try:
+            ast, query = self._search_query(search_query, limited=False)
+            matches = query.with_entities(sRevision.number).subquery()
+            matching = select([matches.c.number])
+            if facet == 'tag':
+                column = sTag.tag
+                counted = self.session.query(column, func.count()).filter(
+                        sTag.revision_number.in_(matching))
+            elif facet == 'bag':
+                column = sTiddler.bag
+                counted = self.session.query(column, func.count()).join(
+                        'current').filter(sRevision.number.in_(matching))
+            elif facet in ('modifier', 'type'):
+                column = getattr(sRevision, facet)
+                counted = self.session.query(column, func.count()).filter(
+                        sRevision.number.in_(matching))
+            else:
+                column = sField.value
+                counted = self.session.query(column, func.count()).filter(
+                        and_(sField.name == facet,
+                            sField.revision_number.in_(matching)))
+            counted = (counted.group_by(column)
+                    .order_by(func.count().desc(), column).limit(limit))
+            config = self.environ.get('tiddlyweb.config', {})
+            with time_limit(self.session, counted, config) as counted:
+                try:
+                    return [(value, count) for value, count
+                            in counted.all()]
+                except ProgrammingError, exc:
+                    raise StoreError('generated search SQL incorrect: %s'
+                            % exc)
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
+
+    def _recipe_filter_terms(self, filter_string):
+        """
+        Translate the filters in a recipe line into search terms,
+        returning None if any filter is not an equality select on an
+        attribute, tag or field the producer matches the same way.
+        """
+        filters = parse_for_filters(filter_string, self.environ)[0]
+        terms = []
+        for _, (key, argument), _ in filters:
+            if key != 'select' or ':' not in argument:
+                return None
+            attribute, value = argument.split(':', 1)
+            if (not value or value[0] in '!<>' or _unquotable(value)
+                    or attribute not in RECIPE_SELECT_ATTRIBUTES
+                    and not _custom_field(attribute)):
+                return None
+            terms.append(u'%s:"%s"' % (attribute, value))
+        return terms
+
+    def _bag_stats(self, names):
+        """
+        Return a dict of the stats of each bag in names, read from
+        bag_counter when counting, otherwise aggregated in one query.
+        """
+        stats = {}
+        if self._counting():
+            for name, tiddlers, revision, modified in self.session.execute(
+                    select([bag_counter_table]).where(and_(
+                        bag_counter_table.c.bag.in_(names),
+                        ~statements.COUNTER_BAG_DELETING))):
+                stats[name] = {'tiddlers': tiddlers,
+                        'revision': revision or 0, 'modified': modified}
+        missing = [name for name in names if name not in stats]
+        if missing:
+            for name, tiddlers, revision, modified in self.session.execute(
+                    self._bag_aggregates(missing)):
+                stats[name] = {'tiddlers': tiddlers, 'revision': revision,
+                        'modified': modified}
+        for name in names:
+            if name not in stats:
+                raise NoBagError('no stats for bag %s' % name)
+        return stats
+
+    def _bag_aggregates(self, names=None):
+        """
+        Select the name, tiddler count, highest current revision and
+        latest modified of the bags in names, or of all bags, leaving
+        out bags being deleted in chunks.
+        """
+        bag_table = sBag.__table__
+        tiddler_table = sTiddler.__table__
+        revision_table = sRevision.__table__
+        statement = (select([bag_table.c.name,
+            func.count(tiddler_table.c.id).label('tiddlers'),
+            func.coalesce(func.max(current_revision_table.c.current_id),
+                0).label('revision'),
+            func.max(revision_table.c.modified).label('modified')])
+            .select_from(bag_table
+                .outerjoin(tiddler_table,
+                    tiddler_table.c.bag == bag_table.c.name)
+                .outerjoin(current_revision_table,
+                    current_revision_table.c.tiddler_id == tiddler_table.c.id)
+                .outerjoin(revision_table, revision_table.c.number
+                    == current_revision_table.c.current_id))
+            .where(~statements.BAG_DELETING)
+            .group_by(bag_table.c.name))
+        if names is not None:
+            statement = statement.where(bag_table.c.name.in_(names))
+        return statement
+
+    def _count_write(self, bag_name, created, revision_number, modified):
+        """
+        Update the bag_counter row of bag_name, if it has one, for a
+        new revision, adding one tiddler if created. The highest
+        revision and latest modified are kept when writers commit out
+        of order.
+        """
+        counter = bag_counter_table.c
+        self.session.execute(bag_counter_table.update()
+                .where(counter.bag == bag_name)
+                .values(tiddlers=counter.tiddlers + (created and 1 or 0),
+                    revision=case([(counter.revision < revision_number,
+                        revision_number)], else_=counter.revision),
+                    modified=case([(or_(counter.modified == None,
+                        counter.modified < modified), modified)],
+                        else_=counter.modified)))
+
+    def _current_revision(self, tiddler):
+        """
+        Return the current revision number of tiddler, from the cached
+        pointer if it is trusted, otherwise with one indexed lookup.
+        """
+        cache = self.tiddler_cache
+        if cache.trust_pointers:
+            revision = cache.pointer(tiddler.bag, tiddler.title)
+            if revision:
+                return revision
+        revision = self._execute(statements.CURRENT_REVISION,
+                {'bag': tiddler.bag, 'title': tiddler.title}).scalar()
+        if revision is None:
+            raise NoResultFound('no current revision')
+        cache.set_pointer(tiddler.bag, tiddler.title, revision)
+        return revision
+
+    def _generations(self, scopes):
+        """
+        Return the current write generation of each scope.
+        """
+        values = dict(self.session.execute(select([generation_table.c.scope,
+            generation_table.c.value]).where(
+                generation_table.c.scope.in_(scopes))).fetchall())
+        return tuple(values.get(scope, 0) for scope in scopes)
+
+    def _bump_generations(self, bag_name):
+        """
+        Increment the store's write generation, and that of bag_name
+        when the search cache is per bag, creating them if needed.
+        """
+        scopes = [u'']
+        if self.search_cache.per_bag:
+            scopes.append(bag_name)
+        update = (generation_table.update()
+                .where(generation_table.c.scope.in_(scopes))
+                .values(value=generation_table.c.value + 1))
+        if self.session.execute(update).rowcount < len(scopes):
+            self.session.execute(self._insert_ignoring_conflicts(
+                generation_table), [{'scope': scope, 'value': 0}
+                    for scope in scopes])
+            self.session.execute(update)
+
+    def _tombstone(self, tiddler_id, bag_name, title):
+        """
+        Record the deletion of a tiddler, or with title None of a bag,
+        in the change feed. Its number is taken from the revision
+        sequence by inserting a revision of tiddler_id and deleting it
+        again, so that no revision is left for a tiddler which lives
+        on until a chunked bag delete is purged. Nothing is recorded
+        while the revision table may reuse numbers.
+        """
+        if not Store.tombstones:
+            return
+        revision_table = sRevision.__table__
+        number = self.session.execute(revision_table.insert(),
+                {'tiddler_id': tiddler_id}).inserted_primary_key[0]
+        self.session.execute(revision_table.delete().where(
+            revision_table.c.number == number))
+        self.session.execute(tombstone_table.insert(), {'number': number,
+            'bag': bag_name, 'title': title})
+
+    def _search_query(self, search_query, limited=True, guarded=True):
+        """
+        Parse search_query and produce a query from it, returning
+        the AST and the query. If limited is False the query has
+        no limit or ordering, for use in aggregates. If guarded is
+        False the search guardrails are skipped, for queries the
+        store makes itself.
+        """
+        query = self.session.query(sTiddler).join('current').filter(
+                ~statements.TIDDLER_BAG_DELETING)
+        config = self.environ.get('tiddlyweb.config', {})
+        if limited and '_limit:' not in search_query:
+            default_limit = config.get('mysql.search_limit',
+                    config.get('sqlalchemy3.search_limit', '20'))
+            search_query += ' _limit:%s' % default_limit
+        try:
+            start = time.time()
+            ast = self.parser(search_query)[0]
+            parsed = time.time()
+            if guarded:
+                check_ast(ast, config)
+            fulltext = config.get('mysql.fulltext', False)
+            query = self.producer.produce(ast, query, fulltext=fulltext,
+                    geo=self.has_geo, group_terms=config.get(
+                        'sqlalchemy3.search_group_terms', False))
+            if guarded:
+                check_joins(self.producer.joins, config)
+            SEARCH_PARSE.observe(parsed - start)
+            SEARCH_COMPILE.observe(time.time() - parsed)
+        except ParseException, exc:
+            raise StoreError('failed to parse search query: %s' % exc)
+        if not limited:
+            query = query.limit(None).order_by(None)
+        return ast, query
+
+    def _project_tiddlers(self, tiddlers, ids, rows, metadata, tags,
+            fields):
+        """
+        Fill in current revision metadata, and optionally tags and
+        fields, on the tiddlers from the corresponding ids and search
+        rows, with one query for each of created, tags and fields.
+        """
+        by_revision = {}
+        by_id = {}
+        for tiddler, tiddler_id, row in zip(tiddlers, ids, rows):
+            by_revision[row.number] = tiddler
+            by_id[tiddler_id] = tiddler
+            if metadata:
+                tiddler.revision = row.number
+                tiddler.modified = row.modified
+                tiddler.modifier = row.modifier
+                tiddler.type = row.type
+
+        if metadata:
+            first = (self.session.query(first_revision_table.c.tiddler_id,
+                sRevision.modified, sRevision.modifier)
+                .join(sRevision,
+                    sRevision.number == first_revision_table.c.first_id)
+                .filter(first_revision_table.c.tiddler_id.in_(by_id.keys())))
+            for tiddler_id, modified, modifier in first:
+                by_id[tiddler_id].created = modified
+                by_id[tiddler_id].creator = modifier
+
+        if tags:
+            for tiddler in tiddlers:
+                tiddler.tags = []
+            stags = (self.session.query(sTag.revision_number, sTag.tag)
+                    .filter(sTag.revision_number.in_(by_revision.keys())))
+            for revision_number, tag in stags:
+                by_revision[revision_number].tags.append(tag)
+
+        if fields:
+            sfields = (self.session.query(sField.revision_number, sField.name,
+                sField.value)
+                .filter(sField.revision_number.in_(by_revision.keys())))
+            for revision_number, name, value in sfields:
+                by_revision[revision_number].fields[name] = value
+
+    def _core_bags(self):
+        """
+        Return all the bags, built from Core rows without the ORM.
+        """
+        policies = self._core_policies(statements.BAG_POLICY_ROWS)
+        bags = []
+        for bag_id, name, desc in self._execute(statements.BAG_ROWS,
+                {}).fetchall():
+            bag = Bag(name)
+            bag.desc = desc
+            bag.policy = self._load_policy(policies.get(bag_id, []))
+            bag.store = True
+            bags.append(bag)
+        return bags
+
+    def _core_recipes(self):
+        """
+        Return all the recipes, built from Core rows without the ORM.
+        """
+        policies = self._core_policies(statements.RECIPE_POLICY_ROWS)
+        recipes = []
+        for recipe_id, name, desc, recipe_string in self._execute(
+                statements.RECIPE_ROWS, {}).fetchall():
+            recipe = Recipe(name)
+            recipe.desc = desc
+            recipe.policy = self._load_policy(policies.get(recipe_id, []))
+            recipe.set_recipe(self._load_recipe_string(recipe_string))
+            recipe.store = True
+            recipes.append(recipe)
+        return recipes
+
+    def _core_policies(self, statement):
+        """
+        Return the policy rows of statement by container id.
+        """
+        policies = {}
+        for row in self._execute(statement, {}).fetchall():
+            policies.setdefault(row.container_id, []).append(row)
+        return policies
 
     def _load_bag(self, bag, sbag):
         bag.desc = sbag.desc
@@ -443,41 +1419,100 @@ class Store(StorageInterface):
         return sbag
 
     def _store_policy(self, container, policy):
-        policies = []
+        """
+        Associate container (an sBag or sRecipe) with the sPolicy rows
+        for policy. All the principals are resolved with one query,
+        any which are missing are inserted together, and only changed
+        associations are written.
+        """
+        principals = set()
         for attribute in policy.attributes:
             if attribute == 'owner':
                 value = policy.owner is None and [] or [policy.owner]
             else:
                 value = getattr(policy, attribute, [])
-            spolicies = self._handle_policy_attribute(attribute, value)
-            policies.extend(spolicies)
-
-        container.policy = policies
-
-    def _handle_policy_attribute(self, attribute, value):
-        spolicies = []
-        for principal_name in value:
-            if principal_name is not None:
-                if principal_name.startswith('R:'):
-                    pname = principal_name[2:]
-                    ptype = u'R'
-                else:
-                    pname = principal_name
-                    ptype = u'U'
+            for principal_name in value:
+                if principal_name is not None:
+                    if principal_name.startswith('R:'):
+                        principals.add((attribute, principal_name[2:], u'R'))
+                    else:
+                        principals.add((attribute, principal_name, u'U'))
+
+        policy_ids = self._policy_ids(principals)
+        current_ids = set(spolicy.id for spolicy in container.policy)
+        removed = current_ids - policy_ids
+        added = policy_ids - current_ids
+
+        if isinstance(container, sBag):
+            table = bag_policy_table
+            column = table.c.bag_id
+        else:
+            table = recipe_policy_table
+            column = table.c.recipe_id
+        if added and container.id is None:
+            self.session.flush()
+        if removed:
+            self.session.execute(table.delete().where(and_(
+                column == container.id,
+                table.c.policy_id.in_(removed))))
+        if added:
+            self.session.execute(table.insert(), [
+                {column.name: container.id, 'policy_id': policy_id}
+                for policy_id in added])
+
+    def _policy_ids(self, principals):
+        """
+        Return the ids of the sPolicy rows for principals, a set of
+        (constraint, principal name, principal type), inserting rows
+        for those that do not exist.
+        """
+        if not principals:
+            return set()
+        table = sPolicy.__table__
+        names = set(principal[1] for principal in principals)
+        query = select([table.c.id, table.c.constraint,
+            table.c.principal_name, table.c.principal_type]).where(
+                    table.c.principal_name.in_(names))
+
+        def lookup():
+            found = {}
+            for row in self.session.execute(query):
+                principal = (row[1], row[2], row[3])
+                if principal in principals:
+                    found[principal] = row[0]
+            return found
+
+        found = lookup()
+        missing = principals - set(found)
+        if missing:
+            # Another writer may insert the same principals between
+            # lookup and insert, so ignore conflicts and look again.
+            self.session.execute(self._insert_ignoring_conflicts(table), [
+                {'constraint': constraint, 'principal_name': name,
+                    'principal_type': principal_type}
+                for constraint, name, principal_type in missing])
+            found = lookup()
+        return set(found.values())
+
+    def _execute(self, statement, params):
+        """
+        Execute statement, one of those defined in
+        :py:mod:`statements`, in the session's transaction, reusing
+        its compiled SQL.
+        """
+        return self.session.connection().execution_options(
+                compiled_cache=statements.COMPILED_STATEMENTS).execute(
+                        statement, params)
 
-                try:
-                    spolicy = self.session.query(sPolicy).filter(and_(
-                        sPolicy.constraint == attribute,
-                        sPolicy.principal_name == pname,
-                        sPolicy.principal_type == ptype)).one()
-                except NoResultFound:
-                    spolicy = sPolicy()
-                    spolicy.constraint = attribute
-                    spolicy.principal_name = pname
-                    spolicy.principal_type = ptype
-                    self.session.add(spolicy)
-                spolicies.append(spolicy)
-        return spolicies
+    def _dialect(self):
+        return self.session.get_bind().dialect.name
+
+    def _insert_ignoring_conflicts(self, table):
+        """
+        Return an insert into table which skips rows that would
+        violate a unique constraint, where the dialect allows.
+        """
+        return statements.insert_ignoring_conflicts(self._dialect(), table)
 
     def _store_recipe(self, recipe):
         try:
@@ -506,65 +1541,240 @@ class Store(StorageInterface):
             self.session.merge(srole)
 
     def _store_tiddler(self, tiddler):
+        """
+        Write a new revision of tiddler with Core statements, returning
+        the revision number. The bag and the tiddler id are looked up
+        together, the current revision pointer is upserted and, where
+        the dialect supports RETURNING, generated ids come back with
+        their insert.
+        """
         if binary_tiddler(tiddler):
             tiddler.text = unicode(b64encode(tiddler.text))
 
+        row = self._execute(statements.TIDDLER_ID_IN_BAG,
+                {'bag': tiddler.bag, 'title': tiddler.title}).fetchone()
+        if row is None or row[1] is not None:
+            raise NoBagError('bag %s must exist for tiddler save'
+                    % tiddler.bag)
+        tiddler_id = row[0]
+        new_tiddler = False
+        if tiddler_id is None:
+            tiddler_id, new_tiddler = self._insert_tiddler(tiddler)
+
+        result = self._execute(statements.INSERT_REVISION, {
+            'tiddler_id': tiddler_id,
+            'type': tiddler.type,
+            'modified': tiddler.modified,
+            'modifier': tiddler.modifier})
+        revision_number = result.inserted_primary_key[0]
+
+        self._execute(statements.INSERT_TEXT, {
+            'revision_number': revision_number, 'text': tiddler.text})
+
+        tags = [{'revision_number': revision_number, 'tag': tag}
+                for tag in set(tiddler.tags)]
+        if tags:
+            self._execute(statements.INSERT_TAG, tags)
+
+        fields = [dict(field_types(tiddler.fields[field]),
+            revision_number=revision_number, name=field,
+            value=tiddler.fields[field])
+            for field in tiddler.fields if not field.startswith('server.')]
+        if fields:
+            self._execute(statements.INSERT_FIELD, fields)
+
+        current = {'tiddler_id': tiddler_id, 'current_id': revision_number}
+        if new_tiddler:
+            self._execute(statements.INSERT_CURRENT, current)
+            self._execute(statements.INSERT_FIRST, {
+                'tiddler_id': tiddler_id, 'first_id': revision_number})
+        else:
+            self._upsert(current_revision_table, current)
+
+        if self._counting():
+            self._count_write(tiddler.bag, new_tiddler, revision_number,
+                    tiddler.modified)
+        if self.search_cache:
+            self._bump_generations(tiddler.bag)
+
+        return revision_number
+
+    def _insert_tiddler(self, tiddler):
+        """
+        Insert the tiddler row for tiddler, returning its id and
+        whether this call created it. A concurrent writer may create
+        the same tiddler first, in which case its id is looked up.
+        """
+        table = sTiddler.__table__
+        values = {'bag': tiddler.bag, 'title': tiddler.title}
+        dialect = self._dialect()
+        if dialect == 'postgresql':
+            row = self._execute(statements.insert_ignoring_conflicts(
+                dialect, table, table.c.id), values).fetchone()
+            if row is not None:
+                return row[0], True
+        else:
+            result = self._execute(statements.insert_ignoring_conflicts(
+                dialect, table), values)
+            # a MySQL conflict counts as a row found, with no insert id
+            if result.rowcount and result.inserted_primary_key[0]:
+                return result.inserted_primary_key[0], True
+        return self._execute(statements.TIDDLER_ID, values).scalar(), False
+
+    def _upsert(self, table, values):
+        """
+        Insert values into table, replacing the row with the same
+        primary key, in one statement where the dialect allows.
+        """
+        statement = statements.upsert(self._dialect(), table, values.keys())
+        if statement is None:
+            keys = [column.name for column in table.primary_key]
+            updates = [name for name in values if name not in keys]
+            result = self.session.execute(table.update()
+                    .where(and_(*[table.c[name] == values[name]
+                        for name in keys]))
+                    .values(dict((name, values[name]) for name in updates)))
+            if result.rowcount:
+                return
+            self.session.execute(table.insert(), values)
+        else:
+            self._execute(statement, values)
+
+    def _store_user(self, user):
+        suser = sUser()
+        suser.usersign = user.usersign
+        suser.password = user._password
+        suser.note = user.note
+        return suser
+
+
+def get_engine(db_config):
+    """
+    Return the engine for db_config, creating it the first time so
+    that every Store in the process shares one connection pool.
+    """
+    engine = STORE_ENGINES.get(db_config)
+    if engine is None:
+        with ENGINE_LOCK:
+            engine = STORE_ENGINES.get(db_config)
+            if engine is None:
+                engine = create_engine(db_config)
+                track_engine(engine)
+                # turn on foreign keys for sqlite (the default engine)
+                if engine.dialect.name == 'sqlite':
+                    event.listen(engine, 'connect', _set_sqlite_pragma)
+                elif engine.dialect.name == 'mysql':
+                    event.listen(engine, 'connect', raise_auto_increment)
+                STORE_ENGINES[db_config] = engine
+    return engine
+
+
+def _purge_deleted_bags(store_config, environ):
+    """
+    Purge deleted bags in a thread of their own, unless this process
+    is already doing so.
+    """
+    if not PURGE_LOCK.acquire(False):
+        return
+    try:
+        Store(store_config, environ).purge_deleted_bags()
+    except Exception, exc:
+        PURGE_LOGGER.error('purging deleted bags failed: %s', exc)
+    finally:
+        Session.remove()
+        PURGE_LOCK.release()
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+class SessionRelease(object):
+    """
+    WSGI middleware which removes the thread's session, returning its
+    connection to the pool, when a request's response is finished or
+    fails, however far its output was read.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
         try:
-            stiddler = self.session.query(sTiddler.id).filter(
-                    and_(sTiddler.title == tiddler.title,
-                        sTiddler.bag == tiddler.bag)).one()
-            new_tiddler = False
-        except NoResultFound:
-            stiddler = sTiddler(tiddler.title, tiddler.bag)
-            self.session.add(stiddler)
-            new_tiddler = True
-            self.session.flush()
+            output = self.application(environ, start_response)
+        except:
+            Session.remove()
+            raise
+        return ReleasingOutput(output)
 
-        srevision = sRevision()
-        srevision.type = tiddler.type
-        srevision.modified = tiddler.modified
-        srevision.modifier = tiddler.modifier
-        srevision.tiddler_id = stiddler.id
-        self.session.add(srevision)
 
-        self.session.flush()
+class ReleasingOutput(object):
+    """
+    A response iterable which removes the session when closed.
+    """
+
+    def __init__(self, output):
+        self.output = output
 
-        text_insert = (sText.__table__.insert()
-                .values(text=tiddler.text, revision_number=srevision.number))
-        self.session.execute(text_insert)
+    def __iter__(self):
+        return iter(self.output)
 
-        for tag in set(tiddler.tags):
-            stag = sTag(tag)
-            stag.revision_number = srevision.number
-            self.session.add(stag)
+    def close(self):
+        try:
+            if hasattr(self.output, 'close'):
+                self.output.close()
+        finally:
+            Session.remove()
 
-        for field in tiddler.fields:
-            if not field.startswith('server.'):
-                sfield = sField(field, tiddler.fields[field])
-                sfield.revision_number = srevision.number
-                self.session.add(sfield)
 
-        self.session.flush()
+def _unquotable(value):
+    """
+    True if value cannot be given as a quoted search term value.
+    """
+    return '"' in value or '\\' in value or '*' in value
 
-        current_revision = sCurrentRevision()
-        current_revision.tiddler_id = stiddler.id
-        current_revision.current_id = srevision.number
-        self.session.merge(current_revision)
 
-        if new_tiddler:
-            first_revision = sFirstRevision()
-            first_revision.tiddler_id = stiddler.id
-            first_revision.first_id = srevision.number
-            self.session.merge(first_revision)
+def _custom_field(attribute):
+    """
+    True if a select filter on attribute compares a custom field.
+    """
+    return (FIELD_NAME.match(attribute) is not None
+            and not attribute.startswith('_')
+            and attribute not in SELECT_ATTRIBUTE
+            and attribute not in SEARCH_ATTRIBUTES
+            and not hasattr(Tiddler(u'attributes'), attribute))
 
-        return srevision.number
 
-    def _store_user(self, user):
-        suser = sUser()
-        suser.usersign = user.usersign
-        suser.password = user._password
-        suser.note = user.note
-        return suser
+def init(config):
+    """
+    Establish the twanager commands. In the web server, release
+    each request's session when its response is done, mount
+    the metrics endpoint at ``sqlalchemy3.metrics_uri``, start
+    writing metrics to ``sqlalchemy3.metrics_file`` and answer
+    conditional listing requests if ``sqlalchemy3.conditional_listings``
+    is set, when those are configured.
+    """
+    from .commands import establish_commands
+    establish_commands(config)
+
+    if 'selector' in config:
+        # the last response filter is the outermost, so the close of
+        # its output is not lost in the output of other filters
+        if SessionRelease not in config['server_response_filters']:
+            config['server_response_filters'].append(SessionRelease)
+        if config.get('sqlalchemy3.conditional_listings'):
+            from .conditional import ConditionalListings
+            if ConditionalListings not in config['server_request_filters']:
+                config['server_request_filters'].append(ConditionalListings)
+        metrics_uri = config.get('sqlalchemy3.metrics_uri')
+        if metrics_uri:
+            config['selector'].add(metrics_uri, GET=metrics_app)
+        metrics_file = config.get('sqlalchemy3.metrics_file')
+        if metrics_file:
+            MetricsWriter(metrics_file, float(config.get(
+                'sqlalchemy3.metrics_interval', 15))).start()
 
 
 def index_query(environ, **kwargs):
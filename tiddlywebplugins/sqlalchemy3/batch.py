@@ -0,0 +1,160 @@
+"""
+Group commit of tiddler puts.
+
+Each put normally commits its own transaction, so on SQLite and other
+databases bound by the time to flush a commit, writes per second are
+capped by commit latency. With ``sqlalchemy3.group_commit_window`` set
+to a number of seconds, :py:meth:`Store.tiddler_put` instead queues
+the tiddler for a committer thread, one per database, which writes the
+puts arriving within that window of the first, up to
+``sqlalchemy3.group_commit_size`` of them, and commits them together.
+
+Each caller waits for its batch and gets its own revision number or
+error. A put to a missing bag fails without writing anything. If any
+other put in a batch fails the batch is rolled back and its puts are
+retried one transaction each, so that only the failing put raises.
+If the committer's own store cannot be made or used, the whole batch
+fails with that error and the next batch starts over with a new store.
+"""
+
+import Queue
+import logging
+import sys
+import threading
+import time
+
+from tiddlyweb.store import NoBagError
+
+
+COMMITTERS = {}
+COMMITTER_LOCK = threading.Lock()
+LOGGER = logging.getLogger('tiddlywebplugins.sqlalchemy3.batch')
+
+
+def get_group_commit(config, db_config, store_factory):
+    """
+    Return the GroupCommit for db_config, starting it with a Store made
+    by store_factory the first time, or None if
+    ``sqlalchemy3.group_commit_window`` is not set.
+    """
+    window = float(config.get('sqlalchemy3.group_commit_window', 0))
+    if not window:
+        return None
+    committer = COMMITTERS.get(db_config)
+    if committer is None:
+        with COMMITTER_LOCK:
+            committer = COMMITTERS.get(db_config)
+            if committer is None:
+                committer = GroupCommit(store_factory, window,
+                        int(config.get('sqlalchemy3.group_commit_size', 100)))
+                COMMITTERS[db_config] = committer
+    return committer
+
+
+class _Put(object):
+    """
+    A queued tiddler put, done when its batch is committed or failed.
+    """
+
+    def __init__(self, tiddler):
+        self.tiddler = tiddler
+        # _store_tiddler encodes binary text in place, so a retry
+        # starts from the original
+        self.text = tiddler.text
+        self.revision = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommit(object):
+    """
+    A queue of tiddler puts and the thread which commits them in
+    batches.
+    """
+
+    def __init__(self, store_factory, window, size):
+        self.store_factory = store_factory
+        self.window = window
+        self.size = size
+        self.queue = Queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run,
+                name='sqlalchemy3-group-commit')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, tiddler):
+        """
+        Write tiddler in the next batch, returning its revision number
+        once the batch is committed, or raising its error.
+        """
+        put = _Put(tiddler)
+        self.queue.put(put)
+        put.done.wait()
+        if put.error is not None:
+            raise put.error[0], put.error[1], put.error[2]
+        return put.revision
+
+    def _run(self):
+        """
+        Commit batches until the process ends. The store is made when
+        the first batch arrives. If making it or committing fails, the
+        puts of the batch are failed with the error and the committer
+        restarts with a new store for the next batch.
+        """
+        store = None
+        while True:
+            batch = [self.queue.get()]
+            try:
+                deadline = time.time() + self.window
+                while len(batch) < self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(True, remaining))
+                    except Queue.Empty:
+                        break
+                if store is None:
+                    store = self.store_factory()
+                self._commit(store, batch)
+            except Exception, exc:
+                LOGGER.error('group commit failed, restarting: %s', exc)
+                error = sys.exc_info()
+                for put in batch:
+                    if not put.done.is_set():
+                        put.error = error
+                        put.done.set()
+                if store is not None:
+                    store.session.close()
+                store = None
+
+    def _commit(self, store, batch):
+        """
+        Write and commit batch in one transaction, or if that fails
+        each of its puts in a transaction of its own.
+        """
+        session = store.session
+        try:
+            for put in batch:
+                put.tiddler.text = put.text
+                put.error = None
+                try:
+                    put.revision = store._store_tiddler(put.tiddler)
+                except NoBagError:
+                    # raised before the put writes anything, so the
+                    # rest of the batch can go ahead
+                    put.error = sys.exc_info()
+            session.commit()
+            self.batches += 1
+        except:
+            error = sys.exc_info()
+            session.rollback()
+            if len(batch) > 1:
+                for put in batch:
+                    self._commit(store, [put])
+                return
+            batch[0].revision = None
+            batch[0].error = error
+        for put in batch:
+            put.done.set()
@@ -0,0 +1,416 @@
+"""
+Process-local caches of loaded tiddlers and search results.
+
+A revision never changes once written, so a loaded tiddler keyed by
+``(bag, title, revision)`` stays correct until the tiddler is
+deleted. :py:class:`TiddlerCache` keeps these in least recently used
+order, bounded by an estimate of their size in bytes, along with a
+bounded map of each tiddler's current revision.
+
+A read of the current revision looks up the pointer with one indexed
+query and is then answered from the cache. With
+``sqlalchemy3.tiddler_cache_trust_pointers`` set the cached pointer
+is used without that query, which is only correct when every write to
+the store goes through this process. Puts and deletes in this process
+update the pointers and deletes drop the tiddler's revisions.
+
+Enable the cache by setting ``sqlalchemy3.tiddler_cache_bytes``.
+Hits, misses, entries and bytes are included in the metrics.
+
+:py:class:`SearchCache` keeps search results by normalized query and
+the write generation they were read at. Every tiddler put and delete
+increments the store-wide generation in the database, in the same
+transaction, so a cached result is only used while nothing has been
+written since, in any process. With ``sqlalchemy3.search_cache_per_bag``
+set each bag also has a generation, and searches confined to bags by
+top level ``bag:`` terms depend only on those. Enable it by setting
+``sqlalchemy3.search_cache_size`` to the number of results to keep,
+in every process writing to the store.
+"""
+
+import re
+import threading
+
+from collections import OrderedDict
+
+from tiddlyweb.model.tiddler import Tiddler
+
+from .metrics import REGISTRY
+
+
+# Quoted phrases, which are kept as they are when normalizing queries.
+QUOTED = re.compile(r'("(?:[^"\\]|\\.)*")')
+WHITESPACE = re.compile(r'\s+')
+# Estimated bytes used by an entry besides its strings.
+ENTRY_OVERHEAD = 512
+ATTRIBUTES = ['revision', 'modifier', 'modified', 'type', 'created',
+        'creator', 'text']
+
+
+class TiddlerCache(object):
+    """
+    An LRU cache of tiddler state by (bag, title, revision), with an
+    LRU map of (bag, title) to current revision.
+    """
+
+    def __init__(self, max_bytes, max_pointers=10000,
+            trust_pointers=False):
+        self.max_bytes = max_bytes
+        self.max_pointers = max_pointers
+        self.trust_pointers = trust_pointers
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.revisions = {}
+        self.pointers = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.pointer_hits = 0
+        self.pointer_misses = 0
+
+    def get(self, tiddler, revision):
+        """
+        Fill tiddler from the entry for its revision, returning
+        whether there was one.
+        """
+        key = (tiddler.bag, tiddler.title, revision)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return False
+            self.entries[key] = entry
+            self.hits += 1
+        state, _ = entry
+        for attribute in ATTRIBUTES:
+            setattr(tiddler, attribute, state[attribute])
+        tiddler.tags = list(state['tags'])
+        tiddler.fields.update(state['fields'])
+        return True
+
+    def put(self, tiddler):
+        """
+        Add loaded tiddler, evicting the least recently used entries
+        to stay within max_bytes.
+        """
+        state = dict((attribute, getattr(tiddler, attribute))
+                for attribute in ATTRIBUTES)
+        state['tags'] = tuple(tiddler.tags)
+        state['fields'] = dict((name, value) for name, value
+                in tiddler.fields.items() if not name.startswith('server.'))
+        size = entry_size(state)
+        if size > self.max_bytes:
+            return
+        name = (tiddler.bag, tiddler.title)
+        key = name + (tiddler.revision,)
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (state, size)
+            self.revisions.setdefault(name, set()).add(tiddler.revision)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def pointer(self, bag, title):
+        """
+        Return the cached current revision of the tiddler, or None.
+        """
+        with self.lock:
+            revision = self.pointers.pop((bag, title), None)
+            if revision is None:
+                self.pointer_misses += 1
+                return None
+            self.pointers[(bag, title)] = revision
+            self.pointer_hits += 1
+            return revision
+
+    def set_pointer(self, bag, title, revision):
+        """
+        Record revision as current for the tiddler, unless a higher
+        one, from a write made since it was read, is already known.
+        """
+        with self.lock:
+            revision = max(revision, self.pointers.pop((bag, title), 0))
+            self.pointers[(bag, title)] = revision
+            while len(self.pointers) > self.max_pointers:
+                self.pointers.popitem(last=False)
+
+    def delete(self, bag, title):
+        """
+        Forget the tiddler's pointer and revisions.
+        """
+        with self.lock:
+            self.pointers.pop((bag, title), None)
+            for revision in list(self.revisions.get((bag, title), ())):
+                self._remove((bag, title, revision))
+
+    def delete_bag(self, bag):
+        """
+        Forget the pointers and revisions of every tiddler in bag.
+        """
+        with self.lock:
+            for name in [name for name in self.pointers if name[0] == bag]:
+                del self.pointers[name]
+            for key in [key for key in self.entries if key[0] == bag]:
+                self._remove(key)
+
+    def stats(self):
+        """
+        Return a dict of the entries, bytes, hits, misses and hit
+        ratios of the cache.
+        """
+        with self.lock:
+            stats = {'entries': len(self.entries), 'bytes': self.bytes,
+                    'pointers': len(self.pointers), 'hits': self.hits,
+                    'misses': self.misses, 'pointer_hits': self.pointer_hits,
+                    'pointer_misses': self.pointer_misses}
+        stats['hit_ratio'] = _ratio(stats['hits'], stats['misses'])
+        stats['pointer_hit_ratio'] = _ratio(stats['pointer_hits'],
+                stats['pointer_misses'])
+        return stats
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+            revisions = self.revisions.get(key[:2])
+            revisions.discard(key[2])
+            if not revisions:
+                del self.revisions[key[:2]]
+
+
+class SearchCache(object):
+    """
+    An LRU cache of search results by query, projection and
+    generation, remembering which generations each query uses.
+    """
+
+    def __init__(self, max_entries, per_bag=False):
+        self.max_entries = max_entries
+        self.per_bag = per_bag
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.query_scopes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def scopes(self, query):
+        """
+        Return the generation scopes recorded for query, or None.
+        """
+        with self.lock:
+            return self.query_scopes.get(query)
+
+    def set_scopes(self, query, ast):
+        """
+        Record and return the generation scopes of query: u'' for
+        the whole store or, when per_bag, the bags ast is confined to.
+        """
+        scopes = (u'',)
+        if self.per_bag:
+            bags = search_bags(ast)
+            if bags:
+                scopes = tuple(sorted(bags))
+        with self.lock:
+            self.query_scopes.pop(query, None)
+            self.query_scopes[query] = scopes
+            while len(self.query_scopes) > self.max_entries:
+                self.query_scopes.popitem(last=False)
+        return scopes
+
+    def get(self, key):
+        """
+        Return new copies of the tiddlers found for key, or None.
+        """
+        with self.lock:
+            results = self.entries.pop(key, None)
+            if results is None:
+                self.misses += 1
+                return None
+            self.entries[key] = results
+            self.hits += 1
+        tiddlers = []
+        for title, bag, state in results:
+            tiddler = Tiddler(title, bag)
+            for attribute, value in state.items():
+                if attribute == 'tags':
+                    tiddler.tags = list(value)
+                elif attribute == 'fields':
+                    tiddler.fields.update(value)
+                else:
+                    setattr(tiddler, attribute, value)
+            tiddlers.append(tiddler)
+        return tiddlers
+
+    def put(self, key, tiddlers, metadata=False, tags=False):
+        """
+        Keep the tiddlers found for key, with metadata and tags if
+        they were projected.
+        """
+        results = []
+        for tiddler in tiddlers:
+            state = {'fields': dict(tiddler.fields)}
+            if metadata:
+                for attribute in ATTRIBUTES[:-1]:
+                    state[attribute] = getattr(tiddler, attribute)
+            if tags:
+                state['tags'] = tuple(tiddler.tags)
+            results.append((tiddler.title, tiddler.bag, state))
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = results
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Return a dict of the entries, hits, misses and hit ratio.
+        """
+        with self.lock:
+            stats = {'entries': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses}
+        stats['hit_ratio'] = _ratio(stats['hits'], stats['misses'])
+        return stats
+
+
+def normalize_query(search_query):
+    """
+    Collapse the whitespace in search_query outside quoted phrases.
+    """
+    parts = QUOTED.split(search_query)
+    for index in range(0, len(parts), 2):
+        parts[index] = WHITESPACE.sub(u' ', parts[index])
+    return u''.join(parts).strip()
+
+
+def search_bags(ast):
+    """
+    Return the set of bags named in bag or fbag terms which every
+    result of the search must match, or None if there are none.
+    """
+    bags = set()
+    nodes = list(ast)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, basestring):
+            continue
+        name = node.getName()
+        if name == 'And':
+            nodes.extend(node)
+        elif (name == 'Field' and node[0] in ('bag', 'fbag')
+                and node[1].getName() in ('Word', 'Quotes')
+                and isinstance(node[1][0], basestring)
+                and '*' not in node[1][0]):
+            bags.add(node[1][0])
+    return bags or None
+
+
+def entry_size(state):
+    """
+    Estimate the bytes held by a cached tiddler state.
+    """
+    size = ENTRY_OVERHEAD
+    for attribute in ATTRIBUTES:
+        value = state[attribute]
+        if isinstance(value, basestring):
+            size += len(value) * (isinstance(value, unicode) and 4 or 1)
+    for tag in state['tags']:
+        size += len(tag) * 4
+    for name, value in state['fields'].items():
+        size += (len(name) + len(value)) * 4
+    return size
+
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return total and float(hits) / total or 0.0
+
+
+TIDDLER_CACHE = None
+CACHE_LOCK = threading.Lock()
+
+
+def get_tiddler_cache(config):
+    """
+    Return the process's TiddlerCache, creating it from config, or
+    None if ``sqlalchemy3.tiddler_cache_bytes`` is not set.
+    """
+    global TIDDLER_CACHE
+    max_bytes = int(config.get('sqlalchemy3.tiddler_cache_bytes', 0))
+    if not max_bytes:
+        return None
+    if TIDDLER_CACHE is None:
+        with CACHE_LOCK:
+            if TIDDLER_CACHE is None:
+                TIDDLER_CACHE = TiddlerCache(max_bytes,
+                        int(config.get('sqlalchemy3.tiddler_cache_pointers',
+                            10000)),
+                        config.get('sqlalchemy3.tiddler_cache_trust_pointers',
+                            False))
+    return TIDDLER_CACHE
+
+
+SEARCH_CACHE = None
+
+
+def get_search_cache(config):
+    """
+    Return the process's SearchCache, creating it from config, or
+    None if ``sqlalchemy3.search_cache_size`` is not set.
+    """
+    global SEARCH_CACHE
+    max_entries = int(config.get('sqlalchemy3.search_cache_size', 0))
+    if not max_entries:
+        return None
+    if SEARCH_CACHE is None:
+        with CACHE_LOCK:
+            if SEARCH_CACHE is None:
+                SEARCH_CACHE = SearchCache(max_entries,
+                        config.get('sqlalchemy3.search_cache_per_bag', False))
+    return SEARCH_CACHE
+
+
+def _search_cache_collector():
+    if SEARCH_CACHE is None:
+        return []
+    stats = SEARCH_CACHE.stats()
+    return [
+            ('sqlalchemy3_search_cache_requests_total', 'counter',
+                'Search cache lookups by result.',
+                [('sqlalchemy3_search_cache_requests_total',
+                    [('result', 'hit')], stats['hits']),
+                    ('sqlalchemy3_search_cache_requests_total',
+                        [('result', 'miss')], stats['misses'])]),
+            ('sqlalchemy3_search_cache_entries', 'gauge',
+                'Search results held in the cache.',
+                [('sqlalchemy3_search_cache_entries', [],
+                    stats['entries'])]),
+            ]
+
+
+def _cache_collector():
+    if TIDDLER_CACHE is None:
+        return []
+    stats = TIDDLER_CACHE.stats()
+    return [
+            ('sqlalchemy3_tiddler_cache_requests_total', 'counter',
+                'Tiddler cache lookups by kind and result.',
+                [('sqlalchemy3_tiddler_cache_requests_total',
+                    [('kind', kind), ('result', result)],
+                    stats[key]) for kind, result, key in [
+                        ('revision', 'hit', 'hits'),
+                        ('revision', 'miss', 'misses'),
+                        ('pointer', 'hit', 'pointer_hits'),
+                        ('pointer', 'miss', 'pointer_misses')]]),
+            ('sqlalchemy3_tiddler_cache_entries', 'gauge',
+                'Tiddler revisions held in the cache.',
+                [('sqlalchemy3_tiddler_cache_entries', [],
+                    stats['entries'])]),
+            ('sqlalchemy3_tiddler_cache_bytes', 'gauge',
+                'Estimated bytes held by the tiddler cache.',
+                [('sqlalchemy3_tiddler_cache_bytes', [], stats['bytes'])]),
+            ]
+
+
+REGISTRY.register_collector(_cache_collector)
+REGISTRY.register_collector(_search_cache_collector)
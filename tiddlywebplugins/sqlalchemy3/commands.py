@@ -0,0 +1,123 @@
+"""
+twanager commands for inspecting and maintaining a sqlalchemy store.
+
+Add ``tiddlywebplugins.sqlalchemy3`` to ``twanager_plugins`` in
+config to make them available.
+"""
+
+import json
+import sys
+import time
+
+from tiddlyweb.manage import make_command
+from tiddlyweb.store import Store
+
+from . import get_engine
+from .dump import dump_store, load_store, fill_field_types
+from .explain import format_explanation
+from .migrate import (add_missing_columns, create_missing_indexes,
+        migrate_revision_sequence)
+
+
+def establish_commands(config):
+    """
+    Add the commands to twanager.
+    """
+
+    @make_command()
+    def sqlexplain(args):
+        """Explain the SQL and query plan for a search: <query>"""
+        store = _store(config)
+        explanation = store.storage.explain_search(u' '.join(args))
+        print format_explanation(explanation).encode('utf-8')
+
+    @make_command()
+    def sqldump(args):
+        """Dump the entire store, with revisions, to stdout or [filename]"""
+        store = _store(config)
+        if args:
+            output = open(args[0], 'w')
+        else:
+            output = sys.stdout
+        try:
+            count, seconds = dump_store(store.storage, output,
+                    progress=_report)
+        finally:
+            if args:
+                output.close()
+        _report(count, seconds, final=True)
+
+    @make_command()
+    def sqlload(args):
+        """Load a dump from stdin or [filename] into an empty store"""
+        store = _store(config)
+        if args:
+            lines = open(args[0])
+        else:
+            lines = sys.stdin
+        count, seconds = load_store(store.storage, lines, progress=_report)
+        _report(count, seconds, final=True)
+
+    @make_command()
+    def sqlfieldtypes(args):
+        """Add and fill the typed field columns used by range searches"""
+        store = _store(config)
+        count, seconds = fill_field_types(store.storage, progress=_report)
+        _report(count, seconds, final=True)
+
+    @make_command()
+    def sqlchanges(args):
+        """Print changes after [revision], at most [limit], as JSON lines"""
+        store = _store(config)
+        since = args and int(args[0]) or 0
+        limit = len(args) > 1 and int(args[1]) or None
+        for bag, title, revision, deleted in store.storage.changes_since(
+                since, limit):
+            print json.dumps({'bag': bag, 'title': title,
+                'revision': revision, 'deleted': deleted})
+
+    @make_command()
+    def sqlbagcounters(args):
+        """Rebuild the bag counters kept with sqlalchemy3.bag_counters"""
+        store = _store(config)
+        start = time.time()
+        count = store.storage.rebuild_bag_counters()
+        _report(count, time.time() - start, final=True)
+
+    @make_command()
+    def sqlpurgebags(args):
+        """Remove bags deleted in chunks, [chunk] tiddlers at a time"""
+        store = _store(config)
+        chunk = args and int(args[0]) or None
+
+        def progress(bag, removed, tiddlers, done):
+            sys.stderr.write('\r%s: %d of %d tiddlers removed%s' % (
+                bag.encode('utf-8'), removed, tiddlers, done and '\n' or ''))
+
+        start = time.time()
+        count = store.storage.purge_deleted_bags(chunk, progress=progress)
+        _report(count, time.time() - start, final=True)
+
+    @make_command()
+    def sqlmigrate(args):
+        """Add missing columns and indexes, rebuild the revision table"""
+        engine = get_engine(config['server_store'][1]['db_config'])
+        changes = ['added column %s' % column
+                for column in add_missing_columns(engine)]
+        if migrate_revision_sequence(engine):
+            changes.append('revision table migrated')
+        changes.extend('created index %s' % index
+                for index in create_missing_indexes(engine))
+        for change in changes or ['nothing to migrate']:
+            print change
+
+
+def _report(count, seconds, final=False):
+    rate = seconds and count / seconds or 0
+    sys.stderr.write('\r%d entities in %.1fs, %.0f/s%s' % (count, seconds,
+        rate, final and '\n' or ''))
+
+
+def _store(config):
+    return Store(config['server_store'][0], config['server_store'][1],
+            {'tiddlyweb.config': config})
@@ -0,0 +1,117 @@
+"""
+Answer conditional GETs of bag and recipe tiddler listings from the
+store's bag statistics, without listing the tiddlers.
+
+:py:class:`ConditionalListings` is a request filter, added to
+``server_request_filters`` when ``sqlalchemy3.conditional_listings``
+is set in config. For ``GET`` and ``HEAD`` of ``/bags/{name}/tiddlers``
+and ``/recipes/{name}/tiddlers`` it computes an ETag from the bag (or
+recipe) stats, the request URI, the Accept header and the current
+user. A matching If-None-Match is answered with 304 Not Modified;
+otherwise the listing is sent as usual with that ETag in place of
+the one TiddlyWeb computes from the tiddlers.
+
+Read permission is checked as the listing handlers check it. When
+it is refused, the store is not a sqlalchemy store, or the recipe
+includes a special bag, the request goes through unchanged.
+"""
+
+import re
+import urllib
+
+from hashlib import sha1
+
+from tiddlyweb.control import recipe_template
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.policy import PermissionsError
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.store import StoreError
+from tiddlyweb.web.util import http_date_from_timestamp
+
+
+LISTING_PATH = re.compile(r'^/(bags|recipes)/([^/]+)/tiddlers(?:\.\w+)?$')
+
+
+class ConditionalListings(object):
+    """
+    WSGI middleware answering If-None-Match on tiddler listings.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+            listing = listing_etag(environ)
+            if listing:
+                etag, modified = listing
+                if environ.get('HTTP_IF_NONE_MATCH') == etag:
+                    headers = [('Etag', etag), ('Cache-Control', 'no-cache'),
+                            ('Vary', 'Accept')]
+                    if modified:
+                        headers.append(('Last-Modified',
+                            http_date_from_timestamp(modified)))
+                    start_response('304 Not Modified', headers)
+                    return []
+                return self.application(environ,
+                        _replace_etag(start_response, etag))
+        return self.application(environ, start_response)
+
+
+def listing_etag(environ):
+    """
+    Return the ETag and latest modified time of the tiddler listing
+    requested in environ, or None if it cannot be answered from stats.
+    """
+    config = environ.get('tiddlyweb.config', {})
+    path = environ.get('PATH_INFO', '')
+    prefix = config.get('server_prefix', '')
+    if prefix and path.startswith(prefix):
+        path = path[len(prefix):]
+    match = LISTING_PATH.match(path)
+    store = environ.get('tiddlyweb.store')
+    if not match or not hasattr(getattr(store, 'storage', None),
+            'bag_stats'):
+        return None
+
+    kind = match.group(1)
+    try:
+        name = urllib.unquote(match.group(2)).decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    usersign = environ.get('tiddlyweb.usersign', {'name': 'GUEST'})
+    try:
+        if kind == 'bags':
+            bag = store.get(Bag(name))
+            bag.policy.allows(usersign, 'read')
+            definition = None
+            stats = store.storage.bag_stats(bag)
+        else:
+            recipe = store.get(Recipe(name))
+            recipe.policy.allows(usersign, 'read')
+            definition = recipe.get_recipe(recipe_template(environ))
+            for bag_name, _ in definition:
+                bag = store.get(Bag(bag_name))
+                bag.policy.allows(usersign, 'read')
+            stats = store.storage.recipe_stats(recipe)
+    except (StoreError, PermissionsError):
+        return None
+
+    digest = sha1(repr((kind, name, definition, stats['tiddlers'],
+        stats['revision'], stats['modified'], path,
+        environ.get('QUERY_STRING', ''), environ.get('HTTP_ACCEPT', ''),
+        usersign.get('name')))).hexdigest()
+    return '"sqlalchemy3:%s"' % digest, stats['modified']
+
+
+def _replace_etag(start_response, etag):
+    """
+    Wrap start_response to put etag on a successful response.
+    """
+    def replacing_start_response(status, headers, exc_info=None):
+        if status.startswith('200'):
+            headers = [(header, value) for header, value in headers
+                    if header.lower() != 'etag']
+            headers.append(('Etag', etag))
+        return start_response(status, headers, exc_info)
+    return replacing_start_response
@@ -0,0 +1,397 @@
+"""
+Stream a whole store, including the full revision history of every
+tiddler, to and from a compact line-delimited JSON format.
+
+Each line is a JSON object with a ``type`` of ``header``, ``bag``,
+``recipe``, ``user``, ``tiddler``, ``revision`` or ``tombstone``. A
+``tiddler`` line is followed by the lines for each of its revisions,
+oldest first, and the tombstones of the change feed come last.
+Tiddler ids, revision numbers and tombstone numbers are preserved, so
+a dump must be loaded into an empty store.
+
+Both directions work in chunks, so memory use is bounded by the
+chunk size rather than the size of the store. Loading uses
+executemany for each chunk, ``COPY`` on PostgreSQL (with psycopg2),
+and commits in batches of several chunks, which matters most on
+SQLite where each commit is a sync to disk.
+
+:py:func:`fill_field_types` similarly works through every field row,
+adding the typed value columns used by range searches to stores
+created before they existed.
+"""
+
+import json
+import time
+
+from StringIO import StringIO
+
+from sqlalchemy.sql.expression import and_, or_, select, bindparam
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.user import User
+
+from .migrate import (add_missing_columns, create_missing_indexes,
+        restart_revision_sequence)
+from .model import (sTiddler, sRevision, sText, sTag, sField,
+        current_revision_table, first_revision_table, tombstone_table,
+        field_types)
+from .statements import TIDDLER_BAG_DELETING
+
+
+DUMP_VERSION = 1
+CHUNK_SIZE = 1000
+TRANSACTION_SIZE = 20000
+
+TIDDLER = sTiddler.__table__
+REVISION = sRevision.__table__
+TEXT = sText.__table__
+TAG = sTag.__table__
+FIELD = sField.__table__
+
+# Tables in the order their rows must be inserted.
+LOAD_ORDER = [TIDDLER, REVISION, TEXT, TAG, FIELD, current_revision_table,
+        first_revision_table, tombstone_table]
+
+
+def dump_store(storage, output, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Write every entity in storage (a sqlalchemy3 Store) to the file
+    like output. progress, if given, is called with the number of
+    entities written and the elapsed seconds after each chunk.
+    Returns that count and time.
+    """
+    start = time.time()
+    count = 0
+
+    def write(record):
+        output.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    write({'type': 'header', 'version': DUMP_VERSION})
+
+    for bag in storage.list_bags():
+        write({'type': 'bag', 'name': bag.name, 'desc': bag.desc,
+            'policy': _dump_policy(bag.policy)})
+        count += 1
+    for recipe in storage.list_recipes():
+        write({'type': 'recipe', 'name': recipe.name, 'desc': recipe.desc,
+            'policy': _dump_policy(recipe.policy),
+            'recipe': recipe.get_recipe()})
+        count += 1
+    for user in list(storage.list_users()):
+        user = storage.user_get(user)
+        write({'type': 'user', 'usersign': user.usersign,
+            'password': user._password, 'note': user.note,
+            'roles': sorted(user.roles)})
+        count += 1
+
+    session = storage.session
+    last_tiddler, last_number = 0, 0
+    try:
+        while True:
+            revisions = session.execute(select([TIDDLER.c.id,
+                TIDDLER.c.bag, TIDDLER.c.title, REVISION.c.number,
+                REVISION.c.modified, REVISION.c.modifier, REVISION.c.type,
+                TEXT.c.text])
+                .select_from(REVISION.join(TIDDLER).outerjoin(TEXT))
+                .where(and_(or_(REVISION.c.tiddler_id > last_tiddler,
+                    and_(REVISION.c.tiddler_id == last_tiddler,
+                        REVISION.c.number > last_number)),
+                    ~TIDDLER_BAG_DELETING))
+                .order_by(REVISION.c.tiddler_id, REVISION.c.number)
+                .limit(chunk_size)).fetchall()
+            if not revisions:
+                break
+
+            numbers = [row.number for row in revisions]
+            tags = {}
+            for number, tag in session.execute(select([TAG.c.revision_number,
+                TAG.c.tag]).where(TAG.c.revision_number.in_(numbers))):
+                tags.setdefault(number, []).append(tag)
+            fields = {}
+            for number, name, value in session.execute(select([
+                FIELD.c.revision_number, FIELD.c.name, FIELD.c.value])
+                .where(FIELD.c.revision_number.in_(numbers))):
+                fields.setdefault(number, {})[name] = value
+
+            for row in revisions:
+                if row.id != last_tiddler:
+                    write({'type': 'tiddler', 'id': row.id, 'bag': row.bag,
+                        'title': row.title})
+                    count += 1
+                write({'type': 'revision', 'number': row.number,
+                    'modified': row.modified, 'modifier': row.modifier,
+                    'tiddler_type': row.type, 'text': row.text,
+                    'tags': tags.get(row.number, []),
+                    'fields': fields.get(row.number, {})})
+                count += 1
+                last_tiddler, last_number = row.id, row.number
+            if progress:
+                progress(count, time.time() - start)
+
+        last_number = 0
+        while True:
+            tombstones = session.execute(select([tombstone_table])
+                .where(tombstone_table.c.number > last_number)
+                .order_by(tombstone_table.c.number)
+                .limit(chunk_size)).fetchall()
+            if not tombstones:
+                break
+            for number, bag, title in tombstones:
+                write({'type': 'tombstone', 'number': number, 'bag': bag,
+                    'title': title})
+                count += 1
+            last_number = tombstones[-1][0]
+            if progress:
+                progress(count, time.time() - start)
+    finally:
+        session.close()
+
+    return count, time.time() - start
+
+
+def load_store(storage, lines, chunk_size=CHUNK_SIZE,
+        transaction_size=TRANSACTION_SIZE, progress=None):
+    """
+    Load the dump in the iterable lines into storage, which should
+    be empty. Rows are inserted chunk_size at a time and committed
+    every transaction_size rows. progress, if given, is called with
+    the number of entities loaded and the elapsed seconds after each
+    chunk. Returns that count and time. With ``sqlalchemy3.bag_counters``
+    set the bag counters are rebuilt from the loaded tiddlers.
+    """
+    loader = Loader(storage, chunk_size, transaction_size, progress)
+    try:
+        for line in lines:
+            if line.strip():
+                loader.load(json.loads(line))
+        loader.finish()
+        if storage._counting():
+            storage.rebuild_bag_counters()
+    except:
+        storage.session.rollback()
+        raise
+    finally:
+        storage.session.close()
+    return loader.count, time.time() - loader.start
+
+
+def fill_field_types(storage, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Add the typed value columns, and any other missing columns and
+    indexes, if they are missing, then set them from the value of
+    every field row, committing after each chunk. progress, if given, is
+    called with the number of rows updated and the elapsed seconds
+    after each chunk. Returns that count and time.
+    """
+    start = time.time()
+    count = 0
+    session = storage.session
+    engine = session.get_bind()
+
+    add_missing_columns(engine)
+    create_missing_indexes(engine)
+
+    update = (FIELD.update()
+            .where(and_(FIELD.c.revision_number == bindparam('b_number'),
+                FIELD.c.name == bindparam('b_name')))
+            .values(value_number=bindparam('b_value_number'),
+                value_date=bindparam('b_value_date')))
+    last_number, last_name = 0, u''
+    try:
+        while True:
+            rows = session.execute(select([FIELD.c.revision_number,
+                FIELD.c.name, FIELD.c.value])
+                .where(or_(FIELD.c.revision_number > last_number,
+                    and_(FIELD.c.revision_number == last_number,
+                        FIELD.c.name > last_name)))
+                .order_by(FIELD.c.revision_number, FIELD.c.name)
+                .limit(chunk_size)).fetchall()
+            if not rows:
+                break
+            session.execute(update, [dict(b_number=number, b_name=name,
+                **dict(('b_%s' % key, value) for key, value
+                    in field_types(value).items()))
+                for number, name, value in rows])
+            session.commit()
+            count += len(rows)
+            last_number, last_name = rows[-1][0], rows[-1][1]
+            if progress:
+                progress(count, time.time() - start)
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    return count, time.time() - start
+
+
+class Loader(object):
+    """
+    Buffer rows from dump records and insert them in chunks.
+    """
+
+    def __init__(self, storage, chunk_size, transaction_size, progress):
+        self.storage = storage
+        self.session = storage.session
+        self.dialect = self.session.get_bind().dialect
+        self.chunk_size = chunk_size
+        self.transaction_size = transaction_size
+        self.progress = progress
+        self.rows = dict((table, []) for table in LOAD_ORDER)
+        self.buffered = 0
+        self.uncommitted = 0
+        self.count = 0
+        self.start = time.time()
+        self.tiddler = None
+        self.first = self.current = None
+
+    def load(self, record):
+        kind = record['type']
+        if kind == 'header':
+            if record['version'] != DUMP_VERSION:
+                raise ValueError('unsupported dump version %s'
+                        % record['version'])
+            return
+        self.count += 1
+        if kind == 'tiddler':
+            self._end_tiddler()
+            self.tiddler = record['id']
+            self._add(TIDDLER, {'id': record['id'], 'bag': record['bag'],
+                'title': record['title']})
+        elif kind == 'revision':
+            self._load_revision(record)
+        elif kind == 'tombstone':
+            self._add(tombstone_table, {'number': record['number'],
+                'bag': record['bag'], 'title': record['title']})
+        elif kind == 'bag':
+            bag = Bag(record['name'])
+            bag.desc = record['desc']
+            _load_policy(bag.policy, record['policy'])
+            self.storage.bag_put(bag)
+        elif kind == 'recipe':
+            recipe = Recipe(record['name'])
+            recipe.desc = record['desc']
+            _load_policy(recipe.policy, record['policy'])
+            recipe.set_recipe([tuple(line) for line in record['recipe']])
+            self.storage.recipe_put(recipe)
+        elif kind == 'user':
+            user = User(record['usersign'])
+            user._password = record['password']
+            user.note = record['note']
+            for role in record['roles']:
+                user.add_role(role)
+            self.storage.user_put(user)
+        else:
+            raise ValueError('unknown dump record type %s' % kind)
+
+    def finish(self):
+        self._end_tiddler()
+        self._flush()
+        self._commit()
+        if self.dialect.name == 'postgresql':
+            self.session.execute("SELECT setval(pg_get_serial_sequence("
+                "'%s', 'id'), (SELECT max(id) FROM %s))"
+                % (TIDDLER.name, TIDDLER.name))
+        # tombstones may be numbered past the last loaded revision
+        restart_revision_sequence(self.session.connection())
+        self._commit()
+
+    def _load_revision(self, record):
+        number = record['number']
+        if self.first is None:
+            self.first = number
+        self.current = number
+        self._add(REVISION, {'number': number, 'tiddler_id': self.tiddler,
+            'modified': record['modified'], 'modifier': record['modifier'],
+            'type': record['tiddler_type']})
+        if record['text'] is not None:
+            self._add(TEXT, {'revision_number': number,
+                'text': record['text']})
+        for tag in record['tags']:
+            self._add(TAG, {'revision_number': number, 'tag': tag})
+        for name, value in record['fields'].items():
+            self._add(FIELD, dict(field_types(value),
+                revision_number=number, name=name, value=value))
+
+    def _end_tiddler(self):
+        if self.tiddler is not None and self.current is not None:
+            self._add(current_revision_table, {'tiddler_id': self.tiddler,
+                'current_id': self.current})
+            self._add(first_revision_table, {'tiddler_id': self.tiddler,
+                'first_id': self.first})
+        self.tiddler = self.first = self.current = None
+
+    def _add(self, table, row):
+        # Rows arrive after the rows they refer to, and each flush
+        # inserts in LOAD_ORDER, so a flush may happen at any point.
+        self.rows[table].append(row)
+        self.buffered += 1
+        if self.buffered >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffered:
+            return
+        connection = self.session.connection()
+        for table in LOAD_ORDER:
+            rows = self.rows[table]
+            if not rows:
+                continue
+            if (self.dialect.name == 'postgresql'
+                    and self.dialect.driver == 'psycopg2'):
+                _copy_rows(connection, table, rows)
+            else:
+                connection.execute(table.insert(), rows)
+            self.rows[table] = []
+        self.uncommitted += self.buffered
+        self.buffered = 0
+        if self.uncommitted >= self.transaction_size:
+            self._commit()
+        if self.progress:
+            self.progress(self.count, time.time() - self.start)
+
+    def _commit(self):
+        self.session.commit()
+        self.uncommitted = 0
+
+
+def _copy_rows(connection, table, rows):
+    """
+    Insert rows into table with PostgreSQL COPY.
+    """
+    columns = rows[0].keys()
+    data = StringIO()
+    for row in rows:
+        data.write('\t'.join(_copy_value(row[column]) for column in columns))
+        data.write('\n')
+    data.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table.name,
+            ', '.join(columns)), data)
+    finally:
+        cursor.close()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        # str() rounds to 12 significant digits
+        return repr(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _dump_policy(policy):
+    return dict((attribute, getattr(policy, attribute))
+            for attribute in policy.attributes)
+
+
+def _load_policy(policy, values):
+    for attribute, value in values.items():
+        setattr(policy, attribute, value)
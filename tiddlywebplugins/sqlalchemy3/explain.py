@@ -0,0 +1,214 @@
+"""
+Explain the SQL generated for a search query.
+
+:py:func:`explain_search` returns the parsed AST, the generated SQL
+and its parameters, and the database's query plan for it, along with
+warnings about parts of the plan that are likely to be slow: full
+table scans, temporary B-trees or tables used for sorting and
+grouping, columns filtered on without an index and LIKE patterns
+with a leading wildcard.
+"""
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import Table
+from sqlalchemy.sql.expression import (Executable, ClauseElement,
+        BinaryExpression, BindParameter, Alias)
+from sqlalchemy.sql.visitors import iterate
+
+from .parser import dump_ast
+
+
+EXPLAIN_PREFIXES = {
+        'sqlite': 'EXPLAIN QUERY PLAN',
+        'postgresql': 'EXPLAIN',
+        'mysql': 'EXPLAIN',
+        }
+
+
+class Explain(Executable, ClauseElement):
+    """
+    An EXPLAIN of a select statement.
+    """
+
+    def __init__(self, statement, prefix):
+        self.statement = statement
+        self.prefix = prefix
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kwargs):
+    return '%s %s' % (element.prefix,
+            compiler.process(element.statement, **kwargs))
+
+
+def explain_search(session, ast, query):
+    """
+    Explain the query produced from ast, returning a dict with
+    ast, sql, params, plan and warnings keys.
+    """
+    statement = query.statement
+    dialect = session.get_bind().dialect
+    compiled = statement.compile(dialect=dialect)
+
+    prefix = EXPLAIN_PREFIXES.get(dialect.name, 'EXPLAIN')
+    result = session.execute(Explain(statement, prefix))
+    plan = [tuple(row) for row in result]
+    columns = result.keys()
+    result.close()
+
+    tables = _filtered_columns(statement)
+    if dialect.name == 'sqlite':
+        warnings = _sqlite_warnings(plan, tables)
+    elif dialect.name == 'mysql':
+        warnings = _mysql_warnings(plan, columns, tables)
+    elif dialect.name == 'postgresql':
+        warnings = _postgresql_warnings(plan, tables)
+    else:
+        warnings = []
+    warnings.extend(_like_warnings(statement))
+
+    return {
+            'ast': dump_ast(ast),
+            'sql': unicode(compiled),
+            'params': compiled.params,
+            'plan': plan,
+            'warnings': warnings,
+            }
+
+
+def format_explanation(explanation):
+    """
+    Turn the dict returned by :py:func:`explain_search` into text.
+    """
+    lines = ['AST:', explanation['ast'], '', 'SQL:', explanation['sql'],
+            '', 'Parameters:']
+    for key, value in sorted(explanation['params'].items()):
+        lines.append('  %s = %r' % (key, value))
+    lines.extend(['', 'Plan:'])
+    for row in explanation['plan']:
+        lines.append('  ' + ' | '.join(unicode(item) for item in row))
+    lines.extend(['', 'Warnings:'])
+    if explanation['warnings']:
+        lines.extend('  ' + warning for warning in explanation['warnings'])
+    else:
+        lines.append('  none')
+    return '\n'.join(lines)
+
+
+def _sqlite_warnings(plan, tables):
+    warnings = []
+    for row in plan:
+        detail = row[-1]
+        words = detail.split()
+        if words[0] == 'SCAN' and 'INDEX' not in words:
+            # older sqlite says "SCAN TABLE name", newer "SCAN name"
+            table = words[1] == 'TABLE' and words[2] or words[1]
+            warnings.extend(_scan_warnings(table, tables))
+        elif 'TEMP B-TREE' in detail:
+            warnings.append('temporary B-tree: %s' % detail)
+    return warnings
+
+
+def _mysql_warnings(plan, columns, tables):
+    warnings = []
+    for row in plan:
+        row = dict(zip(columns, row))
+        if row.get('type') == 'ALL':
+            warnings.extend(_scan_warnings(row.get('table'), tables))
+        extra = row.get('Extra') or ''
+        if 'Using temporary' in extra or 'Using filesort' in extra:
+            warnings.append('temporary table or filesort on %s: %s'
+                    % (row.get('table'), extra))
+    return warnings
+
+
+def _postgresql_warnings(plan, tables):
+    warnings = []
+    for row in plan:
+        detail = row[0].strip().lstrip('->').strip()
+        if detail.startswith('Seq Scan on '):
+            words = detail.split()
+            # "Seq Scan on table alias (cost...)"
+            table = words[3]
+            if len(words) > 4 and not words[4].startswith('('):
+                table = words[4]
+            warnings.extend(_scan_warnings(table, tables))
+        elif detail.startswith('Sort ') and 'external' in detail:
+            warnings.append('sort spilled to disk: %s' % detail)
+    return warnings
+
+
+def _scan_warnings(name, tables):
+    """
+    Warn of a full scan of the table (or alias) called name, noting
+    any columns that are filtered on but lead no index.
+    """
+    warnings = ['full scan of %s' % name]
+    table, columns = tables.get(name, (None, []))
+    if table is not None:
+        for column in columns:
+            if not _indexed(table, column):
+                warnings.append('missing index: %s.%s is filtered on but '
+                        'leads no index' % (table.name, column))
+    return warnings
+
+
+def _indexed(table, column_name):
+    for index in table.indexes:
+        if index.columns.keys()[0] == column_name:
+            return True
+    for constraint in table.constraints:
+        keys = constraint.columns.keys()
+        if keys and keys[0] == column_name:
+            return True
+    return False
+
+
+def _filtered_columns(statement):
+    """
+    Map table and alias names to (table, column names) for the
+    columns compared in the where clause of statement.
+    """
+    tables = {}
+    whereclause = _where(statement)
+    if whereclause is None:
+        return tables
+    for element in iterate(whereclause, {}):
+        if isinstance(element, BinaryExpression):
+            for side in (element.left, element.right):
+                selectable = getattr(side, 'table', None)
+                if selectable is not None:
+                    table = selectable
+                    if isinstance(selectable, Alias):
+                        table = selectable.original
+                    if not isinstance(table, Table):
+                        continue
+                    names = tables.setdefault(selectable.name,
+                            (table, []))[1]
+                    if side.name not in names:
+                        names.append(side.name)
+    return tables
+
+
+def _like_warnings(statement):
+    warnings = []
+    whereclause = _where(statement)
+    if whereclause is None:
+        return warnings
+    for element in iterate(whereclause, {}):
+        if (isinstance(element, BinaryExpression)
+                and getattr(element.operator, '__name__', '') == 'like_op'
+                and isinstance(element.right, BindParameter)):
+            value = element.right.value
+            if isinstance(value, basestring) and value.startswith('%'):
+                warnings.append('leading wildcard LIKE %r on %s cannot use '
+                        'an index' % (value, element.left))
+    return warnings
+
+
+def _where(statement):
+    # whereclause is public from sqlalchemy 1.4
+    try:
+        return statement.whereclause
+    except AttributeError:
+        return statement._whereclause
@@ -0,0 +1,134 @@
+"""
+Guardrails on the cost of a search, so that one expensive query
+cannot hold a database connection, or core, for long. Each is off
+unless set in config:
+
+``sqlalchemy3.search_max_nodes``
+    refuse queries whose AST has more nodes than this
+
+``sqlalchemy3.search_max_joins``
+    refuse queries which join more tag, field and text tables than this
+
+``sqlalchemy3.search_leading_wildcards``
+    ``refuse`` or ``rewrite`` fielded terms such as ``title:*foo*``,
+    whose LIKE pattern cannot use an index, and plain words with a
+    leading wildcard such as ``*foo*``. Rewriting drops the leading
+    wildcards of a fielded term, making a prefix match, and all the
+    wildcards of a plain word, which is matched anywhere in the text
+    with ``*`` as a literal character.
+
+``sqlalchemy3.search_timeout``
+    seconds a search statement may run: ``statement_timeout`` on
+    PostgreSQL, a ``MAX_EXECUTION_TIME`` hint on MySQL and a progress
+    handler on SQLite
+
+Every refusal raises StoreError.
+"""
+
+import time
+
+from contextlib import contextmanager
+
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.sql.expression import text
+
+from tiddlyweb.store import StoreError
+
+
+# SQLite virtual machine instructions between checks of the deadline.
+SQLITE_PROGRESS_STEPS = 1000
+
+
+def check_ast(ast, config):
+    """
+    Refuse ast if it is too large or, as configured, has leading
+    wildcard terms, rewriting those terms in place when so configured.
+    """
+    max_nodes = int(config.get('sqlalchemy3.search_max_nodes', 0))
+    wildcards = config.get('sqlalchemy3.search_leading_wildcards', 'allow')
+    nodes = _check_node(ast, False, wildcards)
+    if max_nodes and nodes > max_nodes:
+        raise StoreError('search query refused, %s nodes is more than '
+                'the %s allowed' % (nodes, max_nodes))
+
+
+def check_joins(joins, config):
+    """
+    Refuse a produced query which made joins joins.
+    """
+    max_joins = int(config.get('sqlalchemy3.search_max_joins', 0))
+    if max_joins and joins > max_joins:
+        raise StoreError('search query refused, %s joins is more than '
+                'the %s allowed' % (joins, max_joins))
+
+
+@contextmanager
+def time_limit(session, query, config):
+    """
+    Limit the time the statement of query may run to the configured
+    search timeout, yielding the query to run. A statement stopped by
+    the limit raises StoreError.
+    """
+    timeout = float(config.get('sqlalchemy3.search_timeout', 0))
+    if not timeout:
+        yield query
+        return
+
+    milliseconds = int(timeout * 1000)
+    dialect = session.get_bind().dialect.name
+    connection = None
+    start = time.time()
+    if dialect == 'postgresql':
+        # ends with the transaction, as the session is closed after
+        session.execute(text('SET LOCAL statement_timeout = %d'
+            % milliseconds))
+    elif dialect == 'mysql':
+        query = query.prefix_with('/*+ MAX_EXECUTION_TIME(%d) */'
+                % milliseconds)
+    elif dialect == 'sqlite':
+        connection = session.connection().connection.connection
+        connection.set_progress_handler(
+                lambda: time.time() - start > timeout,
+                SQLITE_PROGRESS_STEPS)
+    try:
+        yield query
+    except DatabaseError, exc:
+        if time.time() - start < timeout:
+            raise
+        raise StoreError('search query stopped after %s seconds: %s'
+                % (timeout, exc))
+    finally:
+        if connection is not None:
+            connection.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
+
+
+def _check_node(node, fielded, wildcards):
+    """
+    Return the number of nodes in the AST node, not counting control
+    terms, refusing or rewriting any leading wildcard in it. fielded
+    is True for the value of a field term.
+    """
+    name = node.getName()
+    if name == 'Field':
+        if node[0].startswith('_'):
+            # _limit, _after and _rank control the search
+            return 0
+        return 1 + _check_node(node[1], True, wildcards)
+    if name == 'Boost':
+        return 1 + _check_node(node[0], fielded, wildcards)
+    if name == 'Word':
+        value = node[0]
+        # a fielded value is only a pattern with a trailing wildcard
+        if (isinstance(value, basestring) and value.startswith('*')
+                and (value.endswith('*') or not fielded)
+                and wildcards != 'allow'):
+            if fielded:
+                rewritten = value.lstrip('*')
+            else:
+                rewritten = value.strip('*')
+            if wildcards != 'rewrite' or not rewritten:
+                raise StoreError('search query refused, leading wildcard '
+                        'in %s' % value)
+            node[0] = rewritten
+    return 1 + sum(_check_node(child, False, wildcards) for child in node
+            if not isinstance(child, basestring))
@@ -0,0 +1,273 @@
+"""
+Instrumentation for the sqlalchemy store.
+
+When ``sqlalchemy3.instrument`` is true in config, each public Store
+method is wrapped to record a latency histogram, the number of SQL
+statements issued per call and the number of rows (entities) it
+returned. SQL statements are timed with the engine's
+``before_cursor_execute`` and ``after_cursor_execute`` events, and any
+statement slower than ``sqlalchemy3.slow_query_threshold`` seconds
+(default 1.0) is logged, along with the store method and search query
+that caused it, to the ``tiddlywebplugins.sqlalchemy3.slowquery``
+logger.
+
+Statistics are kept per process, as Store instances are made per
+request.
+"""
+
+import logging
+import threading
+import time
+
+from bisect import bisect_left
+from functools import wraps
+from types import GeneratorType
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+SLOW_LOGGER = logging.getLogger('tiddlywebplugins.sqlalchemy3.slowquery')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+        0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+INSTRUMENTED_METHODS = ['list_recipes', 'list_bags', 'list_users',
+        'list_bag_tiddlers', 'list_tiddler_revisions', 'recipe_delete',
+        'recipe_get', 'recipe_put', 'bag_delete', 'bag_get', 'bag_put',
+        'tiddler_delete', 'tiddler_get', 'tiddler_put', 'user_delete',
+        'user_get', 'user_put', 'search', 'tiddler_history',
+        'tiddler_get_revisions', 'recipe_tiddlers', 'bag_stats',
+        'recipe_stats', 'changes_since']
+
+
+class Histogram(object):
+    """
+    A cumulative histogram with fixed upper bounds, in the style
+    of Prometheus: each bucket counts the observations less than
+    or equal to its bound.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {
+                'count': self.count,
+                'sum': self.sum,
+                'buckets': zip(self.buckets, cumulative),
+                }
+
+
+class OperationStats(object):
+    """
+    Accumulated statistics for one Store method.
+    """
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.rows = 0
+        self.errors = 0
+
+    def snapshot(self):
+        return {
+                'latency': self.latency.snapshot(),
+                'statements': self.statements.snapshot(),
+                'rows': self.rows,
+                'errors': self.errors,
+                }
+
+
+class Operation(object):
+    """
+    The state of one in-progress call to a Store method.
+    """
+
+    def __init__(self, method, search_query=None):
+        self.method = method
+        self.search_query = search_query
+        self.start = time.time()
+        self.statements = 0
+        self.rows = 0
+        self.error = False
+
+
+class Instrumentation(object):
+    """
+    Collect statistics about Store methods and the SQL they run.
+    """
+
+    def __init__(self, slow_threshold=1.0):
+        self.slow_threshold = slow_threshold
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def current(self):
+        """
+        Return the innermost Operation active in this thread, if any.
+        """
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return None
+
+    def instrument_engines(self):
+        """
+        Listen for statement execution on all engines. Listening on
+        the Engine class, rather than one engine, catches statements
+        run by sessions still bound to an engine from an earlier Store.
+        """
+        if not event.contains(Engine, 'before_cursor_execute',
+                self._before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                    self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                    self._after_cursor_execute)
+
+    def instrument_store(self, store):
+        """
+        Replace the public methods on the store instance with timed
+        versions.
+        """
+        for name in INSTRUMENTED_METHODS:
+            method = getattr(store, name, None)
+            if method is not None:
+                setattr(store, name, self.wrap(name, method))
+
+    def wrap(self, name, method):
+        """
+        Wrap method so each call is recorded as an Operation. If the
+        method returns a generator the Operation lasts until the
+        generator is exhausted or closed.
+        """
+
+        @wraps(method)
+        def _instrumented(*args, **kwargs):
+            search_query = None
+            if name == 'search':
+                search_query = kwargs.get('search_query',
+                        args and args[0] or '')
+            operation = Operation(name, search_query)
+            self._push(operation)
+            try:
+                result = method(*args, **kwargs)
+            except:
+                operation.error = True
+                self._pop()
+                self.record(operation)
+                raise
+            self._pop()
+            if isinstance(result, GeneratorType):
+                return self._wrap_generator(result, operation)
+            if isinstance(result, (list, tuple)):
+                operation.rows += len(result)
+            elif result is not None:
+                operation.rows += 1
+            self.record(operation)
+            return result
+
+        return _instrumented
+
+    def record(self, operation):
+        """
+        Add a completed Operation to the statistics.
+        """
+        elapsed = time.time() - operation.start
+        with self.lock:
+            stats = self.stats.get(operation.method)
+            if stats is None:
+                stats = self.stats[operation.method] = OperationStats()
+            stats.latency.observe(elapsed)
+            stats.statements.observe(operation.statements)
+            stats.rows += operation.rows
+            if operation.error:
+                stats.errors += 1
+
+    def snapshot(self):
+        """
+        Return a dict of method name to a dict of its statistics.
+        """
+        with self.lock:
+            return dict((name, stats.snapshot())
+                    for name, stats in self.stats.items())
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def _wrap_generator(self, generator, operation):
+        try:
+            while True:
+                self._push(operation)
+                try:
+                    item = generator.next()
+                except StopIteration:
+                    break
+                except:
+                    operation.error = True
+                    raise
+                finally:
+                    self._pop()
+                operation.rows += 1
+                yield item
+        finally:
+            generator.close()
+            self.record(operation)
+
+    def _push(self, operation):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(operation)
+
+    def _pop(self):
+        self.local.stack.pop()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+            context, executemany):
+        # kept on the execution context, which is dropped along with
+        # it if the statement raises
+        if context is not None:
+            context.sqlalchemy3_query_start = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+            context, executemany):
+        operation = self.current()
+        if operation is not None:
+            operation.statements += 1
+        # no start without a context, or when listening began mid
+        # statement
+        start = getattr(context, 'sqlalchemy3_query_start', None)
+        if start is None:
+            return
+        elapsed = time.time() - start
+        if elapsed >= self.slow_threshold:
+            if operation is not None:
+                method = operation.method
+                search_query = operation.search_query
+            else:
+                method = search_query = None
+            SLOW_LOGGER.warning('slow query %.3fs in %s, search: %r: '
+                    '%s %r', elapsed, method, search_query,
+                    ' '.join(statement.split()), parameters)
+
+
+INSTRUMENTATION = Instrumentation()
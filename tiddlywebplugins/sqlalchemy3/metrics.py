@@ -0,0 +1,329 @@
+"""
+A small metrics registry for the sqlalchemy store, rendered in the
+Prometheus text exposition format.
+
+Counters and histograms are updated in place as the store works and
+cost one lock acquisition per update. Gauges, such as connection
+pool state, and the per-method statistics gathered by
+:py:mod:`tiddlywebplugins.sqlalchemy3.instrument` are read by
+collectors when the registry is rendered.
+
+The rendered text can be served by :py:func:`metrics_app`, mounted
+at ``sqlalchemy3.metrics_uri`` in config, or written periodically to
+``sqlalchemy3.metrics_file`` for the node exporter's textfile
+collector.
+"""
+
+import os
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from .instrument import Histogram, INSTRUMENTATION, LATENCY_BUCKETS
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    """
+    A monotonically increasing value.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class LockedHistogram(Histogram):
+    """
+    A Histogram that may be observed from several threads.
+    """
+
+    def __init__(self, buckets):
+        Histogram.__init__(self, buckets)
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            Histogram.observe(self, value)
+
+
+class MetricFamily(object):
+    """
+    A named metric with a set of labelled children. A family with
+    no label names has a single child.
+    """
+
+    def __init__(self, name, kind, help_text, label_names=(),
+            buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        Return the child for the given label values, in the order of
+        the family's label names, creating it if needed.
+        """
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    if self.kind == 'histogram':
+                        child = LockedHistogram(self.buckets)
+                    else:
+                        child = Counter()
+                    self.children[values] = child
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        """
+        Yield (name, labels, value) for each child.
+        """
+        for values, child in sorted(self.children.items()):
+            labels = zip(self.label_names, values)
+            if self.kind == 'histogram':
+                for sample in histogram_samples(self.name, labels,
+                        child.snapshot()):
+                    yield sample
+            else:
+                yield self.name, labels, child.value
+
+
+class Registry(object):
+    """
+    Hold the metric families and collectors that make up the
+    exposition.
+    """
+
+    def __init__(self):
+        self.families = []
+        self.collectors = []
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add(MetricFamily(name, 'counter', help_text,
+            label_names))
+
+    def histogram(self, name, help_text, label_names=(),
+            buckets=LATENCY_BUCKETS):
+        return self._add(MetricFamily(name, 'histogram', help_text,
+            label_names, buckets))
+
+    def register_collector(self, collector):
+        """
+        Add a callable which returns a list of (name, kind, help,
+        samples) tuples, where samples is a list of (name, labels,
+        value).
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        for family in self.families:
+            yield (family.name, family.kind, family.help_text,
+                    list(family.samples()))
+        for collector in self.collectors:
+            for metric in collector():
+                yield metric
+
+    def render(self):
+        """
+        Return the current state of all metrics as Prometheus
+        exposition text.
+        """
+        lines = []
+        for name, kind, help_text, samples in self.collect():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name,
+                    _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+
+def histogram_samples(name, labels, snapshot):
+    """
+    Turn a Histogram snapshot into bucket, sum and count samples.
+    """
+    labels = list(labels)
+    for bound, count in snapshot['buckets']:
+        yield ('%s_bucket' % name, labels + [('le', _format_value(bound))],
+                count)
+    yield '%s_bucket' % name, labels + [('le', '+Inf')], snapshot['count']
+    yield '%s_sum' % name, labels, snapshot['sum']
+    yield '%s_count' % name, labels, snapshot['count']
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+            for key, value in labels)
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+SEARCH_SECONDS = REGISTRY.histogram('sqlalchemy3_search_seconds',
+        'Time spent parsing, compiling and executing searches.',
+        ['phase'])
+SEARCH_PARSE = SEARCH_SECONDS.labels('parse')
+SEARCH_COMPILE = SEARCH_SECONDS.labels('compile')
+SEARCH_EXECUTE = SEARCH_SECONDS.labels('execute')
+
+ROWS_STREAMED = REGISTRY.counter('sqlalchemy3_rows_streamed_total',
+        'Entities yielded by store list and search methods.', ['method'])
+
+POOL_CHECKOUTS = REGISTRY.counter('sqlalchemy3_pool_checkouts_total',
+        'Connections checked out of the pool.')
+POOL_CHECKINS = REGISTRY.counter('sqlalchemy3_pool_checkins_total',
+        'Connections returned to the pool.')
+
+ENGINES = weakref.WeakSet()
+
+
+def track_engine(engine):
+    """
+    Include the pool of engine in the pool gauges, and count pool
+    checkouts and checkins.
+    """
+    ENGINES.add(engine)
+    if not event.contains(Pool, 'checkout', _on_checkout):
+        event.listen(Pool, 'checkout', _on_checkout)
+        event.listen(Pool, 'checkin', _on_checkin)
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKOUTS.inc()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    POOL_CHECKINS.inc()
+
+
+def _pool_collector():
+    checked_out = 0
+    overflow = 0
+    size = 0
+    for engine in list(ENGINES):
+        pool = engine.pool
+        if hasattr(pool, 'checkedout'):
+            checked_out += pool.checkedout()
+            overflow += max(pool.overflow(), 0)
+            size += pool.size()
+    return [
+            ('sqlalchemy3_pool_checked_out', 'gauge',
+                'Connections currently checked out of the pool.',
+                [('sqlalchemy3_pool_checked_out', [], checked_out)]),
+            ('sqlalchemy3_pool_overflow', 'gauge',
+                'Connections open beyond the configured pool size.',
+                [('sqlalchemy3_pool_overflow', [], overflow)]),
+            ('sqlalchemy3_pool_size', 'gauge',
+                'Configured size of the connection pool.',
+                [('sqlalchemy3_pool_size', [], size)]),
+            ]
+
+
+def _instrumentation_collector():
+    snapshot = INSTRUMENTATION.snapshot()
+    latency = []
+    statements = []
+    rows = []
+    errors = []
+    for method, stats in sorted(snapshot.items()):
+        labels = [('method', method)]
+        latency.extend(histogram_samples('sqlalchemy3_method_seconds',
+            labels, stats['latency']))
+        statements.extend(histogram_samples(
+            'sqlalchemy3_method_statements', labels, stats['statements']))
+        rows.append(('sqlalchemy3_method_rows_total', labels, stats['rows']))
+        errors.append(('sqlalchemy3_method_errors_total', labels,
+            stats['errors']))
+    if not snapshot:
+        return []
+    return [
+            ('sqlalchemy3_method_seconds', 'histogram',
+                'Latency of instrumented store methods.', latency),
+            ('sqlalchemy3_method_statements', 'histogram',
+                'SQL statements issued per store method call.', statements),
+            ('sqlalchemy3_method_rows_total', 'counter',
+                'Rows returned by store methods.', rows),
+            ('sqlalchemy3_method_errors_total', 'counter',
+                'Store method calls that raised an exception.', errors),
+            ]
+
+
+REGISTRY.register_collector(_pool_collector)
+REGISTRY.register_collector(_instrumentation_collector)
+
+
+def metrics_app(environ, start_response):
+    """
+    WSGI application presenting the registry as Prometheus text.
+    """
+    output = REGISTRY.render()
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+        ('Cache-Control', 'no-cache')])
+    return [output]
+
+
+def write_metrics(filename):
+    """
+    Atomically write the registry to filename.
+    """
+    temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'w') as output:
+        output.write(REGISTRY.render())
+    os.rename(temp_filename, filename)
+
+
+class MetricsWriter(threading.Thread):
+    """
+    A daemon thread which writes the registry to a file every
+    interval seconds.
+    """
+
+    def __init__(self, filename, interval):
+        threading.Thread.__init__(self, name='sqlalchemy3-metrics')
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            write_metrics(self.filename)
@@ -0,0 +1,203 @@
+"""
+Keep the revision number sequence from handing out a number twice.
+
+Tombstones in the change feed take their numbers from the revision
+sequence, by inserting a revision and deleting it again at once, so
+a sequence which reuses the numbers of deleted rows would number
+later revisions below earlier deletions, and eventually repeat a
+tombstone's number.
+
+PostgreSQL sequences never go back. A SQLite ``revision`` table only
+keeps its high water mark if it was created ``AUTOINCREMENT``, which
+tables made before that was declared were not:
+:py:func:`check_revision_sequence` finds them, and the store then
+records no tombstones and refuses the change feed until
+:py:func:`migrate_revision_sequence` (``twanager sqlmigrate``) has
+rebuilt the table. InnoDB before MySQL 8 resets ``AUTO_INCREMENT`` to
+the highest row on restart, so :py:func:`raise_auto_increment` moves
+it past the highest tombstone on each new connection.
+
+Tables which already exist are left alone by ``create_all``, so
+:py:func:`add_missing_columns` adds columns added to the model since,
+at store start, and :py:func:`create_missing_indexes` the indexes,
+from ``twanager sqlmigrate`` as they may take a while on large tables.
+"""
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.sql.expression import text
+
+from tiddlyweb.store import StoreError
+
+from .model import Base, sField, sRevision
+
+
+MIGRATING_TABLE = 'revision_unmigrated'
+# Columns which may be missing from tables made by older versions.
+ADDED_COLUMNS = [(sField.__table__, ['value_number', 'value_date'])]
+# The number after which the revision sequence should continue.
+HIGHEST_NUMBER = ('SELECT COALESCE(MAX(number), 0) FROM ('
+        'SELECT MAX(number) AS number FROM revision UNION ALL '
+        'SELECT MAX(number) FROM tombstone) AS numbers')
+
+
+def add_missing_columns(engine):
+    """
+    Add the ADDED_COLUMNS which are missing from their tables, as
+    nullable columns. Return the names of the columns added.
+    """
+    inspector = inspect(engine)
+    added = []
+    for table, names in ADDED_COLUMNS:
+        columns = set(column['name']
+                for column in inspector.get_columns(table.name))
+        for name in names:
+            if name not in columns:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, name,
+                    table.c[name].type.compile(dialect=engine.dialect)))
+                added.append('%s.%s' % (table.name, name))
+    return added
+
+
+def create_missing_indexes(engine):
+    """
+    Create the indexes of the model which are missing from tables
+    made before they were declared. Return the names of the indexes
+    created.
+    """
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name']
+                for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+
+def check_revision_sequence(engine):
+    """
+    Raise StoreError if the revision table of engine may reuse the
+    numbers of deleted revisions.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    sql = engine.execute("SELECT sql FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'revision'").scalar()
+    if sql and 'AUTOINCREMENT' not in sql.upper():
+        raise StoreError('the revision table may reuse revision numbers, '
+                'run twanager sqlmigrate to rebuild it')
+
+
+def migrate_revision_sequence(engine):
+    """
+    Rebuild an SQLite revision table which is not AUTOINCREMENT, keeping
+    its rows, and start its sequence after the highest revision or
+    tombstone. Move the MySQL AUTO_INCREMENT past the highest tombstone.
+    Return True if anything was changed.
+    """
+    if engine.dialect.name == 'mysql':
+        raw = engine.raw_connection()
+        try:
+            return raise_auto_increment(raw.connection, None)
+        finally:
+            raw.close()
+    try:
+        check_revision_sequence(engine)
+        return False
+    except StoreError:
+        pass
+
+    table = sRevision.__table__
+    columns = ', '.join(column.name for column in table.columns)
+    raw = engine.raw_connection()
+    connection = raw.connection
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    cursor = connection.cursor()
+    # rename without rewriting the references of other tables, which
+    # are meant for the new table
+    cursor.execute('PRAGMA foreign_keys=OFF')
+    cursor.execute('PRAGMA legacy_alter_table=ON')
+    try:
+        cursor.execute('BEGIN')
+        try:
+            cursor.execute('ALTER TABLE revision RENAME TO %s'
+                    % MIGRATING_TABLE)
+            indexes = cursor.execute("SELECT name FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = ? "
+                    "AND sql IS NOT NULL", (MIGRATING_TABLE,)).fetchall()
+            for name, in indexes:
+                cursor.execute('DROP INDEX %s' % name)
+            cursor.execute(unicode(CreateTable(table).compile(
+                dialect=engine.dialect)))
+            for index in table.indexes:
+                cursor.execute(unicode(CreateIndex(index).compile(
+                    dialect=engine.dialect)))
+            cursor.execute('INSERT INTO revision (%s) SELECT %s FROM %s'
+                    % (columns, columns, MIGRATING_TABLE))
+            cursor.execute('DROP TABLE %s' % MIGRATING_TABLE)
+            highest = cursor.execute(HIGHEST_NUMBER).fetchone()[0]
+            cursor.execute("DELETE FROM sqlite_sequence "
+                    "WHERE name = 'revision'")
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) "
+                    "VALUES ('revision', ?)", (highest,))
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+    finally:
+        cursor.execute('PRAGMA legacy_alter_table=OFF')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+        connection.isolation_level = isolation_level
+        raw.close()
+    return True
+
+
+def restart_revision_sequence(connection):
+    """
+    Continue the revision sequence of connection after the highest
+    revision or tombstone, as needed after loading both with their
+    numbers.
+    """
+    highest = connection.execute(HIGHEST_NUMBER).scalar()
+    if not highest:
+        return
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text("SELECT setval(pg_get_serial_sequence("
+            "'revision', 'number'), :highest)"), highest=highest)
+    elif dialect == 'sqlite':
+        connection.execute("DELETE FROM sqlite_sequence "
+                "WHERE name = 'revision'")
+        connection.execute(text("INSERT INTO sqlite_sequence (name, seq) "
+            "VALUES ('revision', :highest)"), highest=highest)
+    elif dialect == 'mysql':
+        raise_auto_increment(connection.connection.connection, None)
+
+
+def raise_auto_increment(dbapi_connection, connection_record):
+    """
+    Move the MySQL revision AUTO_INCREMENT past the highest tombstone,
+    if it is not already. Return True if it was moved.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        try:
+            cursor.execute('SELECT (SELECT MAX(number) FROM tombstone), '
+                    '(SELECT COALESCE(MAX(number), 0) FROM revision)')
+        except dbapi_connection.ProgrammingError:
+            # the tables are not created yet
+            return False
+        tombstone, revision = cursor.fetchone()
+        if tombstone is None or tombstone <= revision:
+            return False
+        cursor.execute('ALTER TABLE revision AUTO_INCREMENT = %d'
+                % (tombstone + 1))
+        return True
+    finally:
+        cursor.close()
@@ -1,10 +1,18 @@
 
+import re
+
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.schema import (Table, Column, UniqueConstraint, ForeignKey)
-from sqlalchemy.types import Unicode, Integer, String, UnicodeText, CHAR
+from sqlalchemy.schema import (Table, Column, UniqueConstraint, ForeignKey,
+        Index)
+from sqlalchemy.types import (Unicode, Integer, String, UnicodeText, CHAR,
+        Float)
 from sqlalchemy.orm import relationship, mapper
 
+DATE_PATTERN = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2})'
+        r'(?:[T ]?(\d{2}):?(\d{2})(?::?(\d{2}))?)?Z?$')
+DATE_LIMITS = [None, (1, 12), (1, 31), (0, 23), (0, 59), (0, 60)]
+
 Base = declarative_base()
 Session = scoped_session(sessionmaker())
 
@@ -34,6 +42,37 @@ first_revision_table = Table('first_revision', Base.metadata,
             ondelete='CASCADE'), index=True, nullable=False),
         UniqueConstraint('tiddler_id', 'first_id'))
 
+# Per bag counts maintained on write when sqlalchemy3.bag_counters is
+# set, so bag statistics need not aggregate over the bag's tiddlers.
+bag_counter_table = Table('bag_counter', Base.metadata,
+        Column('bag', Unicode(128), ForeignKey('bag.name',
+            ondelete='CASCADE'), nullable=False, primary_key=True),
+        Column('tiddlers', Integer, nullable=False, default=0),
+        Column('revision', Integer, nullable=False, default=0),
+        Column('modified', String(14)))
+
+# Bags deleted with sqlalchemy3.chunked_bag_delete whose tiddlers are
+# still being removed, with how many there were and how many are gone.
+bag_deletion_table = Table('bag_deletion', Base.metadata,
+        Column('bag', Unicode(128), ForeignKey('bag.name',
+            ondelete='CASCADE'), nullable=False, primary_key=True),
+        Column('tiddlers', Integer, nullable=False, default=0),
+        Column('removed', Integer, nullable=False, default=0))
+
+# Deletions in the change feed. number comes from the revision
+# sequence, title is null when a whole bag was deleted.
+tombstone_table = Table('tombstone', Base.metadata,
+        Column('number', Integer, nullable=False, primary_key=True,
+            autoincrement=False),
+        Column('bag', Unicode(128), nullable=False),
+        Column('title', Unicode(128)))
+
+# Write generations for the search cache, with scope u'' for the whole
+# store or a bag name.
+generation_table = Table('generation', Base.metadata,
+        Column('scope', Unicode(128), nullable=False, primary_key=True),
+        Column('value', Integer, nullable=False, default=0))
+
 
 class sCurrentRevision(object):
     pass
@@ -50,22 +89,67 @@ mapper(sFirstRevision, first_revision_table)
 class sField(Base):
 
     __tablename__ = 'field'
+    __table_args__ = (
+            Index('ix_field_name_number', 'name', 'value_number'),
+            Index('ix_field_name_date', 'name', 'value_date'))
 
     revision_number = Column(Integer,
             ForeignKey('revision.number', ondelete='CASCADE'),
             nullable=False, index=True, primary_key=True)
     name = Column(Unicode(64), nullable=False, index=True, primary_key=True)
     value = Column(Unicode(1024), nullable=False, index=True)
+    # typed copies of value, for range searches
+    value_number = Column(Float(53))
+    value_date = Column(String(14))
 
     def __init__(self, name, value):
         object.__init__(self)
         self.name = name
         self.value = value
+        self.value_number = field_number(value)
+        self.value_date = field_date(value)
 
     def __repr__(self):
         return '<sField(%s:%s)>' % (self.name, self.value)
 
 
+def field_number(value):
+    """
+    Return value as a float if it is a finite number, else None.
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if number != number or number in (float('inf'), float('-inf')):
+        return None
+    return number
+
+
+def field_date(value, pad='0'):
+    """
+    Return value as a 14 digit TiddlyWeb timestamp if it is a date or
+    date and time, as YYYYMMDD[HHMM[SS]] or the ISO 8601 equivalent,
+    else None. Missing time digits are filled with pad.
+    """
+    match = DATE_PATTERN.match(value or '')
+    if not match:
+        return None
+    parts = [part for part in match.groups() if part is not None]
+    for part, limits in zip(parts, DATE_LIMITS):
+        if limits and not limits[0] <= int(part) <= limits[1]:
+            return None
+    return str(''.join(parts).ljust(14, pad))
+
+
+def field_types(value):
+    """
+    Return the typed shadow column values of a field row for value.
+    """
+    return {'value_number': field_number(value),
+            'value_date': field_date(value)}
+
+
 class sTag(Base):
 
     __tablename__ = 'tag'
@@ -104,6 +188,14 @@ class sText(Base):
 class sRevision(Base):
 
     __tablename__ = 'revision'
+    __table_args__ = (
+            Index('ix_revision_modified_tiddler', 'modified', 'tiddler_id'),
+            # covers revision history listings
+            Index('ix_revision_history', 'tiddler_id', 'number', 'modified',
+                'modifier', 'type'),
+            # never reuse the numbers of deleted revisions, so a new
+            # revision is always the highest
+            {'sqlite_autoincrement': True})
 
     tiddler_id = Column(Integer, ForeignKey('tiddler.id', ondelete='CASCADE'),
             nullable=False,
@@ -1,14 +1,368 @@
 """
 A search query string parser that generates an ast to be used elsewhere
 to create an appropriate SQL query.
+
+DEFAULT_PARSER is a hand written recursive descent parser. The
+pyparsing grammar it mirrors, returned by ``pyparsing_parser``, is
+the reference for its behaviour and is only built when first asked
+for. Both return a one item list holding the Toplevel node, and both
+raise ParseException for a query they cannot parse.
 """
 
-from pyparsing import (printables, alphanums, OneOrMore, Group,
-        Combine, Suppress, Literal, CharsNotIn,
-        Word, Keyword, Empty, White, Forward, QuotedString, StringEnd)
+import threading
+
+from pyparsing import ParseException
+
+
+WHITESPACE = ' \n\t\r'
+# Characters ending a run of word text, as in the grammar's wordtext.
+WORD_ENDS = '\\():"{}[]^ '
+FIELD_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz'
+        'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-.')
+# Characters which may not adjoin a keyword, as for pyparsing's Keyword.
+KEYWORD_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz'
+        'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$')
+DIGITS = '0123456789'
+
+PYPARSING_LOCK = threading.Lock()
+_PYPARSING_PARSER = []
+
+
+class Node(list):
+    """
+    A node of the AST: a list of child nodes and strings with the
+    name of the grammar rule which made it, or None for the bounds
+    of a Range.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name, children=()):
+        list.__init__(self, children)
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+    def __repr__(self):
+        return '%s%s' % (self.name or '', list.__repr__(self))
+
+
+class _Parser(object):
+    """
+    Parse one query. Each rule method takes the position to start at,
+    before any whitespace, and returns a node and the position after
+    it, or None if the rule does not match there. Alternatives are
+    tried in the grammar's order and whitespace is skipped where the
+    grammar skips it, so that the two parsers agree on every query.
+    """
+
+    def __init__(self, query):
+        self.text = query.expandtabs()
+        self.length = len(self.text)
+        # the AND, OR and NOT rules each start with a unit, so units
+        # are parsed once per position
+        self.units = {}
+
+    def parse(self):
+        children, position = self.expression(self._skip(0))
+        position = self._skip(position)
+        if position < self.length:
+            raise ParseException(self.text, position, 'Expected end of text')
+        return [Node('Toplevel', children)]
+
+    def _skip(self, position):
+        text = self.text
+        length = self.length
+        while position < length and text[position] in WHITESPACE:
+            position += 1
+        return position
+
+    def _white(self, position):
+        """
+        Return the position after the whitespace at position, or None
+        if there is none.
+        """
+        end = self._skip(position)
+        if end == position:
+            return None
+        return end
+
+    def _keyword(self, position, keyword):
+        """
+        Return the position after keyword if it is at position,
+        standing alone, else None.
+        """
+        text = self.text
+        end = position + len(keyword)
+        if (text.startswith(keyword, position)
+                and (end >= self.length or text[end] not in KEYWORD_CHARS)
+                and (position == 0
+                    or text[position - 1] not in KEYWORD_CHARS)):
+            return end
+        return None
+
+    def _char(self, position, chars):
+        """
+        Return the character at position, after whitespace, and the
+        position after it, if it is one of chars, else None.
+        """
+        position = self._skip(position)
+        if position < self.length and self.text[position] in chars:
+            return self.text[position], position + 1
+        return None
+
+    def expression(self, position):
+        """
+        Parse the operators and units up to the end of the query or
+        of a parenthetical, returning them and the position after.
+        """
+        children = []
+        while True:
+            result = (self.operator(position, 'And', 'AND')
+                    or self.operator(position, 'Or', 'OR')
+                    or self.negation(position)
+                    or self.unit(position))
+            if result is None:
+                return children, position
+            node, position = result
+            children.append(node)
+
+    def operator(self, position, name, keyword):
+        result = self.unit(position)
+        if result is None:
+            return None
+        node, position = result
+        children = [node]
+        while True:
+            after = self._white(position)
+            if after is None:
+                break
+            after = self._keyword(after, keyword)
+            if after is None:
+                break
+            after = self._white(after)
+            if after is None:
+                break
+            result = self.unit(after)
+            if result is None:
+                break
+            node, position = result
+            children.append(node)
+        if len(children) < 2:
+            return None
+        return Node(name, children), position
+
+    def negation(self, position):
+        position = self._keyword(self._skip(position), 'NOT')
+        if position is None:
+            return None
+        position = self._white(position)
+        if position is None:
+            return None
+        result = self.unit(position)
+        if result is None:
+            return None
+        node, position = result
+        return Node('Not', [node]), position
 
+    def unit(self, position):
+        try:
+            return self.units[position]
+        except KeyError:
+            result = self.units[position] = (self.field(position)
+                    or self.fieldable(position))
+            return result
 
-def _make_default_parser():
+    def field(self, position):
+        text = self.text
+        start = end = self._skip(position)
+        while end < self.length and text[end] in FIELD_CHARS:
+            end += 1
+        if end == start:
+            return None
+        colon = self._char(end, ':')
+        if colon is None:
+            return None
+        result = self.fieldable(colon[1])
+        if result is None:
+            return None
+        node, position = result
+        return Node('Field', [text[start:end], node]), position
+
+    def fieldable(self, position):
+        return (self.parenthetical(position) or self.boost(position)
+                or self.boostable(position))
+
+    def parenthetical(self, position):
+        opening = self._char(position, '(')
+        if opening is None:
+            return None
+        children, position = self.expression(opening[1])
+        closing = self._char(position, ')')
+        if closing is None:
+            return None
+        return Node('Group', children), closing[1]
+
+    def boost(self, position):
+        result = self.boostable(position)
+        if result is None:
+            return None
+        node, position = result
+        caret = self._char(position, '^')
+        if caret is None:
+            return None
+        text = self.text
+        start = end = self._skip(caret[1])
+        if end >= self.length or text[end] not in DIGITS:
+            return None
+        end += 1
+        while end < self.length and text[end] in '.0123456789':
+            end += 1
+        return Node('Boost', [node, text[start:end]]), end
+
+    def boostable(self, position):
+        result = self.range(position)
+        if result is None:
+            result = self.word(position)
+            if result is None:
+                result = self.quoted(position)
+                if result is None:
+                    return None
+                return Node('Quotes', [result[0]]), result[1]
+            return Node('Word', [result[0]]), result[1]
+        return result
+
+    def range(self, position):
+        start = self._char(position, '[{')
+        if start is None:
+            return None
+        position = self._skip(start[1])
+        bounds = (self._closed_range(position)
+                or self._open_start_range(position)
+                or self._open_end_range(position))
+        if bounds is None:
+            return None
+        lower, upper, position = bounds
+        end = self._char(position, ']}')
+        if end is None:
+            return None
+        return Node('Range', [start[0], lower, upper, end[0]]), end[1]
+
+    def _closed_range(self, position):
+        lower = self.range_item(position)
+        if lower is None:
+            return None
+        position = self._white(lower[1])
+        if position is None:
+            return None
+        position = self._keyword(position, 'TO')
+        if position is None:
+            return None
+        position = self._white(position)
+        if position is None:
+            return None
+        upper = self.range_item(position)
+        if upper is None:
+            return None
+        return Node(None, [lower[0]]), Node(None, [upper[0]]), upper[1]
+
+    def _open_start_range(self, position):
+        position = self._keyword(position, 'TO')
+        if position is None:
+            return None
+        position = self._white(position)
+        if position is None:
+            return None
+        upper = self.range_item(position)
+        if upper is None:
+            return None
+        return Node(None), Node(None, [upper[0]]), upper[1]
+
+    def _open_end_range(self, position):
+        lower = self.range_item(position)
+        if lower is None:
+            return None
+        position = self._white(lower[1])
+        if position is None:
+            return None
+        position = self._keyword(position, 'TO')
+        if position is None:
+            return None
+        return Node(None, [lower[0]]), Node(None), position
+
+    def range_item(self, position):
+        return self.quoted(position) or self.word(position)
+
+    def quoted(self, position):
+        """
+        Return the text of the double quoted string at position, which
+        may not span lines and has no escapes.
+        """
+        text = self.text
+        position = self._skip(position)
+        if position >= self.length or text[position] != '"':
+            return None
+        end = position + 1
+        while end < self.length and text[end] not in '"\n\r':
+            end += 1
+        if end >= self.length or text[end] != '"':
+            return None
+        return text[position + 1:end], end + 1
+
+    def word(self, position):
+        """
+        Return the word at position, made of word text, carets which
+        do not start a boost and backslash escaped characters.
+        """
+        text = self.text
+        length = self.length
+        position = start = self._skip(position)
+        pieces = []
+        while position < length:
+            char = text[position]
+            if char not in WORD_ENDS:
+                end = position + 1
+                while end < length and text[end] not in WORD_ENDS:
+                    end += 1
+                pieces.append(text[position:end])
+                position = end
+            elif char == '^':
+                if position + 1 < length and text[position + 1] in DIGITS:
+                    break
+                pieces.append(char)
+                position += 1
+            elif char == '\\' and position + 1 < length and (
+                    '!' <= text[position + 1] <= '~'
+                    or text[position + 1] in WHITESPACE):
+                pieces.append(text[position + 1])
+                position += 2
+            else:
+                break
+        if position == start:
+            return None
+        return ''.join(pieces), position
+
+
+def parse(query):
+    """
+    Parse the search query, returning a list of its Toplevel node.
+    """
+    return _Parser(query).parse()
+
+
+def pyparsing_parser():
+    """
+    Return the pyparsing parser, building it on first use.
+    """
+    if not _PYPARSING_PARSER:
+        with PYPARSING_LOCK:
+            if not _PYPARSING_PARSER:
+                _PYPARSING_PARSER.append(_make_pyparsing_parser())
+    return _PYPARSING_PARSER[0]
+
+
+def _make_pyparsing_parser():
     """
     Define a search query grammar that basically amounts to:
 
@@ -20,12 +374,18 @@ def _make_default_parser():
 
     Borrowed from early Whoosh versions
     """
+    from pyparsing import (printables, alphanums, OneOrMore, Group,
+            Combine, Suppress, Literal, CharsNotIn, Word, Keyword, Empty,
+            White, Forward, QuotedString, StringEnd, Regex)
+
     escapechar = "\\"
 
-    wordtext = CharsNotIn('\\():"{}[] ')
+    wordtext = CharsNotIn('\\():"{}[]^ ')
+# A caret is part of a word unless it starts a boost (^2)
+    caret = Regex(r'\^(?![0-9])')
     escape = Suppress(escapechar) + (Word(printables, exact=1)
             | White(exact=1))
-    wordtoken = Combine(OneOrMore(wordtext | escape))
+    wordtoken = Combine(OneOrMore(wordtext | caret | escape))
 # A plain old word.
     plainWord = Group(wordtoken).setResultsName("Word")
 
@@ -89,4 +449,17 @@ def _make_default_parser():
     return toplevel.parseString
 
 
-DEFAULT_PARSER = _make_default_parser()
+def dump_ast(node, indent=0):
+    """
+    Return a readable, indented representation of an AST produced
+    by the parser, one node per line.
+    """
+    if node is None or isinstance(node, basestring):
+        return '%s%r' % (' ' * indent, node)
+    lines = ['%s%s' % (' ' * indent, node.getName() or '-')]
+    for subnode in node:
+        lines.append(dump_ast(subnode, indent + 2))
+    return '\n'.join(lines)
+
+
+DEFAULT_PARSER = parse
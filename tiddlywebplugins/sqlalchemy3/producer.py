@@ -1,15 +1,72 @@
 """
 Produce a sqlalchemy query object from the parser AST.
+
+A ``_rank:1`` term orders results by relevance rather than modified
+time. Each term scores the tiddlers it matches, multiplied by any
+boost (``term^2``): a fielded term scores when its field matches,
+while a plain word scores for a title containing it, a tag or field
+value equal to it and text containing it, in decreasing weight. Text
+is scored with MATCH relevance when MySQL fulltext is on. The score
+is computed and sorted on in the database, so _limit takes the top
+results.
+
+With group_terms, two or more equality terms on tags, or on custom
+fields, within an AND are matched together by one grouped lookup of
+the revisions having all of them, rather than a join of the tag or
+field table for each term. As well as bounding the rows joined, this
+makes a negated AND of such terms exclude only revisions having all
+of them.
 """
 
+import operator
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
 from sqlalchemy.orm import aliased
-from sqlalchemy.sql.expression import (and_, or_, not_, text as text_, label)
+from sqlalchemy.sql.expression import (and_, or_, not_, text as text_, label,
+        bindparam, case, exists, literal, select)
 from sqlalchemy.sql import func
 
 from tiddlyweb.store import StoreError
 
 from tiddlywebplugins.sqlalchemy3 import (sField, sTag, sText, sTiddler,
         sRevision)
+from tiddlywebplugins.sqlalchemy3.model import field_date, field_number
+
+
+# Scores for a plain word matching in each place, before boosting.
+RANK_WEIGHTS = {
+        'title': 4,
+        'tag': 3,
+        'field': 2,
+        'text': 1,
+        }
+
+# Field names which are not custom fields.
+RESERVED_FIELDS = frozenset(['title', 'ftitle', 'bag', 'fbag', 'id', 'near',
+    'text', 'modifier', 'modified', 'type', '_limit', '_rank', '_after'])
+
+
+def encode_cursor(modified, tiddler_id):
+    """
+    Make an opaque search cursor from the modified time and tiddler
+    id of a search result, to be used in an _after:<cursor> term to
+    get the results which follow it.
+    """
+    return unicode(urlsafe_b64encode('%s:%s' % (modified or '', tiddler_id)))
+
+
+def decode_cursor(cursor):
+    """
+    Return the modified time and tiddler id held in cursor.
+    """
+    try:
+        modified, tiddler_id = urlsafe_b64decode(
+                cursor.encode('ascii')).rsplit(':', 1)
+        return unicode(modified), int(tiddler_id)
+    except (TypeError, ValueError, UnicodeError), exc:
+        raise StoreError('failed to parse search query, malformed '
+                'cursor: %s' % exc)
 
 
 class Producer(object):
@@ -17,7 +74,8 @@ class Producer(object):
     Turn a tiddlywebplugins.sqalchemy3.parser AST into a sqlalchemy query.
     """
 
-    def produce(self, ast, query, fulltext=False, geo=False):
+    def produce(self, ast, query, fulltext=False, geo=False,
+            group_terms=False):
         """
         Given an ast and an empty query, build that query into a
         full select, based on the info in the ast.
@@ -26,6 +84,7 @@ class Producer(object):
         self.joined_tags = False
         self.joined_fields = False
         self.joined_text = False
+        self.joins = 0
         self.in_and = False
         self.in_or = False
         self.in_not = False
@@ -33,7 +92,21 @@ class Producer(object):
         self.query = query
         self.fulltext = fulltext
         self.geo = geo
+        self.group_terms = group_terms
+        self.rank = False
+        # scores are only built when a _rank term asks for them
+        self.scoring = _ranked(ast)
+        self.after = False
+        self.boost = 1.0
+        self.scores = []
         expressions = self._eval(ast, None)
+        if self.rank:
+            if self.after:
+                raise StoreError('failed to parse search query, _after '
+                        'cannot be used with _rank')
+            score = reduce(operator.add, self.scores or [literal(0)])
+            self.query = self.query.order_by(None).order_by(score.desc(),
+                    sRevision.modified.desc(), sRevision.tiddler_id.desc())
         if self.limit:
             self.query = self.query.filter(expressions).limit(self.limit)
         else:
@@ -63,7 +136,7 @@ class Producer(object):
                 if value.endswith('*'):
                     value = value.replace('*', '%')
                     like = True
-            except TypeError:
+            except (TypeError, AttributeError):
                 # Hack around field values containing parens
                 # The node[0] is a non-string if that's the case.
                 node[0] = '(' + value[0] + ')'
@@ -73,6 +146,7 @@ class Producer(object):
                 fieldname = 'title'
             if fieldname == 'fbag':
                 fieldname = 'bag'
+            self._score(fieldname, value, like)
 
             if fieldname == 'bag':
                 if like:
@@ -89,26 +163,11 @@ class Producer(object):
                 expression = and_(sTiddler.bag == bag,
                         sTiddler.title == title)
             elif fieldname == 'tag':
-                if self.in_and:
-                    tag_alias = aliased(sTag)
-                    self.query = self.query.join(tag_alias)
-                    if like:
-                        expression = (tag_alias.tag.like(value))
-                    else:
-                        expression = (tag_alias.tag == value)
+                tag = self._tag_entity()
+                if like:
+                    expression = (tag.tag.like(value))
                 else:
-                    if not self.joined_tags:
-                        self.query = self.query.join(sTag)
-                        if like:
-                            expression = (sTag.tag.like(value))
-                        else:
-                            expression = (sTag.tag == value)
-                        self.joined_tags = True
-                    else:
-                        if like:
-                            expression = (sTag.tag.like(value))
-                        else:
-                            expression = (sTag.tag == value)
+                    expression = (tag.tag == value)
             elif fieldname == 'near' and self.geo:
                 # proximity search on geo.long, geo.lat based on
                 # http://cdent.tiddlyspace.com/bags/cdent_public/tiddlers/Proximity%20Search.html
@@ -135,8 +194,8 @@ class Producer(object):
                         * func.sin(
                             func.radians(field_alias2.value)))))
                 self.query = self.query.add_columns(distance)
-                self.query = self.query.join(field_alias1)
-                self.query = self.query.join(field_alias2)
+                self._join(field_alias1)
+                self._join(field_alias2)
                 self.query = self.query.having(
                         u'greatcircle < %s' % radius).order_by('greatcircle')
                 expression = and_(field_alias1.name == u'geo.long',
@@ -148,11 +207,23 @@ class Producer(object):
                 except ValueError:
                     pass
                 self.query = self.query.order_by(
-                        sRevision.modified.desc())
+                        sRevision.modified.desc(),
+                        sRevision.tiddler_id.desc())
+                expression = None
+            elif fieldname == '_rank':
+                self.rank = _rank_wanted(value)
                 expression = None
+            elif fieldname == '_after':
+                # Keyset pagination in (modified, tiddler_id) order,
+                # the leading range on modified lets an index be used.
+                self.after = True
+                modified, tiddler_id = decode_cursor(value)
+                expression = and_(sRevision.modified <= modified,
+                        or_(sRevision.modified < modified,
+                            sRevision.tiddler_id < tiddler_id))
             elif fieldname == 'text':
                 if not self.joined_text:
-                    self.query = self.query.join(sText)
+                    self._join(sText)
                     self.joined_text = True
                 if self.fulltext:
                     expression = (text_(
@@ -169,38 +240,16 @@ class Producer(object):
                     expression = (getattr(sRevision,
                         fieldname) == value)
             else:
-                if self.in_and:
-                    field_alias = aliased(sField)
-                    self.query = self.query.join(field_alias)
-                    expression = (field_alias.name == fieldname)
-                    if like:
-                        expression = and_(expression,
-                                field_alias.value.like(value))
-                    else:
-                        expression = and_(expression,
-                                field_alias.value == value)
+                field = self._field_entity()
+                expression = (field.name == fieldname)
+                if like:
+                    expression = and_(expression, field.value.like(value))
                 else:
-                    if not self.joined_fields:
-                        self.query = self.query.join(sField)
-                        expression = (sField.name == fieldname)
-                        if like:
-                            expression = and_(expression,
-                                    sField.value.like(value))
-                        else:
-                            expression = and_(expression,
-                                    sField.value == value)
-                        self.joined_fields = True
-                    else:
-                        expression = (sField.name == fieldname)
-                        if like:
-                            expression = and_(expression,
-                                    sField.value.like(value))
-                        else:
-                            expression = and_(expression,
-                                    sField.value == value)
+                    expression = and_(expression, field.value == value)
         else:
+            self._score(None, value, False)
             if not self.joined_text:
-                self.query = self.query.join(sText)
+                self._join(sText)
                 self.joined_text = True
             if self.fulltext:
                 expression = (text_(
@@ -212,8 +261,207 @@ class Producer(object):
         return expression
 
     def _Field(self, node, fieldname):
+        if node[1].getName() in ('Range', 'Boost'):
+            return self._eval(node[1], node[0])
         return self._Word(node[1], node[0])
 
+    def _Boost(self, node, fieldname):
+        """
+        Multiply the rank scores of the boosted term by its boost.
+        """
+        try:
+            boost = float(node[1])
+        except ValueError, exc:
+            raise StoreError('failed to parse search query, malformed '
+                    'boost: %s' % exc)
+        outer_boost = self.boost
+        self.boost = outer_boost * boost
+        try:
+            if fieldname and node[0].getName() != 'Range':
+                # as in _Field, a fielded phrase is matched unquoted
+                return self._Word(node[0], fieldname)
+            return self._eval(node[0], fieldname)
+        finally:
+            self.boost = outer_boost
+
+    def _score(self, fieldname, value, like):
+        """
+        Add the rank score for a term matching value in fieldname,
+        or anywhere if fieldname is None. Negated and control terms
+        do not score.
+        """
+        if (not self.scoring or self.in_not or fieldname in ('id', 'near',
+                '_limit', '_after', '_rank')):
+            return
+
+        def matches(column, contains=False):
+            if contains:
+                return column.like('%' + value + '%')
+            if like:
+                return column.like(value)
+            return column == value
+
+        def scored(condition, weight):
+            return case([(condition, weight * self.boost)], else_=0)
+
+        # Subqueries correlate only with the current revision, as the
+        # query may also join the tables they read.
+        revision = sRevision.__table__
+
+        def tagged():
+            tag = sTag.__table__
+            return exists().where(and_(
+                tag.c.revision_number == revision.c.number,
+                matches(tag.c.tag))).correlate(revision)
+
+        def field_valued(name=None):
+            field = sField.__table__
+            conditions = [field.c.revision_number == revision.c.number,
+                    matches(field.c.value)]
+            if name is not None:
+                conditions.append(field.c.name == name)
+            return exists().where(and_(*conditions)).correlate(revision)
+
+        def text_score(weight):
+            text_table = sText.__table__
+            if self.fulltext:
+                relevance = text_('MATCH(text.text) AGAINST(:rank_text '
+                        'IN BOOLEAN MODE)').bindparams(bindparam('rank_text',
+                            value, unique=True))
+                return (select([relevance])
+                        .where(text_table.c.revision_number
+                            == revision.c.number)
+                        .correlate(revision)
+                        .as_scalar() * weight * self.boost)
+            return scored(exists().where(and_(
+                text_table.c.revision_number == revision.c.number,
+                matches(text_table.c.text, contains=True)))
+                .correlate(revision), weight)
+
+        if fieldname is None:
+            self.scores.extend([
+                scored(matches(sTiddler.title, contains=True),
+                    RANK_WEIGHTS['title']),
+                scored(tagged(), RANK_WEIGHTS['tag']),
+                scored(field_valued(), RANK_WEIGHTS['field']),
+                text_score(RANK_WEIGHTS['text'])])
+        elif fieldname in ('title', 'bag'):
+            self.scores.append(scored(matches(getattr(sTiddler, fieldname)),
+                1))
+        elif fieldname in ('modifier', 'modified', 'type'):
+            self.scores.append(scored(matches(getattr(sRevision,
+                fieldname)), 1))
+        elif fieldname == 'tag':
+            self.scores.append(scored(tagged(), 1))
+        elif fieldname == 'text':
+            self.scores.append(text_score(1))
+        else:
+            self.scores.append(scored(field_valued(fieldname), 1))
+
+    def _Range(self, node, fieldname):
+        """
+        Compare a column with the bounds of a range, [ and ] being
+        inclusive, { and } exclusive and a missing or * bound open.
+        Custom fields are compared as dates if both bounds are dates,
+        as numbers if both are numbers, otherwise as strings.
+        """
+        start_fence, start, end, end_fence = node
+        start = start and start[0] not in ('*', '') and start[0] or None
+        end = end and end[0] not in ('*', '') and end[0] or None
+        start_inclusive = start_fence == '['
+        end_inclusive = end_fence == ']'
+
+        fieldname = {'ftitle': 'title', 'fbag': 'bag'}.get(fieldname,
+                fieldname)
+        bounds = [bound for bound in (start, end) if bound is not None]
+        condition = None
+        if fieldname in ('title', 'bag'):
+            column = getattr(sTiddler, fieldname)
+        elif fieldname in ('modifier', 'type'):
+            column = getattr(sRevision, fieldname)
+        elif fieldname == 'modified':
+            column = sRevision.modified
+            if all(field_date(bound) for bound in bounds):
+                start, end = _date_bounds(start, end, start_inclusive,
+                        end_inclusive)
+        elif fieldname == 'tag':
+            column = self._tag_entity().tag
+        elif (not fieldname or fieldname.startswith('_')
+                or fieldname in ('text', 'id', 'near')):
+            raise StoreError('failed to parse search query, range not '
+                    'supported on %s' % (fieldname or 'text'))
+        else:
+            field = self._field_entity()
+            condition = (field.name == fieldname)
+            if bounds and all(field_date(bound) for bound in bounds):
+                column = field.value_date
+                start, end = _date_bounds(start, end, start_inclusive,
+                        end_inclusive)
+            elif bounds and all(field_number(bound) is not None
+                    for bound in bounds):
+                column = field.value_number
+                start = start and field_number(start)
+                end = end and field_number(end)
+            else:
+                column = field.value
+
+        if start is not None and end is not None and (start_inclusive
+                and end_inclusive):
+            expression = column.between(start, end)
+        else:
+            expressions = []
+            if start is not None:
+                if start_inclusive:
+                    expressions.append(column >= start)
+                else:
+                    expressions.append(column > start)
+            if end is not None:
+                if end_inclusive:
+                    expressions.append(column <= end)
+                else:
+                    expressions.append(column < end)
+            if not expressions:
+                expressions.append(column != None)
+            expression = and_(*expressions)
+        if condition is not None:
+            expression = and_(condition, expression)
+        return expression
+
+    def _join(self, target):
+        """
+        Join target to the query, counting the joins made.
+        """
+        self.query = self.query.join(target)
+        self.joins += 1
+
+    def _tag_entity(self):
+        """
+        Join the tag table, aliased within an AND so each term has
+        its own row, returning the entity to filter on.
+        """
+        if self.in_and:
+            tag_alias = aliased(sTag)
+            self._join(tag_alias)
+            return tag_alias
+        if not self.joined_tags:
+            self._join(sTag)
+            self.joined_tags = True
+        return sTag
+
+    def _field_entity(self):
+        """
+        Join the field table, aliased within an AND so each term has
+        its own row, returning the entity to filter on.
+        """
+        if self.in_and:
+            field_alias = aliased(sField)
+            self._join(field_alias)
+            return field_alias
+        if not self.joined_fields:
+            self._join(sField)
+            self.joined_fields = True
+        return sField
+
     def _Group(self, node, fieldname):
         expressions = []
         for subnode in node:
@@ -231,11 +479,52 @@ class Producer(object):
     def _And(self, node, fieldname):
         expressions = []
         self.in_and = True
-        for subnode in node:
-            expressions.append(self._eval(subnode, fieldname))
+        terms = [self.group_terms and _equality_term(subnode)
+                for subnode in node]
+        tags = [term[1] for term in terms if term and term[0] == 'tag']
+        fields = [term for term in terms if term and term[0] != 'tag']
+        for subnode, term in zip(node, terms):
+            if not term or len(term[0] == 'tag' and tags or fields) < 2:
+                # a nested AND ends in_and
+                self.in_and = True
+                expressions.append(self._eval(subnode, fieldname))
+        if len(tags) > 1:
+            expressions.append(self._all_tags(tags))
+        if len(fields) > 1:
+            expressions.append(self._all_fields(fields))
         self.in_and = False
         return and_(*expressions)
 
+    def _all_tags(self, values):
+        """
+        Return a condition matching revisions with every tag in values,
+        as one indexed lookup of the tags grouped by revision.
+        """
+        for value in values:
+            self._score('tag', value, False)
+        values = sorted(set(values))
+        tag = sTag.__table__
+        return sRevision.number.in_(select([tag.c.revision_number])
+                .where(tag.c.tag.in_(values))
+                .group_by(tag.c.revision_number)
+                .having(func.count() == len(values)))
+
+    def _all_fields(self, terms):
+        """
+        Return a condition matching revisions with every field name
+        and value pair in terms, as one lookup of the fields grouped
+        by revision.
+        """
+        for name, value in terms:
+            self._score(name, value, False)
+        terms = sorted(set(terms))
+        field = sField.__table__
+        return sRevision.number.in_(select([field.c.revision_number])
+                .where(or_(*[and_(field.c.name == name, field.c.value == value)
+                    for name, value in terms]))
+                .group_by(field.c.revision_number)
+                .having(func.count() == len(terms)))
+
     def _Not(self, node, fieldname):
         expressions = []
         self.in_not = True
@@ -247,3 +536,49 @@ class Producer(object):
     def _Quotes(self, node, fieldname):
         node[0] = '"%s"' % node[0]
         return self._Word(node, fieldname)
+
+
+def _rank_wanted(value):
+    """
+    Return True if value of a _rank term turns ranking on.
+    """
+    return value.lower() not in ('0', 'false', 'no')
+
+
+def _ranked(node):
+    """
+    Return True if the AST node has a _rank term turning ranking on.
+    """
+    if node.getName() == 'Field' and node[0] == '_rank':
+        value = node[1][0]
+        return (node[1].getName() != 'Word'
+                or not isinstance(value, basestring) or _rank_wanted(value))
+    return any(_ranked(child) for child in node
+            if not isinstance(child, basestring))
+
+
+def _equality_term(node):
+    """
+    Return the field name and value of node if it is a term matching
+    a tag or custom field equal to a value, else None.
+    """
+    if node.getName() != 'Field' or node[1].getName() not in ('Word',
+            'Quotes'):
+        return None
+    fieldname, value = node[0], node[1][0]
+    if (not isinstance(value, basestring) or value.endswith('*')
+            or fieldname in RESERVED_FIELDS):
+        return None
+    return fieldname, value
+
+
+def _date_bounds(start, end, start_inclusive, end_inclusive):
+    """
+    Expand date range bounds to timestamps, so that a date includes
+    (or excludes) every time on that day.
+    """
+    if start is not None:
+        start = field_date(start, start_inclusive and '0' or '9')
+    if end is not None:
+        end = field_date(end, end_inclusive and '9' or '0')
+    return start, end
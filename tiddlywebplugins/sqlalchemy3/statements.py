@@ -0,0 +1,187 @@
+"""
+Statements for the store's fixed-shape lookups and writes, defined
+once so that each call only binds parameters and executes.
+
+ORM lookups are baked queries: the Query is built and its SQL
+compiled on first use, then reused. Core statements are module level
+objects executed by ``Store._execute`` with a compiled cache, which
+keys compiled SQL by statement object, so only these fixed statements
+may be executed that way. Dialect specific inserts are built once per
+dialect.
+"""
+
+from sqlalchemy.ext import baked
+from sqlalchemy.sql.expression import and_, bindparam, exists, select
+
+from .model import (sBag, sRecipe, sUser, sTiddler, sRevision, sText, sTag,
+        sField, sPolicy, bag_policy_table, recipe_policy_table,
+        current_revision_table, first_revision_table, bag_deletion_table,
+        bag_counter_table)
+
+
+BAKERY = baked.bakery()
+
+# Compiled SQL of the statements below, by dialect, statement and
+# parameter names.
+COMPILED_STATEMENTS = {}
+
+TIDDLER = sTiddler.__table__
+BAG = sBag.__table__
+RECIPE = sRecipe.__table__
+POLICY = sPolicy.__table__
+DELETION = bag_deletion_table
+
+# True for a bag, or the bag of a tiddler or bag counter, which is
+# being deleted in chunks, and so is hidden from reads.
+BAG_DELETING = exists().where(DELETION.c.bag == BAG.c.name)
+TIDDLER_BAG_DELETING = exists().where(DELETION.c.bag == TIDDLER.c.bag)
+COUNTER_BAG_DELETING = exists().where(
+        DELETION.c.bag == bag_counter_table.c.bag)
+
+
+def _baked(name, entity, *conditions):
+    """
+    Return a baked query of entity filtered by conditions. The bakery
+    keys queries by the code of their lambdas, which is shared by all
+    queries made here, so name is added to the key.
+    """
+    query = BAKERY(lambda session: session.query(entity), name)
+    query += lambda query: query.filter(and_(*conditions))
+    return query
+
+
+BAG_BY_NAME = _baked('bag', sBag, sBag.name == bindparam('name'),
+        ~BAG_DELETING)
+RECIPE_BY_NAME = _baked('recipe', sRecipe,
+        sRecipe.name == bindparam('name'))
+USER_BY_USERSIGN = _baked('user', sUser,
+        sUser.usersign == bindparam('usersign'))
+TIDDLER_BY_NAME = _baked('tiddler', sTiddler,
+        sTiddler.title == bindparam('title'),
+        sTiddler.bag == bindparam('bag'))
+TIDDLER_BY_ID_AND_NAME = _baked('tiddler_id', sTiddler,
+        sTiddler.id == bindparam('id'),
+        sTiddler.title == bindparam('title'),
+        sTiddler.bag == bindparam('bag'))
+REVISION_BY_NUMBER = _baked('revision', sRevision,
+        sRevision.number == bindparam('number'))
+
+# The id of a tiddler, or a row of null if the bag exists but the
+# tiddler does not, or no row if the bag does not exist, with the name
+# of the bag if it is being deleted.
+TIDDLER_ID_IN_BAG = (select([TIDDLER.c.id, DELETION.c.bag])
+        .select_from(BAG.outerjoin(TIDDLER, and_(TIDDLER.c.bag == BAG.c.name,
+            TIDDLER.c.title == bindparam('title')))
+            .outerjoin(DELETION, DELETION.c.bag == BAG.c.name))
+        .where(BAG.c.name == bindparam('bag')))
+TIDDLER_ID = select([TIDDLER.c.id]).where(and_(
+    TIDDLER.c.bag == bindparam('bag'), TIDDLER.c.title == bindparam('title')))
+CURRENT_REVISION = (select([current_revision_table.c.current_id])
+        .select_from(TIDDLER.join(current_revision_table))
+        .where(and_(TIDDLER.c.bag == bindparam('bag'),
+            TIDDLER.c.title == bindparam('title'))))
+
+# The titles of the tiddlers in a bag, or a row of null if the bag is
+# empty, or no row if the bag does not exist.
+TIDDLER_TITLES_IN_BAG = (select([TIDDLER.c.title])
+        .select_from(BAG.outerjoin(TIDDLER, TIDDLER.c.bag == BAG.c.name))
+        .where(and_(BAG.c.name == bindparam('bag'), ~BAG_DELETING)))
+
+# Rows for building bags, recipes and users without the ORM.
+BAG_ROWS = select([BAG.c.id, BAG.c.name, BAG.c.desc]).where(~BAG_DELETING)
+RECIPE_ROWS = select([RECIPE.c.id, RECIPE.c.name, RECIPE.c.desc,
+    RECIPE.c.recipe_string])
+USERSIGNS = select([sUser.__table__.c.usersign])
+
+
+def _policy_rows(link_table, container_column):
+    return (select([container_column.label('container_id'),
+        POLICY.c.constraint, POLICY.c.principal_name,
+        POLICY.c.principal_type])
+        .select_from(link_table.join(POLICY))
+        .order_by(container_column, POLICY.c.id))
+
+
+BAG_POLICY_ROWS = _policy_rows(bag_policy_table, bag_policy_table.c.bag_id)
+RECIPE_POLICY_ROWS = _policy_rows(recipe_policy_table,
+        recipe_policy_table.c.recipe_id)
+
+# A bag's id, with its name if it is being deleted.
+BAG_DELETION = (select([BAG.c.id, DELETION.c.bag])
+        .select_from(BAG.outerjoin(DELETION, DELETION.c.bag == BAG.c.name))
+        .where(BAG.c.name == bindparam('bag')))
+# A bag being deleted in chunks, and a chunk of its tiddlers.
+NEXT_DELETION = select([DELETION.c.bag, DELETION.c.tiddlers,
+    DELETION.c.removed]).order_by(DELETION.c.bag).limit(1)
+TIDDLER_IDS_IN_BAG = select([TIDDLER.c.id]).where(
+        TIDDLER.c.bag == bindparam('bag')).limit(bindparam('chunk'))
+
+INSERT_REVISION = sRevision.__table__.insert()
+INSERT_TEXT = sText.__table__.insert()
+INSERT_TAG = sTag.__table__.insert()
+INSERT_FIELD = sField.__table__.insert()
+INSERT_CURRENT = current_revision_table.insert()
+INSERT_FIRST = first_revision_table.insert()
+
+DIALECT_STATEMENTS = {}
+
+
+def insert_ignoring_conflicts(dialect, table, returning=None):
+    """
+    Return an insert into table which skips rows that would violate
+    a unique constraint, where the dialect allows, returning the
+    column returning if given. On MySQL a conflicting row sets its
+    first primary key column to itself, as INSERT IGNORE would also
+    turn other errors into warnings.
+    """
+    key = ('ignore', dialect, table.name, returning is not None
+            and returning.name)
+    statement = DIALECT_STATEMENTS.get(key)
+    if statement is None:
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = insert(table).on_conflict_do_nothing()
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            column = list(table.primary_key)[0]
+            statement = insert(table).on_duplicate_key_update(
+                    **{column.name: column})
+        elif dialect == 'sqlite':
+            statement = table.insert().prefix_with('OR IGNORE')
+        else:
+            statement = table.insert()
+        if returning is not None:
+            statement = statement.returning(returning)
+        DIALECT_STATEMENTS[key] = statement
+    return statement
+
+
+def upsert(dialect, table, names):
+    """
+    Return an insert into table of the columns names which replaces
+    the row with the same primary key, or None if the dialect has no
+    such statement.
+    """
+    key = ('upsert', dialect, table.name, tuple(sorted(names)))
+    statement = DIALECT_STATEMENTS.get(key)
+    if statement is None:
+        keys = [column.name for column in table.primary_key]
+        updates = [name for name in names if name not in keys]
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = insert(table)
+            statement = statement.on_conflict_do_update(index_elements=keys,
+                    set_=dict((name, statement.excluded[name])
+                        for name in updates))
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(table)
+            statement = statement.on_duplicate_key_update(
+                    **dict((name, statement.inserted[name])
+                        for name in updates))
+        elif dialect == 'sqlite':
+            statement = table.insert().prefix_with('OR REPLACE')
+        else:
+            return None
+        DIALECT_STATEMENTS[key] = statement
+    return statement